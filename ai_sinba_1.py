@@ -1,543 +1,1287 @@
 import pandas as pd
 import numpy as np
 import re
+import os
 import datetime
 import pickle
-from tqdm.notebook import tqdm
-from sklearn.metrics import roc_auc_score
-from sklearn.model_selection import train_test_split
-from sklearn.ensemble import RandomForestClassifier
+import json
+import asyncio
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import weakref
+import time
+import threading
+import functools
+import tracemalloc
+# sklearnとtqdmは使うところで読む（採点だけのプロセスやワーカーの起動を軽くする）
 
 
-class Results:
+class Profiler:
+    # 各メソッド・主な処理単位の時間、行数（入力・出力）、ピークメモリの増分を記録する。
+    # 無効のとき（既定）はspan・iterate・profiledはほぼ何もしない
     def __init__(self):
+        self.enabled = False
+        self.memory = False
+        self.records = []
+        self.local = threading.local()
+
+    def enable(self, memory=False):
+        # memory=Trueならtracemallocでピークメモリも測る（遅くなる）
+        self.enabled = True
+        self.memory = memory
+        if memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def disable(self):
+        self.enabled = False
+        if self.memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self.memory = False
+
+    def reset(self):
+        self.records = []
+
+    def span(self, name, rows_in=None):
+        return Span(self, name, rows_in) if self.enabled else NO_SPAN
+
+    def iterate(self, items, prefix):
+        # (名前, ...)を返すイテレータの1要素ごとの処理時間を、prefix+名前のspanにする
+        return self._iterate(items, prefix) if self.enabled else items
+
+    def _iterate(self, items, prefix):
+        it = iter(items)
+        while True:
+            span = Span(self, prefix)
+            span.__enter__()
+            try:
+                item = next(it)
+            except StopIteration:
+                span.name = None
+                span.__exit__(None, None, None)
+                return
+            span.name = prefix + str(item[0])
+            span.__exit__(None, None, None)
+            yield item
+
+    def stack(self):
+        if not hasattr(self.local, "stack"):
+            self.local.stack = []
+        return self.local.stack
+
+    def summary(self):
+        df = pd.DataFrame(self.records, columns=["name", "start", "seconds", "rows_in", "rows_out", "peak_MB", "depth", "tid"])
+        summary = df.groupby("name", sort=False).agg(calls=("seconds", "size"), total_s=("seconds", "sum"), max_s=("seconds", "max"),
+                                                   rows_in=("rows_in", "sum"), rows_out=("rows_out", "sum"),
+                                                   peak_MB=("peak_MB", "max"), depth=("depth", "min"))
+        summary["mean_ms"] = summary["total_s"] / summary["calls"] * 1000
+        return summary.sort_values("total_s", ascending=False)
+
+    def export_chrome_trace(self, path):
+        # chrome://tracing や Perfetto で開ける形式
+        events = [{"name": r["name"], "ph": "X", "ts": r["start"] * 1e6, "dur": r["seconds"] * 1e6, "pid": os.getpid(), "tid": r["tid"],
+                   "args": {k: r[k] for k in ("rows_in", "rows_out", "peak_MB") if r[k] is not None}} for r in self.records]
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, ensure_ascii=False)
+
+
+class Span:
+    def __init__(self, profiler, name, rows_in=None):
+        self.profiler = profiler
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.peak = 0
+
+    def __enter__(self):
+        stack = self.profiler.stack()
+        if self.profiler.memory:
+            # 外側のspanのピークを取っておいてから、このspan用にピークを測り直す
+            current, peak = tracemalloc.get_traced_memory()
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, peak - stack[-1].base)
+            tracemalloc.reset_peak()
+            self.base = current
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        seconds = time.perf_counter() - self.start
+        stack = self.profiler.stack()
+        stack.pop()
+        peak = None
+        if self.profiler.memory:
+            self.peak = max(self.peak, tracemalloc.get_traced_memory()[1] - self.base)
+            peak = self.peak / 1024 ** 2
+            if stack:
+                stack[-1].peak = max(stack[-1].peak, self.base + self.peak - stack[-1].base)
+        if self.name is not None:
+            self.profiler.records.append({"name": self.name, "start": self.start, "seconds": seconds, "rows_in": self.rows_in,
+                                          "rows_out": self.rows_out, "peak_MB": peak, "depth": len(stack),
+                                          "tid": threading.get_ident()})
+        return False
+
+
+class NoSpan:
+    rows_out = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+NO_SPAN = NoSpan()
+PROFILER = Profiler()
+
+
+def profiled(out=None):
+    # メソッドをspanで包む。行数は最初のDataFrame引数と戻り値（outを指定したらその属性）の長さ
+    def decorate(func):
+        name = func.__qualname__
+
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not PROFILER.enabled:
+                return func(self, *args, **kwargs)
+            rows_in = next((len(a) for a in args if isinstance(a, (pd.DataFrame, pd.Series))), None)
+            with PROFILER.span(name, rows_in) as span:
+                result = func(self, *args, **kwargs)
+                value = getattr(self, out) if out is not None else result
+                if isinstance(value, (pd.DataFrame, pd.Series, np.ndarray)):
+                    span.rows_out = len(value)
+            return result
+        return wrapper
+    return decorate
+
+
+# 進捗バーを出すか（CLIから実行したときだけTrue）
+PROGRESS = False
+
+
+def progress(iterable, desc=None, total=None):
+    # コンソールの進捗バー（tqdm）。PROGRESSがFalseならそのまま返す
+    if not PROGRESS:
+        return iterable
+    from tqdm import tqdm
+    return tqdm(iterable, desc=desc, total=total)
+
+
+MONTH_SEASON = {3:"春", 4:"春", 5:"春", 6:"夏", 7:"夏", 8:"夏", 9:"秋", 10:"秋", 11:"秋", 12:"冬", 1:"冬", 2:"冬"}
+
+# 実績季節は季節ごとのビット（春1・夏2・秋4・冬8）を重ねたマスクで持つ
+SEASON_BITS = {"春": 1, "夏": 2, "秋": 4, "冬": 8}
+
+# 戦績の文字列列のパース（str.extractでまとめて切り出す）
+KEIBAJO_CODES = {"函館":"01", "札幌":"02", "福島":"03", "新潟":"04", "東京":"05", "中山":"06", "中京":"07", "京都":"08", "阪神":"09", "小倉":"10"}
+RACE_TYPES = {"芝":"芝", "ダ":"ダート", "障":"障害"}
+DISTANCE_PATTERN = re.compile(r"^(?P<race_type>\D)(?P<distance>\d+)")                      # 芝1600
+KAISAI_PATTERN = re.compile(r"^.(?P<競馬場>%s)" % "|".join(KEIBAJO_CODES))                  # 1東京2（地方はNaN）
+WEIGHT_PATTERN = re.compile(r"^(?P<体重>\d+)(?:\((?P<体重増減>[+-]?\d+)\))?")               # 480(+4)、計不はNaN
+CORNER_PATTERN = re.compile(r"^\D*(?P<first_corner>\d+)(?:-(?P<second_corner>\d+))?"
+                            r"(?:-(?P<third_corner>\d+))?(?:-(?P<fourth_corner>\d+))?")  # 3-3-2-1
+
+# モデルに渡す特徴量（Peds.pointedの列）
+FEATURES = ["bld_point", "lead_point", "rank_point", "agari_point", "camp_point", "advantage_point", "point_all"]
+# point_allを足し合わせている成分（Backtestで重みを振る）
+POINT_COMPONENTS = ["bld_point", "lead_point", "rank_point", "agari_point", "camp_point", "advantage_point"]
+
+# asof_mergeで戦績から引く列（N走前 → 列）と、それ以外にasof_mergeが戦績で使う列
+LAG_COLS = {1: ["馬番", "人気", "体重", "着順", "着差", "date", "distance", "first_corner", "上り"],
+            2: ["実質着順", "着順", "着差", "date", "distance", "上り"],
+            3: ["実質着順", "着差", "date", "distance", "上り"]}
+HISTORY_COLS = ["date", "競馬場", "着順", "季節", "jockey_id"]
+
+# 騎手・調教師ポイント: その日より前にCAMP_MIN_STARTS回以上乗って（管理して）連対率がCAMP_MIN_RATE以上なら加点
+CAMP_MIN_STARTS = 100
+CAMP_MIN_RATE = 0.25
+
+# 特徴量フレームの型。_N走前の列は元の列名で引く
+SCHEMA_CATEGORY = ["course", "競馬場", "race_type", "sex", "父", "母父", "母母父"]
+SCHEMA_SEASON = ["季節"]
+# NaNが無ければint16、あればfloat32（上りは標準化に使うのでfloat64のまま）
+SCHEMA_INT = ["着順", "人気", "馬番", "枠番", "年齢", "体重", "体重増減", "頭数", "month", "distance", "course_len",
+              "first_corner", "second_corner", "third_corner", "fourth_corner", "出走回数",
+              "前々走距離変化", "前走距離変化", "今回距離変化", "blood_point", "advantage_point"]
+SCHEMA_FLOAT = ["着差", "実質着順", "斤量"]
+
+
+class Schema:
+    # 型を詰めて、詰める前後のメモリを記録する
+    def __init__(self, measure=True):
+        # measure=Falseならメモリを測らない（deep=Trueの計測は文字列の列が多いと重い）
+        self.measure = measure
+        self.rows = []
+
+    @profiled()
+    def apply(self, df, stage, flags=()):
+        before = df.memory_usage(deep=True).sum() if self.measure else np.nan
+        dtypes = {}
+        for col in df.columns:
+            base = re.sub(r"_\d走前$", "", col) if isinstance(col, str) else col
+            numeric = pd.api.types.is_numeric_dtype(df[col]) and not pd.api.types.is_bool_dtype(df[col])
+            if col in flags:
+                dtypes[col] = np.uint8
+            elif base in SCHEMA_CATEGORY:
+                dtypes[col] = "category"
+            elif base in SCHEMA_SEASON:
+                dtypes[col] = pd.CategoricalDtype(list(SEASON_BITS), ordered=True)
+            elif base in SCHEMA_INT and numeric:
+                values = df[col]
+                fits = values.notna().all() and (values.abs() <= np.iinfo(np.int16).max).all() and (values % 1 == 0).all()
+                dtypes[col] = np.int16 if fits else np.float32
+            elif base in SCHEMA_FLOAT and numeric:
+                dtypes[col] = np.float32
+        # 型が変わる列だけまとめて変換する
+        dtypes = {col: dtype for col, dtype in dtypes.items() if df[col].dtype != dtype}
+        flags = [col for col in flags if col in dtypes]
+        if flags:
+            df = df.fillna(dict.fromkeys(flags, 0))
+        df = df.astype(dtypes) if dtypes else df.copy(deep=False)
+        after = df.memory_usage(deep=True).sum() if self.measure else np.nan
+        self.rows.append({"stage": stage, "before_MB": before / 1024 ** 2, "after_MB": after / 1024 ** 2})
+        return df
+
+    def report(self):
+        report = pd.DataFrame(self.rows, columns=["stage", "before_MB", "after_MB"])
+        report["ratio"] = report["before_MB"] / report["after_MB"]
+        return report
+
+
+class StageCache:
+    # 前処理の結果を入力のハッシュ（データ・ファイルの更新日時・コード）ごとにArrow IPCで保存する
+    def __init__(self, path="cache", max_bytes=4 * 1024 ** 3):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.keys = {}
+        os.makedirs(path, exist_ok=True)
+
+    @profiled()
+    def run(self, stage, func, *inputs):
+        key = self.key(stage, *inputs)
+        df = self.get(stage, key)
+        if df is None:
+            df = func(*inputs)
+            self.put(stage, key, df)
+        # 出力を次の段の入力にするときは、中身をハッシュし直さずにこのキーを使う
+        self.keys[id(df)] = (weakref.ref(df), key)
+        return df
+
+    def key(self, stage, *inputs):
+        h = hashlib.sha1(stage.encode())
+        h.update(self.code_version().encode())
+        for x in inputs:
+            h.update(self._fingerprint(x).encode())
+        return h.hexdigest()
+
+    def code_version(self):
+        # スクリプトが変わったら全部作り直す。ノートブックなど__file__が無いときはクラスのバイトコードで代用
+        try:
+            with open(__file__, "rb") as f:
+                return hashlib.sha1(f.read()).hexdigest()
+        except (NameError, OSError):
+            h = hashlib.sha1()
+            for cls in (Results, Peds):
+                for name, func in sorted(vars(cls).items()):
+                    if hasattr(func, "__code__"):
+                        h.update(name.encode() + func.__code__.co_code + repr(func.__code__.co_consts).encode())
+            return h.hexdigest()
+
+    def _fingerprint(self, x):
+        if isinstance(x, (pd.DataFrame, pd.Series)):
+            ref, key = self.keys.get(id(x), (None, None))
+            if ref is not None and ref() is x:
+                return key
+            h = hashlib.sha1(pd.util.hash_pandas_object(x, index=True).values.tobytes())
+            h.update(repr(list(x.columns) if isinstance(x, pd.DataFrame) else x.name).encode())
+            h.update(repr(list(x.dtypes.astype(str)) if isinstance(x, pd.DataFrame) else str(x.dtype)).encode())
+            return h.hexdigest()
+        if isinstance(x, (list, tuple)):
+            return "[" + ",".join(self._fingerprint(v) for v in x) + "]"
+        if isinstance(x, str) and os.path.isfile(x):
+            st = os.stat(x)
+            return "%s:%d:%d" % (os.path.abspath(x), st.st_mtime_ns, st.st_size)
+        return repr(x)
+
+    def _file(self, stage, key):
+        return os.path.join(self.path, "%s-%s.arrow" % (stage, key))
+
+    def get(self, stage, key):
+        path = self._file(stage, key)
+        if not os.path.exists(path):
+            return None
+        import pyarrow as pa
+        with pa.memory_map(path) as source:
+            df = pa.ipc.open_file(source).read_all().to_pandas()
+        os.utime(path)  # 最後に使った時刻（追い出しの順番に使う）
+        return df
+
+    def put(self, stage, key, df):
+        import pyarrow as pa
+        path = self._file(stage, key)
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(path + ".tmp", "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        os.replace(path + ".tmp", path)
+        self.evict(keep=path)
+
+    def evict(self, keep=None):
+        # 合計がmax_bytesを超えたら、使われていない順に消す
+        files = [os.path.join(self.path, f) for f in os.listdir(self.path) if f.endswith(".arrow")]
+        files = sorted(files, key=os.path.getmtime)
+        total = sum(os.path.getsize(f) for f in files)
+        for f in files:
+            if total <= self.max_bytes:
+                break
+            if f != keep:
+                total -= os.path.getsize(f)
+                os.remove(f)
+
+    def invalidate(self, stage=None):
+        # stageを指定したらその段だけ、指定しなければ全部消す
+        for f in os.listdir(self.path):
+            if f.endswith(".arrow") and (stage is None or f.startswith(stage + "-")):
+                os.remove(os.path.join(self.path, f))
+
+
+class Results:
+    def __init__(self, cache=None, performance_by=(), backend=None):
+        # performance_by: 騎手・調教師の成績を分ける列（("競馬場", "race_type")など。空なら通算）
+        # backend: 過去走の結合を別の実装（PolarsBackendなど）で回すとき
         self.results = pd.DataFrame()
         self.hr = pd.DataFrame()
         self.merged = pd.DataFrame()
+        self.state = {}
+        self.cache = cache
+        self.performance_by = tuple(performance_by)
+        self.backend = backend
+        self.schema = Schema()
+
+    def _run(self, stage, func, *inputs):
+        return self.cache.run(stage, func, *inputs) if self.cache is not None else func(*inputs)
     
+    @profiled(out="results")
     def p_p(self, results):
-        self.results = results.copy()
-        self.results.loc[self.results["course_len"]<1000, "course_len"] = 3600 # ステイヤーズS 中山２周となっているので修正いれておく
-        self.results["着順"] = pd.to_numeric(self.results["着順"], errors="coerce")
-        self.results["sex"] = self.results["性齢"].map(lambda x: str(x)[0])
-        self.results["年齢"] = self.results["性齢"].map(lambda x: str(x)[1:]).astype(int)
-        self.results["date"] = pd.to_datetime(self.results["date"], format="%Y年%m月%d日")
-        self.results["month"] = self.results["date"].map(lambda x: x.month)
-        month_dict = {3:"春", 4:"春", 5:"春", 6:"夏", 7:"夏", 8:"夏", 9:"秋", 10:"秋", 11:"秋", 12:"冬", 1:"冬", 2:"冬"}
-        self.results["季節"] = self.results["month"].map(month_dict)
-        self.results["race_id"] = self.results.index
-        self.results = self.results.drop(columns={"馬名","性齢","タイム","着差","単勝","馬体重","調教師"})
+        self.results = self._run("results", lambda results: self.schema.apply(self._p_p_results(results), "results"), results)
+
+    def _p_p_results(self, results):
+        results = results.copy()
+        results.loc[results["course_len"]<1000, "course_len"] = 3600 # ステイヤーズS 中山２周となっているので修正いれておく
+        results["着順"] = pd.to_numeric(results["着順"], errors="coerce")
+        seirei = results["性齢"].astype(str)
+        results["sex"] = seirei.str[0]
+        results["年齢"] = seirei.str[1:].astype(int)
+        results["date"] = pd.to_datetime(results["date"], format="%Y年%m月%d日")
+        results["month"] = results["date"].dt.month
+        results["季節"] = results["month"].map(MONTH_SEASON)
+        results["race_id"] = results.index
+        results = results.drop(columns={"馬名","性齢","タイム","着差","単勝","馬体重","調教師"})
+        return results
     
-    def merge(self, horse_results):
-        self.hr = horse_results.copy()
-        self.hr["date"] = pd.to_datetime(self.hr["日付"])
-        self.hr.drop(['日付'], axis=1, inplace=True)
-        self.hr["month"] = self.hr["date"].map(lambda x: x.month)
-        month_dict = {3:"春", 4:"春", 5:"春", 6:"夏", 7:"夏", 8:"夏", 9:"秋", 10:"秋", 11:"秋", 12:"冬", 1:"冬", 2:"冬"}
-        self.hr["季節"] = self.hr["month"].map(month_dict)
-        self.hr["distance"] = self.hr["距離"].map(lambda x: str(x)[1:])
-        self.hr["distance"] = self.hr["distance"].astype(int)
-        self.hr["着順"] = pd.to_numeric(self.hr["着順"], errors="coerce")
-        self.hr["実質着順"] = (1 - self.hr["着順"] / self.hr["頭数"])
-        race_type_dict = {"ダ":"ダート", "障":"障害"}
-        self.hr["race_type"] = self.hr["距離"].map(lambda x: str(x)[0])
-        self.hr["race_type"] = self.hr["race_type"].map(race_type_dict)
-        self.hr["馬体重"].str.split(r"\(", expand=True)
-        self.hr["体重"] = self.hr["馬体重"].str.split(r"\(", expand=True)[0]
-        self.hr["体重"] = pd.to_numeric(self.hr["体重"], errors="coerce")
-        keibajo_dict = {"函館":"01", "札幌":"02", "福島":"03", "新潟":"04", "東京":"05", "中山":"06", "中京":"07", "京都":"08", "阪神":"09", "小倉":"10"}
-        self.hr["競馬場"] = self.hr["開催"].map(lambda x: str(x)[1:3])
-        self.hr["競馬場"] = self.hr["競馬場"].map(keibajo_dict)
-        def corner(x, n):
-            if type(x) != str:
-                return x
-            elif n==1:
-                return int(re.findall(r'\d+', x)[0])
-        self.hr["first_corner"] = self.hr["通過"].map(lambda x: corner(x, 1))
-        
-        date_list = self.results["date"].unique()
+    @profiled(out="hr")
+    def p_p_hr(self, horse_results):
+        self.hr = self._run("hr", lambda horse_results: self.schema.apply(self._p_p_hr(horse_results), "hr"), horse_results)
+
+    @profiled(out="merged")
+    def merge(self, horse_results=None):
+        # horse_resultsを渡さなければ、p_p_hr済みのself.hrを使う
+        if horse_results is not None:
+            self.p_p_hr(horse_results)
+        self.merged = self._run("merged", lambda results, hr, by: self.schema.apply(self._asof_merge_all(results, hr), "merged"),
+                                self.results, self.hr, self.performance_by)
+
+    def _asof_merge_all(self, results, hr):
+        # 騎手・調教師の成績を足してから過去走を結合する（backendがあればそちらで一度に）
+        if self.backend is not None:
+            return self.backend.asof_merge(results, hr, self.performance_by)
+        return self.asof_merge(self.camp_stats(results, self.performance_indexes(hr, results)), hr)
+
+    def _p_p_hr(self, horse_results):
+        hr = horse_results.copy()
+        hr["date"] = pd.to_datetime(hr["日付"])
+        hr.drop(['日付'], axis=1, inplace=True)
+        hr["month"] = hr["date"].dt.month
+        hr["季節"] = hr["month"].map(MONTH_SEASON)
+        hr["着順"] = pd.to_numeric(hr["着順"], errors="coerce")
+        hr["実質着順"] = (1 - hr["着順"] / hr["頭数"])
+        with PROFILER.span("p_p_hr:parse", len(hr)):
+            # 距離・開催・馬体重・通過はstr.extractで1列ずつまとめて切り出す（要素ごとのmapはしない）。全部NaNの列でも.strが使えるようobjectにする
+            course = hr["距離"].astype(object).str.extract(DISTANCE_PATTERN)
+            hr["distance"] = course["distance"].astype(int)
+            hr["race_type"] = course["race_type"].map(RACE_TYPES)
+            hr["競馬場"] = hr["開催"].astype(object).str.extract(KAISAI_PATTERN)["競馬場"].map(KEIBAJO_CODES)
+            weight = hr["馬体重"].astype(object).str.extract(WEIGHT_PATTERN)
+            corners = hr["通過"].astype(object).str.extract(CORNER_PATTERN)
+            for col, values in pd.concat([weight, corners], axis=1).items():
+                hr[col] = pd.to_numeric(values)
+        return hr
+
+    @profiled()
+    def asof_merge(self, results, hr, indexes=None):
+        # 戦績の索引（HistoryIndex）から「その日より前の戦績」を二分探索で引く（日付ループ無し）
+        # 戦績はnetkeibaの並び（新しい順）を前提に、_1走前を直近のレースとする。indexesは作り置きの索引
+        results = results.loc[results["date"].notna()]
+        date_codes, _ = pd.factorize(results["date"], sort=False)
+        order = np.argsort(date_codes, kind="stable")
+        results = results.iloc[order]
+        date_codes = date_codes[order]
+        indexes = indexes if indexes is not None else self.history_indexes(hr)
+
+        merged = results.reset_index(drop=True)
+        ids, dates = self._horse_ids(merged), merged["date"].values
+
+        def take(values, pos, valid):
+            # 該当なしは-1にしてreindexでNaNにする（merge(how="left")と同じ型の崩れ方）
+            taken = values.reindex(np.where(valid, pos, -1))
+            taken.index = merged.index
+            return taken
+
+        with PROFILER.span("asof_merge:出走回数", len(merged)):
+            count = indexes["all"].count_before(ids, dates)
+            merged["出走回数"] = take(pd.Series(count), np.arange(len(merged)), count > 0)
+
+        with PROFILER.span("asof_merge:実績", len(merged)):
+            placed = indexes["placed"]
+            start, end = placed.before(ids, dates)
+            # 実績季節: 連対した季節のビットを馬ごとに累積OR
+            bits = self.season_bits(placed.frame["季節"])
+            flags = pd.DataFrame({b: (bits & b) != 0 for b in SEASON_BITS.values()}).groupby(placed.groups).cummax()
+            cum = pd.Series((flags.values * np.array(list(SEASON_BITS.values()))).sum(axis=1), dtype=np.uint8)
+            merged["実績季節"] = take(cum, end - 1, end > start).fillna(0).astype(np.uint8)
+            # 実績騎手: 今回の騎手で連対した回数（馬×騎手のキーで引くので、IDの部分一致は起きない）
+            merged["実績騎手"] = indexes["placed_jockey"].count_before((ids, merged["jockey_id"].values), dates)
+
+        with PROFILER.span("asof_merge:N走前", len(merged)):
+            for n, cols in LAG_COLS.items():
+                lagged = indexes["jra"].last_n(ids, dates, n, cols).add_suffix("_%d走前" % n)
+                lagged.index = merged.index
+                merged[lagged.columns] = lagged
+
+        merged["前々走距離変化"] = merged["distance_3走前"] - merged["distance_2走前"]
+        merged["前走距離変化"] = merged["distance_2走前"] - merged["distance_1走前"]
+        merged["今回距離変化"] = merged["distance_1走前"] - merged["course_len"]
+        merged["前々走間隔"] = merged["date_2走前"] - merged["date_3走前"]
+        merged["前走間隔"] = merged["date_1走前"] - merged["date_2走前"]
+        merged["今回間隔"] = merged["date"] - merged["date_1走前"]
+        # 旧実装（日付ごとのmergeをconcat）と同じく、indexは日付ごとに0から振る
+        merged.index = pd.Series(date_codes).groupby(date_codes).cumcount().values
+        return merged
+
+    @profiled()
+    def history_indexes(self, hr):
+        # asof_mergeが使う索引: 全戦績、JRAの戦績、JRAで連対した戦績（馬ごと・馬×騎手ごと）
+        hr = hr.loc[hr["date"].notna()]
+        keibajo_list = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10"]
+        jra = hr.loc[hr.競馬場.isin(keibajo_list)]
+        placed = jra.query('着順==1 or 着順==2')
+        return {"all": HistoryIndex(hr), "jra": HistoryIndex(jra), "placed": HistoryIndex(placed),
+                "placed_jockey": HistoryIndex(placed, keys=("horse_id", "jockey_id"))}
+
+    @profiled()
+    def performance_indexes(self, hr, results):
+        # 騎手の成績は戦績から、調教師の成績は（戦績に調教師が無いので）resultsから作る
+        indexes = {"騎手": PerformanceIndex(hr, "jockey_id", self.performance_by)}
+        if "trainer_id" in results.columns:
+            indexes["調教師"] = PerformanceIndex(results, "trainer_id", self.performance_by)
+        return indexes
+
+    def camp_stats(self, results, indexes):
+        # 各行の騎手・調教師の、その日より前の出走・勝利・連対（騎手_出走など）を足す
+        stats = [index.stats(results, prefix) for prefix, index in indexes.items()]
+        return pd.concat([results] + stats, axis=1) if stats else results
+
+    def _horse_ids(self, df):
+        if "horse_id" in df.columns:
+            return df["horse_id"].values
+        return df.index.get_level_values("horse_id").values
+
+    def season_bits(self, seasons):
+        return seasons.astype(object).map(SEASON_BITS).fillna(0).astype(np.uint8).values
+
+    @profiled()
+    def build_state(self):
+        # 差分更新用に、馬ごとの状態（出走回数・実績季節・直近3走）と馬×騎手の連対回数を全戦績から作る
+        self.state = {"horse": pd.DataFrame({"出走回数": pd.Series(dtype="int64"), "実績季節": pd.Series(dtype=np.uint8),
+                                             "last_date": pd.Series(dtype="datetime64[ns]")}),
+                      "jockey": pd.Series(dtype="int64", index=pd.MultiIndex.from_arrays([[], []], names=["horse_id", "jockey_id"])),
+                      "runs": pd.DataFrame(), "watermark": pd.NaT,
+                      "performance": self.performance_indexes(self.hr, self.results)}
+        self._fold(self.hr)
+
+    def save_state(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.state, f)
+
+    def load_state(self, path):
+        with open(path, "rb") as f:
+            self.state = pickle.load(f)
+
+    @profiled(out="merged")
+    def update(self, results, horse_results):
+        # 新しい開催分のresults/horse_resultsだけで状態を進め、新しいrace_idの特徴量だけをself.mergedに作る
+        results = self.schema.apply(self._p_p_results(results), "results")
+        self.hr = self.schema.apply(self._p_p_hr(horse_results), "hr") if len(horse_results) else pd.DataFrame({"date": pd.Series(dtype="datetime64[ns]")})
+        hr = self.hr.loc[self.hr["date"].notna()]
+        if (results["date"] <= self.state["watermark"]).any():
+            raise ValueError("取り込み済みの戦績（%s まで）より前の日付のresultsは差分更新できません" % self.state["watermark"])
+        # 騎手・調教師の成績は日付で引くので、新しい分を先にまとめて足してよい
+        performance = self.state.get("performance", {})
+        if "騎手" in performance and len(hr):
+            performance["騎手"].update(hr)
+        if "調教師" in performance:
+            performance["調教師"].update(results)
+        results = self.camp_stats(results, performance)
         merged_dict = {}
-        for date in tqdm(date_list):
-            filtered_hr = self.hr.query('date < @date')
-            filtered_results = self.results.query('date == @date')
-            merged_df = pd.merge(filtered_results, pd.DataFrame(filtered_hr.groupby("horse_id").size(), columns=["出走回数"]), on="horse_id", how="left")
-            keibajo_list = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10"]
-            filtered_hr = filtered_hr.loc[filtered_hr.競馬場.isin(keibajo_list)]
-            merged_df = pd.merge(merged_df, pd.DataFrame(filtered_hr.query('着順==1 or 着順==2')\
-                                                         .groupby("horse_id")["季節"].sum()).rename(columns={"季節":"実績季節"}), on="horse_id", how="left")
-            merged_df = pd.merge(merged_df, pd.DataFrame(filtered_hr.query('着順==1 or 着順==2')\
-                                                         .groupby("horse_id")["jockey_id"].sum()).rename(columns={"jockey_id":"実績騎手"}), on="horse_id", how="left")
-            merged_df = pd.merge(merged_df, filtered_hr.groupby("horse_id").nth(0)[["馬番","人気","体重","着順","着差","date","distance","first_corner","上り"]]\
-                                 .add_suffix("_1走前"), on="horse_id", how="left")
-            merged_df = pd.merge(merged_df, filtered_hr.groupby("horse_id").nth(1)[["実質着順","着順","着差","date","distance","上り"]].add_suffix("_2走前"),\
-                     on="horse_id", how="left") 
-            merged_df = pd.merge(merged_df, filtered_hr.groupby("horse_id").nth(2)[["実質着順","着差","date","distance","上り"]].add_suffix("_3走前"),\
-                     on="horse_id", how="left") 
-            merged_df["前々走距離変化"] = merged_df["distance_3走前"] - merged_df["distance_2走前"]
-            merged_df["前走距離変化"] = merged_df["distance_2走前"] - merged_df["distance_1走前"]
-            merged_df["今回距離変化"] = merged_df["distance_1走前"] - merged_df["course_len"]
-            merged_df["前々走間隔"] = merged_df["date_2走前"] - merged_df["date_3走前"]
-            merged_df["前走間隔"] = merged_df["date_1走前"] - merged_df["date_2走前"]
-            merged_df["今回間隔"] = merged_df["date"] - merged_df["date_1走前"]
-            merged_dict[date] = merged_df
-        self.merged = pd.concat([merged_dict[key] for key in merged_dict])
+        for date in np.sort(results["date"].dropna().unique()):
+            self._fold(hr.loc[hr["date"] < date])
+            hr = hr.loc[hr["date"] >= date]
+            merged_dict[date] = self._state_merge(results.loc[results["date"] == date])
+        self._fold(hr)
+        self.results = results
+        self.merged = self.schema.apply(pd.concat([merged_dict[date] for date in results["date"].dropna().unique()]), "merged")
+
+    @profiled()
+    def _fold(self, hr):
+        # 戦績を状態に取り込む。取り込み済みの行（その馬のlast_date以前）は飛ばす
+        if len(hr) == 0:
+            return
+        horse = self.state["horse"]
+        hr = hr.assign(horse_id=self._horse_ids(hr)).reset_index(drop=True)
+        last = horse["last_date"].reindex(hr["horse_id"]).values
+        hr = hr.loc[~(hr["date"].values <= last)]
+        if len(hr) == 0:
+            return
+
+        new = pd.DataFrame({"出走回数": hr.groupby("horse_id").size()})
+        keibajo_list = ["01", "02", "03", "04", "05", "06", "07", "08", "09", "10"]
+        jra = hr.loc[hr.競馬場.isin(keibajo_list)]
+        placed = jra.query('着順==1 or 着順==2')
+        old = horse.reindex(new.index)
+        new["出走回数"] = (new["出走回数"] + old["出走回数"].fillna(0)).astype("int64")
+        added = pd.Series(self.season_bits(placed["季節"]), index=placed["horse_id"]).groupby(level=0).agg(np.bitwise_or.reduce)
+        new["実績季節"] = added.reindex(new.index).fillna(0).astype(np.uint8) | old["実績季節"].fillna(0).astype(np.uint8)
+        pairs = placed.groupby(["horse_id", "jockey_id"]).size()
+        self.state["jockey"] = self.state["jockey"].add(pairs, fill_value=0).astype("int64")
+        new["last_date"] = hr.groupby("horse_id")["date"].max()
+        self.state["horse"] = pd.concat([horse.loc[~horse.index.isin(new.index)], new])
+
+        # 直近3走はJRAの戦績だけ持つ
+        runs = self.state["runs"]
+        if len(runs):
+            touched = runs["horse_id"].isin(new.index)
+            jra = pd.concat([runs.loc[touched], jra])
+            runs = runs.loc[~touched]
+        jra = jra.sort_values(["horse_id", "date"], kind="stable").groupby("horse_id").tail(3)
+        self.state["runs"] = pd.concat([runs, jra]).reset_index(drop=True) if len(runs) else jra.reset_index(drop=True)
+        self.state["watermark"] = max(hr["date"].max(), self.state["watermark"]) if pd.notna(self.state["watermark"]) else hr["date"].max()
+
+    @profiled()
+    def _state_merge(self, results, indexes=None):
+        # 直近3走はasof_mergeで引き、出走回数と実績は状態の集計値で上書きする
+        # 作り置きの索引が無ければ、今回出てくる馬の直近走だけで索引を作る（状態の全馬の分は作らない）
+        runs = self.state["runs"]
+        if indexes is None and len(runs):
+            runs = runs.loc[runs["horse_id"].isin(pd.unique(self._horse_ids(results)))]
+        merged = self.asof_merge(results, runs, indexes)
+        horse = self.state["horse"].reindex(merged["horse_id"].values)
+        horse.index = merged.index
+        merged["出走回数"] = horse["出走回数"].where(horse["出走回数"] > 0)
+        merged["実績季節"] = horse["実績季節"].fillna(0).astype(np.uint8)
+        pairs = pd.MultiIndex.from_arrays([merged["horse_id"], merged["jockey_id"]])
+        merged["実績騎手"] = self.state["jockey"].reindex(pairs).fillna(0).astype("int64").values
+        return merged
         
         
+class HistoryIndex:
+    # 戦績を（キー, 日付）で並べたCSR形式の索引。キーごとの行は offsets[g]:offsets[g + 1]、その中は日付順
+    # キーは既定でhorse_id（列でもindexでもよい）。("horse_id", "jockey_id")のように複数列も使える
+    def __init__(self, hr, keys=("horse_id",)):
+        hr = hr.loc[hr["date"].notna()]
+        values = [self._values(hr, key) for key in keys]
+        self.levels = [pd.Index(pd.unique(v)) for v in values]
+        self.dates = np.unique(hr["date"].values)
+        # グループ番号は実際にあるキーの組だけに振る（馬×騎手の全組み合わせ分のoffsetsは持たない）
+        self.combos = pd.Index(np.unique(self._combine(values)[0]))
+        self.n_groups = len(self.combos)
+        group = self._group(values)
+        key = group * (len(self.dates) + 1) + np.searchsorted(self.dates, hr["date"].values)
+        # 同じキー・同じ日付の行は元の並びの逆順にしておく（末尾側が元の先頭 = nth(0)）
+        order = np.lexsort((-np.arange(len(key)), key))
+        self.keys = key[order]
+        self.groups = group[order]
+        self.frame = hr.iloc[order].reset_index(drop=True)
+        self.offsets = np.searchsorted(self.keys, np.arange(self.n_groups + 1) * (len(self.dates) + 1))
+
+    def _values(self, df, key):
+        values = df[key] if key in df.columns else pd.Series(df.index.get_level_values(key))
+        # カテゴリの列は元の値で引く（フレームごとにカテゴリの並びが違っても同じキーになる）
+        return values.astype(object).values if isinstance(values.dtype, pd.CategoricalDtype) else values.values
+
+    def _combine(self, values):
+        # キーの組 → 各列のコードを混ぜた番号（どれかが索引に無ければfound=False）
+        code = np.zeros(len(values[0]), dtype=np.int64)
+        found = np.ones(len(values[0]), dtype=bool)
+        for level, v in zip(self.levels, values):
+            c = level.get_indexer(v)
+            found &= c >= 0
+            code = code * len(level) + c
+        return code[found], found
+
+    def _group(self, values):
+        # キーの組 → グループ番号（索引に無い組は-1）
+        code, found = self._combine(values)
+        group = np.full(len(found), -1, dtype=np.int64)
+        group[found] = self.combos.get_indexer(code)
+        return group
+
+    def before(self, keys, dates):
+        # 各クエリについて、同じキーの行のうち dates より前の行の [start, end) 位置
+        keys = list(keys) if isinstance(keys, tuple) else [keys]
+        group = self._group(keys)
+        d = np.searchsorted(self.dates, np.asarray(dates), side="left")
+        valid = group >= 0
+        end = np.searchsorted(self.keys, np.where(valid, group, 0) * (len(self.dates) + 1) + d, side="left")
+        start = self.offsets[np.where(valid, group, 0)]
+        return np.where(valid, start, 0), np.where(valid, end, 0)
+
+    def count_before(self, keys, dates):
+        start, end = self.before(keys, dates)
+        return end - start
+
+    def last_n(self, keys, dates, n, columns):
+        # dates より前のn走前の行（無ければNaN）。n=1が直近
+        start, end = self.before(keys, dates)
+        return self.frame[columns].reindex(np.where(end - n >= start, end - n, -1)).reset_index(drop=True)
+
+
+class PerformanceIndex:
+    # 騎手・調教師ごとの、その日より前の出走・勝利・連対の累計。HistoryIndexの並び（キー, 日付）の上で累積和を取っておき、
+    # [start, end) の差で引く。byで競馬場・race_typeごとにも分けられる。uniqueは同じ出走を二重に数えないためのキー（dateを含むこと）
+    # 差分更新では、新しい出走だけで索引（段）を作って後ろに足し、直前の段と大きさが近くなったら併合する。
+    # 段の数は対数個で、1回の更新の手間は取り込み済みの出走の数ではなく新しい出走の数で決まる
+    def __init__(self, runs, key, by=(), unique=("horse_id", "date")):
+        self.key, self.by, self.unique = key, tuple(by), tuple(unique)
+        self.columns = list(dict.fromkeys([key, *self.by, *self.unique, "date", "着順"]))
+        self.parts = []
+        self.update(runs)
+
+    def _dedupe(self, runs):
+        # 同じ出走が何度か来たら、着順のある行を優先し、その中では後から来た行を残す（後で訂正された結果を使う）
+        order = np.lexsort((np.arange(len(runs)), runs["着順"].notna().values))
+        runs = runs.iloc[order].drop_duplicates(list(self.unique), keep="last")
+        return runs.sort_values("date", kind="stable").reset_index(drop=True)
+
+    def _part(self, runs):
+        # runs: 日付順の出走 → 段（出走, 索引, 出走・勝利・連対の累積和）
+        index = HistoryIndex(runs, keys=(self.key,) + self.by)
+        chaku = index.frame["着順"].values
+        cum = {name: np.r_[0, np.cumsum(cond, dtype=np.int64)]
+               for name, cond in [("出走", np.ones(len(chaku), dtype=bool)), ("勝利", chaku == 1), ("連対", chaku <= 2)]}
+        return {"runs": runs, "index": index, "cum": cum}
+
+    def stats(self, df, prefix):
+        # dfの各行（キー, by, date）について、その日より前の累計を「prefix_出走」等の列で返す（段ごとの累計の和）
+        out = {name: np.zeros(len(df), dtype=np.int64) for name in ("出走", "勝利", "連対")}
+        for part in self.parts:
+            index = part["index"]
+            start, end = index.before(tuple(index._values(df, c) for c in (self.key,) + self.by), df["date"].values)
+            for name, cum in part["cum"].items():
+                out[name] += cum[end] - cum[start]
+        return pd.DataFrame({prefix + "_" + name: values for name, values in out.items()}, index=df.index)
+
+    def update(self, runs):
+        # 新しい出走を段にして足す。取り込み済みの出走と同じuniqueのキーの行（結果の訂正など）は、古い段から抜いて新しい段で数え直す
+        runs = (runs if "horse_id" in runs.columns else runs.reset_index()).reset_index(drop=True)
+        new = self._dedupe(runs.loc[runs["date"].notna() & runs[self.key].notna(), self.columns])
+        if not len(new):
+            return
+        keys = pd.MultiIndex.from_frame(new[list(self.unique)])
+        moved = []
+        for i, part in enumerate(self.parts):
+            # uniqueにdateが入っているので、重なるのは新しい出走の最初の日付以降の行だけ
+            old = part["runs"]
+            tail = old.iloc[np.searchsorted(old["date"].values, new["date"].values[0], side="left"):]
+            hit = pd.MultiIndex.from_frame(tail[list(self.unique)]).isin(keys) if len(tail) else np.zeros(0, dtype=bool)
+            if hit.any():
+                moved.append(tail.loc[hit])
+                self.parts[i] = self._part(old.drop(tail.index[hit]).reset_index(drop=True))
+        if moved:
+            new = self._dedupe(pd.concat(moved + [new]))
+        self.parts = [part for part in self.parts if len(part["runs"])]
+        self.parts.append(self._part(new))
+        while len(self.parts) > 1 and len(self.parts[-2]["runs"]) <= 2 * len(self.parts[-1]["runs"]):
+            last = self.parts.pop()
+            runs = pd.concat([self.parts.pop()["runs"], last["runs"]]).sort_values("date", kind="stable").reset_index(drop=True)
+            self.parts.append(self._part(runs))
+
+
+# 小系統の判定ルール（列名, 1代〜5代のどれかにマッチしたら1になる正規表現）。世代で違うものは1代〜5代のリスト
+LINEAGE_RULES = [
+    ("マイバブー系", "メジロマックイーン|トウカイテイオー"),
+    ("ウォーニング系", "Warning"),
+    ("リローンチ系", "Relaunch"),
+    ("スターリング系", "Monsun"),
+    ("米国マイナー系", "Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush"),
+    ("リボー系", "Graustark|His Majesty|Tom Rolfe|Ribot"),
+    ("ハンプトン系", "Dictus|Surumu|Forli|Star Kingdom"),
+    ("ニジンスキー系", "Nijinsky"),
+    ("欧州ND系", "Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis"),
+    ("サドラー系", "Sadler's Wells"),
+    ("欧州ダンチヒ系", "Green Desert|Danehill"),
+    ("米国ダンチヒ系", "Chief's Crown|Chief Bearhart|Hard Spun"),
+    ("ヴァイスリージェント系", "Vice Regent|Deputy Minister"),
+    ("ストームバード系", "Storm Bird|Storm Cat"),
+    ("ノーザンテースト系", "ノーザンテースト"),
+    ("ヘイロー系", "Devil|Glorious Song|サザンヘイロー"),
+    ("ロベルト系", "Roberto"),
+    ("サーゲイロード系", "Habitat|Sir Tristram"),
+    ("米国ネイティヴ系", "Kauai King|Majestic Prince|Affirmed|Alydar"),
+    ("欧州ネイティヴ系", "Atan|Sharpen Up|Sea-Bird"),
+    ("キングマンボ系", ["Kingmambo|Miswaki", "Kingmambo", "Kingmambo", "Kingmambo", "Kingmambo"]),
+    ("49er系", "サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest"),
+    ("ダーレー系", "アドマイヤムーン"),
+    ("ファピアノ系", "Fappiano"),
+    ("その他ミスプロ系", "Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran"),
+    ("グレイソヴリン系", "シービークロス|Cozzene|Tony Bin|Caro"),
+    ("プリンスリーギフト系", "サクラユタカオー"),
+    ("ボールドルーラー系", "ロイヤルスキー|Seattle Slew"),
+    ("レッドゴッド系", "Blushing Groom"),
+    ("ネヴァーベンド系", "Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman"),
+    ("ディープ系", "ディープインパクト"),
+    ("Tサンデー系", "ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ"),
+    ("Pサンデー系", ["フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン", "フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン", "フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン", "フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン", "フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ"]),
+    ("Dサンデー系", "ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ"),
+    ("大系統サンデー", "サンデーサイレンス"),
+]
+# 祖先名の末尾の「 生年 毛色」（ディープインパクト 2002 鹿毛 → ディープインパクト）。系統のメモはこれを落とした名前で引く
+ANCESTOR_SUFFIX = re.compile(r"\s*\d{4}(\s.*)?$")
+# 大系統と国系統型（どれかの系統が1なら1）。上から順に作るので、後の行は前の行を使える
+LINEAGE_GROUPS = [
+    ("大系統ナスルーラ", ["グレイソヴリン系", "プリンスリーギフト系", "ボールドルーラー系", "レッドゴッド系", "ネヴァーベンド系"]),
+    ("大系統ミスプロ", ["キングマンボ系", "49er系", "ダーレー系", "ファピアノ系", "その他ミスプロ系"]),
+    ("大系統ターントゥ", ["ヘイロー系", "ロベルト系", "サーゲイロード系"]),
+    ("大系統米国ND", ["米国ダンチヒ系", "ヴァイスリージェント系", "ストームバード系"]),
+    ("大系統欧州ND", ["ニジンスキー系", "欧州ND系", "サドラー系", "欧州ダンチヒ系"]),
+    ("日本型", ["プリンスリーギフト系", "ダーレー系", "大系統サンデー", "ノーザンテースト系"]),
+    ("米国型", ["リローンチ系", "米国マイナー系", "大系統米国ND", "ヘイロー系", "米国ネイティヴ系", "49er系", "ファピアノ系", "その他ミスプロ系", "ボールドルーラー系"]),
+    ("欧州型", ["マイバブー系", "ウォーニング系", "スターリング系", "リボー系", "ハンプトン系", "大系統欧州ND", "ロベルト系", "サーゲイロード系", "欧州ネイティヴ系", "キングマンボ系", "グレイソヴリン系", "レッドゴッド系", "ネヴァーベンド系"]),
+]
+
+
+# コース区分（芝・ダートの得意コースのまとまり）。血統ポイントのルールからは区分名で参照する
+COURSE_CLASSES = {
+    "turf_a": ["06芝1600", "05芝1600", "08芝1600", "05芝1400", "09芝1600", "09芝1800", "05芝1800", "06芝1200", "08芝1800", "03芝1200",
+              "09芝2000", "06芝2000", "06芝1800", "09芝1400", "08芝1400", "05芝2000", "04芝1000", "07芝1600", "09芝1200", "10芝1200",
+              "08芝1200", "07芝1200"],
+    "turf_b": ["10芝1200", "03芝1200", "02芝1200", "10芝1800", "10芝2000", "08芝2000", "07芝2000", "01芝1200", "06芝2000", "08芝1600",
+              "03芝2000", "03芝1800", "04芝1000", "09芝2000", "06芝1600", "09芝1400", "06芝1800", "09芝1600", "09芝1800", "06芝1200"],
+    "turf_c": ["10芝2000", "08芝2000", "03芝2000", "05芝2400", "01芝2000", "10芝1800", "03芝2600", "10芝2600", "06芝2000", "09芝2000",
+              "09芝2400", "02芝2000", "07芝2200", "04芝1800", "04芝2000", "02芝1800", "08芝1800", "03芝1800", "06芝2200", "05芝2000",
+              "07芝2000", "04芝2400", "08芝2400", "04芝2200", "02芝2600", "01芝2600", "08芝2200", "09芝2200"],
+    "turf_d": ["05芝1600", "05芝1800", "06芝1600", "05芝1400", "10芝1200", "05芝2000", "09芝1600", "06芝2000", "05芝2400", "03芝1200",
+              "07芝2000", "04芝1800", "09芝1800", "08芝1600", "04芝2000", "08芝1800", "07芝1400", "04芝1600", "08芝1400", "02芝1200"],
+    "dart_a": ["06ダート1200", "08ダート1200", "09ダート1400", "09ダート1200", "04ダート1200", "05ダート1600", "08ダート1800", "05ダート1400", "08ダート1400", "09ダート1800",
+              "06ダート1800", "07ダート1400", "07ダート1200", "03ダート1150", "10ダート1000", "10ダート1700", "05ダート1300", "01ダート1000"],
+    "dart_b": ["06ダート1800", "09ダート1800", "08ダート1800", "04ダート1800", "03ダート1700", "05ダート1600", "06ダート1200", "07ダート1800", "10ダート1700", "02ダート1700",
+              "01ダート1700", "09ダート1400", "04ダート1200", "05ダート1400", "08ダート1400", "03ダート1150"],
+    "dart_c": ["06ダート1800", "09ダート1800", "04ダート1800", "05ダート1600", "08ダート1800", "05ダート2100", "03ダート1700", "07ダート1800", "10ダート1700", "02ダート1700",
+              "01ダート1700", "05ダート1400", "06ダート1200", "09ダート1400", "06ダート2400", "07ダート1900", "09ダート2000"],
+    "dart_d": ["05ダート1400", "05ダート1600", "09ダート1800", "06ダート1200", "06ダート1800", "08ダート1800", "09ダート1400", "08ダート1400", "05ダート2100", "07ダート1800",
+              "07ダート1400", "04ダート1800", "08ダート1200", "10ダート1700", "08ダート1900"],
+}
+# 父×性別×コースの血統ポイント（父, [(性別, コース)...]のどれかに当てはまれば, 加点）
+# 父・性別のNoneは条件なし。コースは区分名（turf_a等）、"芝"/"ダート"、コース名（"05芝1600"）を並べる
+BLOOD_RULES = [
+    ("ディープインパクト ", [(None, ["05芝1600", "05芝1800"]), ("牝", ["turf_a"])], 1),
+    ("ディープインパクト ", [(None, ["turf_a", "turf_c", "turf_d"])], 1),
+    ("ディープインパクト ", [(None, ["turf_b"]), ("牝", ["turf_c"])], -1),
+    ("ハーツクライ ", [("牡", ["turf_c"]), ("牝", ["turf_d"])], 1),
+    ("ハーツクライ ", [(None, ["turf_a", "turf_c", "turf_d"])], 1),
+    ("ハーツクライ ", [("牝", ["turf_b"])], -1),
+    ("ハーツクライ ", [("牡", ["dart_b", "dart_c", "dart_d"])], 1),
+    ("ダイワメジャー ", [(None, ["turf_a"])], 2),
+    ("ダイワメジャー ", [("牡", ["turf_d"])], 1),
+    ("ダイワメジャー ", [(None, ["turf_b", "turf_c"])], -1),
+    ("ダイワメジャー ", [("牡", ["dart_a"])], 1),
+    ("ハービンジャー Harbinger(英) ", [(None, ["turf_c", "turf_d"])], 2),
+    ("ハービンジャー Harbinger(英) ", [("牡", ["turf_b"])], 1),
+    ("ハービンジャー Harbinger(英) ", [(None, ["turf_a"])], -1),
+    ("ルーラーシップ ", [("牡", ["turf_c"]), ("牝", ["turf_b"])], 2),
+    ("ルーラーシップ ", [("牡", ["turf_b"]), ("牝", ["turf_c"])], 1),
+    ("ルーラーシップ ", [(None, ["turf_a", "turf_d"])], -1),
+    ("ルーラーシップ ", [("牡", ["dart_c"])], 1),
+    ("ロードカナロア ", [(None, ["turf_a"])], 2),
+    ("ロードカナロア ", [("牡", ["turf_b"])], 1),
+    ("ロードカナロア ", [(None, ["turf_c", "turf_d"])], -1),
+    ("ロードカナロア ", [(None, ["dart_a", "dart_b"])], 1),
+    ("ステイゴールド ", [("牡", ["turf_a", "turf_d"])], 2),
+    ("ステイゴールド ", [("牝", ["turf_d"]), (None, ["turf_c"])], 1),
+    ("ステイゴールド ", [(None, ["turf_b"])], -1),
+    ("キングカメハメハ ", [("牡", ["turf_a"]), ("牝", ["turf_d"])], 2),
+    ("キングカメハメハ ", [("牡", ["turf_d"]), ("牝", ["turf_a"])], 1),
+    ("キングカメハメハ ", [(None, ["turf_b"])], -1),
+    ("キングカメハメハ ", [("牡", ["ダート"])], 1),
+    ("オルフェーヴル ", [("牡", ["turf_c"])], 2),
+    ("オルフェーヴル ", [("牝", ["turf_c"])], 1),
+    ("オルフェーヴル ", [(None, ["turf_a"])], -1),
+    ("オルフェーヴル ", [(None, ["dart_c"])], 1),
+    ("ヴィクトワールピサ ", [("牝", ["turf_c", "turf_d"])], 1),
+    ("キンシャサノキセキ ", [("牡", ["turf_a"])], 2),
+    ("キンシャサノキセキ ", [("牡", ["turf_b"]), ("牝", ["turf_a", "turf_d"])], 1),
+    ("キンシャサノキセキ ", [("牡", ["dart_a", "dart_d"])], 1),
+    ("マンハッタンカフェ ", [(None, ["turf_a", "turf_d"])], 1),
+    ("ディープブリランテ ", [("牡", ["turf_d"]), ("牝", ["turf_b"])], 1),
+    ("スクリーンヒーロー ", [("牡", ["turf_b", "turf_c"]), ("牝", ["turf_a"])], 1),
+    ("ブラックタイド ", [("牡", ["turf_b"]), ("牝", ["turf_d"])], 1),
+    ("ノヴェリスト Novellist(愛) ", [("牡", ["turf_a", "turf_c"]), ("牝", ["turf_b"])], 1),
+    ("エイシンフラッシュ ", [("牡", ["turf_b", "turf_c"])], 1),
+    ("キズナ ", [("牝", ["turf_b"])], 2),
+    ("キズナ ", [("牡", ["turf_b", "ダート"])], 1),
+    ("アドマイヤムーン ", [("牡", ["turf_a", "turf_d"])], 1),
+    ("ジャスタウェイ ", [("牡", ["turf_c"])], 1),
+    ("エピファネイア ", [("牝", ["turf_b", "turf_c"])], 2),
+    ("エピファネイア ", [("牡", ["turf_b", "turf_c"])], 1),
+    ("ドリームジャーニー ", [("牡", ["turf_c", "turf_d"])], 1),
+    ("ジャングルポケット ", [("牡", ["turf_a", "turf_d"])], 1),
+    ("メイショウサムソン ", [(None, ["turf_d"])], 1),
+    ("ワークフォース Workforce(英) ", [(None, ["turf_c"])], 1),
+    ("マツリダゴッホ ", [("牝", ["turf_a"])], 2),
+    ("マツリダゴッホ ", [("牡", ["turf_b", "turf_d"]), ("牝", ["turf_b"])], 1),
+    ("ゴールドアリュール ", [("牡", ["ダート"])], 2),
+    ("ゴールドアリュール ", [("牝", ["ダート"])], 1),
+    ("クロフネ ", [("牝", ["ダート"])], 2),
+    ("クロフネ ", [("牡", ["ダート"])], 1),
+    ("サウスヴィグラス ", [(None, ["dart_a"])], 2),
+    ("ヘニーヒューズ Henny Hughes(米) ", [(None, ["dart_a", "dart_d"])], 2),
+    ("エンパイアメーカー Empire Maker(米) ", [(None, ["ダート"])], 1),
+    ("アイルハヴアナザー I'll Have Another(米) ", [(None, ["dart_c"])], 1),
+    ("シニスターミニスター Sinister Minister(米) ", [("牡", ["ダート"])], 1),
+    ("ネオユニヴァース ", [("牡", ["dart_c", "dart_d"])], 1),
+    ("シンボリクリスエス ", [("牡", ["dart_c", "dart_d"])], 1),
+    ("メイショウボーラー ", [("牡", ["dart_a"])], 1),
+    ("カネヒキリ ", [(None, ["dart_a", "dart_d"])], 1),
+    ("パイロ Pyro(米) ", [(None, ["dart_a", "dart_d"])], 1),
+    ("スマートファルコン ", [(None, ["dart_c"])], 1),
+    ("ドゥラメンテ ", [(None, ["turf_a", "turf_d"])], 2),
+    ("ドゥラメンテ ", [(None, ["turf_b"])], -1),
+    ("ドゥラメンテ ", [("牡", ["ダート"])], 1),
+    ("モーリス ", [("牡", ["turf_b", "turf_c"]), ("牝", ["turf_a"])], 2),
+    ("モーリス ", [(None, ["turf_d"])], -1),
+    ("ダノンレジェンド ", [(None, ["dart_a", "dart_b"])], 2),
+    (None, [("牝", ["turf_c"])], -1),
+    (None, [("牝", ["dart_d"])], -1),
+]
+# 血統の位置（列名の接頭辞, 生データの行, 祖先名を取る世代。Noneは名前を取らない）
+PEDS_POSITIONS = [("父", 0, "1代"), ("母父", 2, "2代"), ("父母父", 1, None), ("母母父", 3, "3代")]
+# 位置ごとに作る系統フラグ。ここに無い系統は判定しない（大系統・型が使う小系統は自動で判定する）
+PEDS_FEATURES = {
+    "父": ["ニジンスキー系", "サドラー系", "欧州ダンチヒ系", "米国ダンチヒ系", "キングマンボ系", "ディープ系", "Tサンデー系", "Pサンデー系", "Dサンデー系",
+          "大系統サンデー", "大系統ナスルーラ", "大系統ミスプロ", "大系統ターントゥ", "大系統米国ND", "大系統欧州ND", "日本型", "米国型", "欧州型"],
+    "母父": ["ニジンスキー系", "サドラー系", "欧州ダンチヒ系", "米国ダンチヒ系", "キングマンボ系", "ディープ系", "Tサンデー系", "Pサンデー系", "Dサンデー系",
+           "大系統サンデー", "大系統ナスルーラ", "大系統ミスプロ", "大系統ターントゥ", "大系統米国ND", "大系統欧州ND", "日本型", "米国型", "欧州型"],
+    "父母父": ["大系統サンデー"],
+    "母母父": ["大系統サンデー", "日本型", "米国型", "欧州型"],
+}
+# 位置をまたいだ血統フラグ（列名, [[全部1の列], ...]のどれかを満たせば1, Trueなら反転）。使う列が全部あるものだけ作る
+PEDIGREE_COMBOS = [
+    ("非サンデー馬", [["父_大系統サンデー"], ["母父_大系統サンデー"], ["父母父_大系統サンデー"], ["母母父_大系統サンデー"]], True),
+    ("サンデー_米国", [["父_大系統サンデー", "母父_米国型"], ["母父_大系統サンデー", "父_米国型"]], False),
+    ("米国B", [["父_米国型", "母父_米国型"], ["父_米国型", "母母父_米国型"]], False),
+    ("米国A", [["父_米国型", "母父_米国型", "母母父_米国型"]], False),
+    ("父_母父_ディープ", [["父_ディープ系"], ["母父_ディープ系"]], False),
+    ("父_母父_キングマンボ系", [["父_キングマンボ系"], ["母父_キングマンボ系"]], False),
+    ("欧州A", [["父_欧州型", "母父_欧州型", "母母父_欧州型"]], False),
+    ("欧州B", [["母父_欧州型", "母母父_欧州型"], ["父_欧州型", "母母父_欧州型"], ["父_欧州型", "母父_欧州型"]], False),
+]
+# 血統フラグ×コースの血統ポイント（どれかが"1"の列, 全部"1"の列, コース, 加点）
+PEDIGREE_RULES = [
+    (["母父_米国型", "母母父_米国型", "非サンデー馬"], [], ["turf_a"], 1),
+    (["父_米国型", "父_欧州型", "非サンデー馬", "母父_日本型"], [], ["turf_b"], 1),
+    (["欧州A", "欧州B"], [], ["turf_c"], 1),
+    (["母父_欧州型", "母母父_欧州型"], ["父_日本型"], ["turf_d"], 1),
+    (["米国A", "米国B", "非サンデー馬"], [], ["dart_a"], 1),
+    (["欧州A", "父_母父_ディープ"], [], ["dart_a"], -1),
+    (["父_母父_ディープ", "父_母父_キングマンボ系", "母父_大系統ナスルーラ"], [], ["dart_b"], 1),
+    (["父_日本型", "父_欧州型", "母父_ニジンスキー系"], [], ["dart_c"], 1),
+    (["欧州B", "父_大系統ナスルーラ", "父_サドラー系"], [], ["dart_d"], 1),
+]
+
+
+def pedigree_rules(columns):
+    # PEDIGREE_RULESのうち、作った血統フラグ（columns）で評価できるもの。作っていないフラグは0とみなすので、
+    # 全部"1"の列が欠けたルールと、どれかが"1"の列が全部欠けたルールは0点（並べない）
+    for any_flags, all_flags, courses, delta in PEDIGREE_RULES:
+        any_flags = [f for f in any_flags if f in columns]
+        if any_flags and all(f in columns for f in all_flags):
+            yield any_flags, all_flags, courses, delta
+# 馬番×コースの枠順ポイント（馬番の下限, 上限, コース, 加点）。Noneは上限/下限なし
+GATE_RULES = [
+    (None, 4, ["01ダート1700", "02ダート1700", "05ダート1300", "05ダート1600", "07ダート1200", "07ダート1800"], 1),
+    (5, 9, ["02ダート1700", "05ダート1300", "07ダート1800"], 1),
+    (10, 14, ["05ダート1400", "05ダート2100", "07ダート1200"], 1),
+    (15, None, ["05ダート2100", "09ダート1200", "09ダート1400"], 1),
+    (None, 4, ["03ダート1150", "03ダート1700", "04ダート1200", "05ダート2100", "07ダート1400", "08ダート1200", "08ダート1400", "08ダート1800", "09ダート1200", "09ダート1400",
+                  "10ダート1000", "10ダート1700"], -1),
+    (10, 14, ["04ダート1800", "07ダート1800", "10ダート1000"], -1),
+    (15, None, ["05ダート1600", "06ダート1800", "07ダート1200", "07ダート1800", "10ダート1700"], -1),
+]
+# 父のペース適性（Peds.mergeで距離の短縮・延長、休み明けに合わせて加減点する）。
+# down: 距離短縮・休み明けで加点、延長で減点。up: 距離延長で加点、短縮・休み明けで減点
+PACE_SIRES = {
+    "down": ["ディープインパクト ", "エピファネイア ", "ルーラーシップ ", "パイロ Pyro(米) ", "トゥザグローリー ",
+             "ノヴェリスト Novellist(愛) ", "ヨハネスブルグ Johannesburg(米) ", "ハービンジャー Harbinger(英) ",
+             "ネオユニヴァース ", "ワールドエース ", "ジャスタウェイ "],
+    "up": ["キングカメハメハ ", "ロードカナロア ", "ドゥラメンテ ", "サウスヴィグラス ", "カジノドライヴ ",
+           "アイルハヴアナザー I'll Have Another(米) ", "エンパイアメーカー Empire Maker(米) ", "ベルシャザール ",
+           "エスケンデレヤ ", "タートルボウル Turtle Bowl(愛) ", "スクリーンヒーロー ", "モーリス "],
+}
+
+
+# 血統の生データ（1頭4行×5列、indexがhorse_id）。ファイルのリストかディレクトリを渡す
+PEDS_PATHS = ["D:/jplb_workspace/peds_raw.pickle", "D:/jplb_workspace/peds_raw_20.pickle"]
+PEDS_EXTENSIONS = (".pickle", ".pkl", ".parquet", ".feather")
+# parquet/featherでhorse_idが入っている列（pandasのindexを書いたもの・reset_index()したものも読む）
+PEDS_ID_COLUMNS = ("horse_id", "__index_level_0__", "index")
+
+
 class Peds:
-    def __init__(self):
+    def __init__(self, paths=PEDS_PATHS, columns=(0, 1, 2, 3, 4), chunk_size=10000, cache=None, features=PEDS_FEATURES, backend=None):
+        # 生データは読み込まず、p_pでchunk_size頭ずつ読んで分類する。featuresは位置ごとに作る系統フラグ（PEDS_FEATURESの形）
+        # backend: 系統の文字列判定・ルールの点数・標準化を別の実装（PolarsBackendなど）で回すとき
         self.df = pd.DataFrame()
         self.merged_df = pd.DataFrame()
-        peds = pd.read_pickle('D:/jplb_workspace/peds_raw.pickle')
-        peds_20 = pd.read_pickle('D:/jplb_workspace/peds_raw_20.pickle')
-        self.peds = pd.concat([peds, peds_20])
-        #self.peds = peds.copy()
-        peds_copy = self.peds.copy()
+        self.peds = None
+        self.paths = paths
+        self.columns = columns
+        self.chunk_size = chunk_size
+        self.cache = cache
+        self.features = features
+        self.backend = backend
+        self.schema = Schema()
+        self.rule_memo = None
+        # 系統の判定結果（(系統, パターン) → {祖先名: 当たった世代のビット}）。チャンク・4つの位置・実行をまたいで使い回す
+        self.lineage_memo = {}
+        self.memo_stats = {}
         self.pointed = pd.DataFrame()
+
+    def read_peds(self, paths, columns=None):
+        # ファイルごとに生データを返す。parquetは行グループ単位、featherはレコードバッチ単位で読むので、ファイル全体をメモリに載せない
+        for path in self._peds_files(paths):
+            ext = os.path.splitext(path)[1].lower()
+            if ext == ".parquet":
+                import pyarrow.parquet as pq
+                f = pq.ParquetFile(path)
+                index_cols = [c for c in f.schema_arrow.names if c in PEDS_ID_COLUMNS]
+                cols = None if columns is None else [str(c) for c in columns] + index_cols
+                for batch in f.iter_batches(batch_size=4 * self.chunk_size, columns=cols):
+                    yield self._raw_frame(batch.to_pandas())
+            elif ext == ".feather":
+                import pyarrow as pa
+                with pa.memory_map(path) as source:
+                    reader = pa.ipc.open_file(source)
+                    index_cols = [c for c in reader.schema.names if c in PEDS_ID_COLUMNS]
+                    cols = None if columns is None else [str(c) for c in columns] + index_cols
+                    for i in range(reader.num_record_batches):
+                        batch = reader.get_batch(i)
+                        yield self._raw_frame((batch if cols is None else batch.select(cols)).to_pandas())
+            else:
+                peds = pd.read_pickle(path)
+                yield peds if columns is None else peds[list(columns)]
+
+    def _peds_files(self, paths):
+        if isinstance(paths, str):
+            paths = [paths]
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files += sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith(PEDS_EXTENSIONS))
+            else:
+                files.append(path)
+        return files
+
+    def _raw_frame(self, peds):
+        # parquet/featherの列名は文字列なので、世代の列を0〜4に戻してhorse_idをindexにする
+        for col in PEDS_ID_COLUMNS:
+            if col in peds.columns:
+                peds = peds.set_index(col)
+        peds.index.name = None
+        peds.columns = [int(c) if str(c).isdigit() else c for c in peds.columns]
+        return peds
+
+    def _horse_chunks(self, frames, chunk_size):
+        # 馬の切れ目でchunk_size頭ずつに分ける。chunk_size頭に満たない残り（ファイルやバッチの末尾で切れた馬を含む）は
+        # 次の読み込み分とつなげるので、バッチが小さくても細かいchunkにはならない
+        carry = None
+        for peds in frames:
+            if carry is not None:
+                peds = pd.concat([carry, peds])
+            if len(peds) == 0:
+                continue
+            ids = peds.index.values
+            starts = np.flatnonzero(np.r_[True, ids[1:] != ids[:-1]])
+            # 最後の馬は次のバッチに続いているかもしれないので、それより前の馬だけをchunk_size頭ずつ出す
+            full = (len(starts) - 1) // chunk_size * chunk_size
+            for i in range(0, full, chunk_size):
+                yield peds.iloc[starts[i]:starts[i + chunk_size]]
+            carry = peds.iloc[starts[full]:]
+        if carry is not None:
+            yield carry
+
+    def iter_p_p(self):
+        # 分類済みの血統をchunkごとに返す
+        frames = [self.peds] if self.peds is not None else self.read_peds(self.paths, self.columns)
+        for peds in progress(self._horse_chunks(frames, self.chunk_size), desc="peds"):
+            yield self._p_p(peds)
         
-    def p_p_1(self, peds_copy):     
-        
+    @profiled()
+    def p_p_1(self, peds_copy, flags=None):
+        # flags: 作る系統フラグ（Noneなら全部）。判定するのは、そのフラグと大系統・型が使う系統だけ
         peds_copy = peds_copy.rename(columns={0:"1代", 1:"2代", 2:"3代", 3:"4代", 4:"5代"})
+        needed = self._lineage_needs(flags)
+        rules = [(name, patterns) for name, patterns in LINEAGE_RULES if name in needed]
 
-        #小系統の分類をひとつずづ列作っていきます。実質的な小系統ワンホット。
-        peds_copy["マイバブー系"] = ((peds_copy["1代"].str.contains("メジロマックイーン|トウカイテイオー")) | (peds_copy["2代"].str.contains("メジロマックイーン|トウカイテイオー")) | (peds_copy["3代"].str.contains("メジロマックイーン|トウカイテイオー")) | (peds_copy["4代"].str.contains("メジロマックイーン|トウカイテイオー")) | (peds_copy["5代"].str.contains("メジロマックイーン|トウカイテイオー"))).astype(int)
-        peds_copy["マイバブー系"] = peds_copy["マイバブー系"].astype(str)
-        peds_copy["ウォーニング系"] = ((peds_copy["1代"].str.contains("Warning")) | (peds_copy["2代"].str.contains("Warning")) | (peds_copy["3代"].str.contains("Warning")) | (peds_copy["4代"].str.contains("Warning")) | (peds_copy["5代"].str.contains("Warning"))).astype(int)
-        peds_copy["ウォーニング系"] = peds_copy["ウォーニング系"].astype(str)
-        peds_copy["リローンチ系"] = ((peds_copy["1代"].str.contains("Relaunch")) | (peds_copy["2代"].str.contains("Relaunch")) | (peds_copy["3代"].str.contains("Relaunch")) | (peds_copy["4代"].str.contains("Relaunch")) | (peds_copy["5代"].str.contains("Relaunch"))).astype(int)
-        peds_copy["リローンチ系"] = peds_copy["リローンチ系"].astype(str)
-        peds_copy["スターリング系"] = ((peds_copy["1代"].str.contains("Monsun")) | (peds_copy["2代"].str.contains("Monsun")) | (peds_copy["3代"].str.contains("Monsun")) | (peds_copy["4代"].str.contains("Monsun")) | (peds_copy["5代"].str.contains("Monsun"))).astype(int)
-        peds_copy["スターリング系"] = peds_copy["スターリング系"].astype(str)
-        peds_copy["米国マイナー系"] = ((peds_copy["1代"].str.contains("Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush")) | (peds_copy["2代"].str.contains("Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush")) | (peds_copy["3代"].str.contains("Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush")) | (peds_copy["4代"].str.contains("Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush")) | (peds_copy["5代"].str.contains("Damascus|Icecapade|Wild Again|Holy Bull|Broad Brush"))).astype(int)
-        peds_copy["米国マイナー系"] = peds_copy["米国マイナー系"].astype(str)
-        peds_copy["リボー系"] = ((peds_copy["1代"].str.contains("Graustark|His Majesty|Tom Rolfe|Ribot")) | (peds_copy["2代"].str.contains("Graustark|His Majesty|Tom Rolfe|Ribot")) | (peds_copy["3代"].str.contains("Graustark|His Majesty|Tom Rolfe|Ribot")) | (peds_copy["4代"].str.contains("Graustark|His Majesty|Tom Rolfe|Ribot")) | (peds_copy["5代"].str.contains("Graustark|His Majesty|Tom Rolfe|Ribot"))).astype(int)
-        peds_copy["リボー系"] = peds_copy["リボー系"].astype(str)
-        peds_copy["ハンプトン系"] = ((peds_copy["1代"].str.contains("Dictus|Surumu|Forli|Star Kingdom")) | (peds_copy["2代"].str.contains("Dictus|Surumu|Forli|Star Kingdom")) | (peds_copy["3代"].str.contains("Dictus|Surumu|Forli|Star Kingdom")) | (peds_copy["4代"].str.contains("Dictus|Surumu|Forli|Star Kingdom")) | (peds_copy["5代"].str.contains("Dictus|Surumu|Forli|Star Kingdom"))).astype(int)
-        peds_copy["ハンプトン系"] = peds_copy["ハンプトン系"].astype(str)
-        peds_copy["ニジンスキー系"] = ((peds_copy["1代"].str.contains("Nijinsky")) | (peds_copy["2代"].str.contains("Nijinsky")) | (peds_copy["3代"].str.contains("Nijinsky")) | (peds_copy["4代"].str.contains("Nijinsky")) | (peds_copy["5代"].str.contains("Nijinsky"))).astype(int)
-        peds_copy["ニジンスキー系"] = peds_copy["ニジンスキー系"].astype(str)
-        peds_copy["欧州ND系"] = ((peds_copy["1代"].str.contains("Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis")) | (peds_copy["2代"].str.contains("Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis")) | (peds_copy["3代"].str.contains("Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis")) | (peds_copy["4代"].str.contains("Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis")) | (peds_copy["5代"].str.contains("Lyphard|Dancing Brave|ホワイトマズル|キングヘイロー|Nureyev|Pivotal|Last Tycoon|Fairy King|Assatis"))).astype(int)
-        peds_copy["欧州ND系"] = peds_copy["欧州ND系"].astype(str)
-        peds_copy["サドラー系"] = ((peds_copy["1代"].str.contains("Sadler's Wells")) | (peds_copy["2代"].str.contains("Sadler's Wells")) | (peds_copy["3代"].str.contains("Sadler's Wells")) | (peds_copy["4代"].str.contains("Sadler's Wells")) | (peds_copy["5代"].str.contains("Sadler's Wells"))).astype(int)
-        peds_copy["サドラー系"] = peds_copy["サドラー系"].astype(str)
-        peds_copy["欧州ダンチヒ系"] = ((peds_copy["1代"].str.contains("Green Desert|Danehill")) | (peds_copy["2代"].str.contains("Green Desert|Danehill")) | (peds_copy["3代"].str.contains("Green Desert|Danehill")) | (peds_copy["4代"].str.contains("Green Desert|Danehill")) | (peds_copy["5代"].str.contains("Green Desert|Danehill"))).astype(int)
-        peds_copy["欧州ダンチヒ系"] = peds_copy["欧州ダンチヒ系"].astype(str)
-        peds_copy["米国ダンチヒ系"] = ((peds_copy["1代"].str.contains("Chief's Crown|Chief Bearhart|Hard Spun")) | (peds_copy["2代"].str.contains("Chief's Crown|Chief Bearhart|Hard Spun")) | (peds_copy["3代"].str.contains("Chief's Crown|Chief Bearhart|Hard Spun")) | (peds_copy["4代"].str.contains("Chief's Crown|Chief Bearhart|Hard Spun")) | (peds_copy["5代"].str.contains("Chief's Crown|Chief Bearhart|Hard Spun"))).astype(int)
-        peds_copy["米国ダンチヒ系"] = peds_copy["米国ダンチヒ系"].astype(str)
-        peds_copy["ヴァイスリージェント系"] = ((peds_copy["1代"].str.contains("Vice Regent|Deputy Minister")) | (peds_copy["2代"].str.contains("Vice Regent|Deputy Minister")) | (peds_copy["3代"].str.contains("Vice Regent|Deputy Minister")) | (peds_copy["4代"].str.contains("Vice Regent|Deputy Minister")) | (peds_copy["5代"].str.contains("Vice Regent|Deputy Minister"))).astype(int)
-        peds_copy["ヴァイスリージェント系"] = peds_copy["ヴァイスリージェント系"].astype(str)
-        peds_copy["ストームバード系"] = ((peds_copy["1代"].str.contains("Storm Bird|Storm Cat")) | (peds_copy["2代"].str.contains("Storm Bird|Storm Cat")) | (peds_copy["3代"].str.contains("Storm Bird|Storm Cat")) | (peds_copy["4代"].str.contains("Storm Bird|Storm Cat")) | (peds_copy["5代"].str.contains("Storm Bird|Storm Cat"))).astype(int)
-        peds_copy["ストームバード系"] = peds_copy["ストームバード系"].astype(str)
-        peds_copy["ノーザンテースト系"] = ((peds_copy["1代"].str.contains("ノーザンテースト")) | (peds_copy["2代"].str.contains("ノーザンテースト")) | (peds_copy["3代"].str.contains("ノーザンテースト")) | (peds_copy["4代"].str.contains("ノーザンテースト")) | (peds_copy["5代"].str.contains("ノーザンテースト"))).astype(int)
-        peds_copy["ノーザンテースト系"] = peds_copy["ノーザンテースト系"].astype(str)
-        peds_copy["ヘイロー系"] = ((peds_copy["1代"].str.contains("Devil|Glorious Song|サザンヘイロー")) | (peds_copy["2代"].str.contains("Devil|Glorious Song|サザンヘイロー")) | (peds_copy["3代"].str.contains("Devil|Glorious Song|サザンヘイロー")) | (peds_copy["4代"].str.contains("Devil|Glorious Song|サザンヘイロー")) | (peds_copy["5代"].str.contains("Devil|Glorious Song|サザンヘイロー"))).astype(int)
-        peds_copy["ヘイロー系"] = peds_copy["ヘイロー系"].astype(str)
-        peds_copy["ロベルト系"] = ((peds_copy["1代"].str.contains("Roberto")) | (peds_copy["2代"].str.contains("Roberto")) | (peds_copy["3代"].str.contains("Roberto")) | (peds_copy["4代"].str.contains("Roberto")) | (peds_copy["5代"].str.contains("Roberto"))).astype(int)
-        peds_copy["ロベルト系"] = peds_copy["ロベルト系"].astype(str)
-        peds_copy["サーゲイロード系"] = ((peds_copy["1代"].str.contains("Habitat|Sir Tristram")) | (peds_copy["2代"].str.contains("Habitat|Sir Tristram")) | (peds_copy["3代"].str.contains("Habitat|Sir Tristram")) | (peds_copy["4代"].str.contains("Habitat|Sir Tristram")) | (peds_copy["5代"].str.contains("Habitat|Sir Tristram"))).astype(int)
-        peds_copy["サーゲイロード系"] = peds_copy["サーゲイロード系"].astype(str)
-        peds_copy["米国ネイティヴ系"] = ((peds_copy["1代"].str.contains("Kauai King|Majestic Prince|Affirmed|Alydar")) | (peds_copy["2代"].str.contains("Kauai King|Majestic Prince|Affirmed|Alydar")) | (peds_copy["3代"].str.contains("Kauai King|Majestic Prince|Affirmed|Alydar")) | (peds_copy["4代"].str.contains("Kauai King|Majestic Prince|Affirmed|Alydar")) | (peds_copy["5代"].str.contains("Kauai King|Majestic Prince|Affirmed|Alydar"))).astype(int)
-        peds_copy["米国ネイティヴ系"] = peds_copy["米国ネイティヴ系"].astype(str)
-        peds_copy["欧州ネイティヴ系"] = ((peds_copy["1代"].str.contains("Atan|Sharpen Up|Sea-Bird")) | (peds_copy["2代"].str.contains("Atan|Sharpen Up|Sea-Bird")) | (peds_copy["3代"].str.contains("Atan|Sharpen Up|Sea-Bird")) | (peds_copy["4代"].str.contains("Atan|Sharpen Up|Sea-Bird")) | (peds_copy["5代"].str.contains("Atan|Sharpen Up|Sea-Bird"))).astype(int)
-        peds_copy["欧州ネイティヴ系"] = peds_copy["欧州ネイティヴ系"].astype(str)
-        peds_copy["キングマンボ系"] = ((peds_copy["1代"].str.contains("Kingmambo|Miswaki")) | (peds_copy["2代"].str.contains("Kingmambo")) | (peds_copy["3代"].str.contains("Kingmambo")) | (peds_copy["4代"].str.contains("Kingmambo")) | (peds_copy["5代"].str.contains("Kingmambo"))).astype(int)
-        peds_copy["キングマンボ系"] = peds_copy["キングマンボ系"].astype(str)
-        peds_copy["49er系"] = ((peds_copy["1代"].str.contains("サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest")) | (peds_copy["2代"].str.contains("サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest")) | (peds_copy["3代"].str.contains("サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest")) | (peds_copy["4代"].str.contains("サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest")) | (peds_copy["5代"].str.contains("サウスヴィグラス|プリサイスエンド|スウェプトオーヴァーボード|スイープトウショウ|ラインクラフト|アイルハヴアナザー|Coronado's Quest"))).astype(int)
-        peds_copy["49er系"] = peds_copy["49er系"].astype(str)
-        peds_copy["ダーレー系"] = ((peds_copy["1代"].str.contains("アドマイヤムーン")) | (peds_copy["2代"].str.contains("アドマイヤムーン")) | (peds_copy["3代"].str.contains("アドマイヤムーン")) | (peds_copy["4代"].str.contains("アドマイヤムーン")) | (peds_copy["5代"].str.contains("アドマイヤムーン"))).astype(int)
-        peds_copy["ダーレー系"] = peds_copy["ダーレー系"].astype(str)
-        peds_copy["ファピアノ系"] = ((peds_copy["1代"].str.contains("Fappiano")) | (peds_copy["2代"].str.contains("Fappiano")) | (peds_copy["3代"].str.contains("Fappiano")) | (peds_copy["4代"].str.contains("Fappiano")) | (peds_copy["5代"].str.contains("Fappiano"))).astype(int)
-        peds_copy["ファピアノ系"] = peds_copy["ファピアノ系"].astype(str)
-        peds_copy["その他ミスプロ系"] = ((peds_copy["1代"].str.contains("Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran")) | (peds_copy["2代"].str.contains("Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran")) | (peds_copy["3代"].str.contains("Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran")) | (peds_copy["4代"].str.contains("Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran")) | (peds_copy["5代"].str.contains("Woodman|Gone West|Seeking the Gold|Machiavellian|Smart Strike|King Glorious|アグネスデジタル|Afreet|Gulch|Jade Robbery|Scan|War Emblem|Aldebaran"))).astype(int)
-        peds_copy["その他ミスプロ系"] = peds_copy["その他ミスプロ系"].astype(str)
-        peds_copy["グレイソヴリン系"] = ((peds_copy["1代"].str.contains("シービークロス|Cozzene|Tony Bin|Caro")) | (peds_copy["2代"].str.contains("シービークロス|Cozzene|Tony Bin|Caro")) | (peds_copy["3代"].str.contains("シービークロス|Cozzene|Tony Bin|Caro")) | (peds_copy["4代"].str.contains("シービークロス|Cozzene|Tony Bin|Caro")) | (peds_copy["5代"].str.contains("シービークロス|Cozzene|Tony Bin|Caro"))).astype(int)
-        peds_copy["グレイソヴリン系"] = peds_copy["グレイソヴリン系"].astype(str)
-        peds_copy["プリンスリーギフト系"] = ((peds_copy["1代"].str.contains("サクラユタカオー")) | (peds_copy["2代"].str.contains("サクラユタカオー")) | (peds_copy["3代"].str.contains("サクラユタカオー")) | (peds_copy["4代"].str.contains("サクラユタカオー")) | (peds_copy["5代"].str.contains("サクラユタカオー"))).astype(int)
-        peds_copy["プリンスリーギフト系"] = peds_copy["プリンスリーギフト系"].astype(str)
-        peds_copy["ボールドルーラー系"] = ((peds_copy["1代"].str.contains("ロイヤルスキー|Seattle Slew")) | (peds_copy["2代"].str.contains("ロイヤルスキー|Seattle Slew")) | (peds_copy["3代"].str.contains("ロイヤルスキー|Seattle Slew")) | (peds_copy["4代"].str.contains("ロイヤルスキー|Seattle Slew")) | (peds_copy["5代"].str.contains("ロイヤルスキー|Seattle Slew"))).astype(int)
-        peds_copy["ボールドルーラー系"] = peds_copy["ボールドルーラー系"].astype(str)
-        peds_copy["レッドゴッド系"] = ((peds_copy["1代"].str.contains("Blushing Groom")) | (peds_copy["2代"].str.contains("Blushing Groom")) | (peds_copy["3代"].str.contains("Blushing Groom")) | (peds_copy["4代"].str.contains("Blushing Groom")) | (peds_copy["5代"].str.contains("Blushing Groom"))).astype(int)
-        peds_copy["レッドゴッド系"] = peds_copy["レッドゴッド系"].astype(str)
-        peds_copy["ネヴァーベンド系"] = ((peds_copy["1代"].str.contains("Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman")) | (peds_copy["2代"].str.contains("Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman")) | (peds_copy["3代"].str.contains("Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman")) | (peds_copy["4代"].str.contains("Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman")) | (peds_copy["5代"].str.contains("Shirley Heights|Mill Reef|ミルジョージ|Magnitude|Riverman|Bravest Roman"))).astype(int)
-        peds_copy["ネヴァーベンド系"] = peds_copy["ネヴァーベンド系"].astype(str)
-        peds_copy["ディープ系"] = ((peds_copy["1代"].str.contains("ディープインパクト")) | (peds_copy["2代"].str.contains("ディープインパクト")) | (peds_copy["3代"].str.contains("ディープインパクト")) | (peds_copy["4代"].str.contains("ディープインパクト")) | (peds_copy["5代"].str.contains("ディープインパクト"))).astype(int)
-        peds_copy["ディープ系"] = peds_copy["ディープ系"].astype(str)
-        peds_copy["Tサンデー系"] = ((peds_copy["1代"].str.contains("ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ")) | (peds_copy["2代"].str.contains("ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ")) | (peds_copy["3代"].str.contains("ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ")) | (peds_copy["4代"].str.contains("ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ")) | (peds_copy["5代"].str.contains("ブラックタイド|ステイゴールド|ゼンノロブロイ|ハーツクライ|ヴィクトワールピサ|マンハッタンカフェ|オルフェーヴル|ダンスインザダーク|スペシャルウィーク|アドマイヤグルーヴ"))).astype(int)
-        peds_copy["Tサンデー系"] = peds_copy["Tサンデー系"].astype(str)
-        peds_copy["Pサンデー系"] = ((peds_copy["1代"].str.contains("フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン")) | (peds_copy["2代"].str.contains("フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン")) | (peds_copy["3代"].str.contains("フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン")) | (peds_copy["4代"].str.contains("フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ|アグネスタキオン")) | (peds_copy["5代"].str.contains("フジキセキ|ダイワメジャー|キンシャサノキセキ|デュランダル|マツリダゴッホ|ジョーカプチーノ"))).astype(int)
-        peds_copy["Pサンデー系"] = peds_copy["Pサンデー系"].astype(str)
-        peds_copy["Dサンデー系"] = ((peds_copy["1代"].str.contains("ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ")) | (peds_copy["2代"].str.contains("ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ")) | (peds_copy["3代"].str.contains("ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ")) | (peds_copy["4代"].str.contains("ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ")) | (peds_copy["5代"].str.contains("ゴールドアリュール|カネヒキリ|ネオユニヴァース|ディープスカイ|スズカマンボ"))).astype(int)
-        peds_copy["Dサンデー系"] = peds_copy["Dサンデー系"].astype(str)
-        #大系統と国系統型
-        peds_copy["大系統サンデー"] = ((peds_copy["1代"].str.contains("サンデーサイレンス")) | (peds_copy["2代"].str.contains("サンデーサイレンス")) | (peds_copy["3代"].str.contains("サンデーサイレンス")) | (peds_copy["4代"].str.contains("サンデーサイレンス")) | (peds_copy["5代"].str.contains("サンデーサイレンス"))).astype(int)
-        peds_copy["大系統サンデー"] = peds_copy["大系統サンデー"].astype(str)
-        peds_copy["大系統ナスルーラ"] = ((peds_copy["グレイソヴリン系"]=="1") | (peds_copy["プリンスリーギフト系"]=="1") | (peds_copy["ボールドルーラー系"]=="1") | (peds_copy["レッドゴッド系"]=="1") | (peds_copy["ネヴァーベンド系"]=="1")).astype(int)
-        peds_copy["大系統ナスルーラ"] = peds_copy["大系統ナスルーラ"].astype(str)
-        peds_copy["大系統ミスプロ"] = ((peds_copy["キングマンボ系"]=="1") | (peds_copy["49er系"]=="1") | (peds_copy["ダーレー系"]=="1") | (peds_copy["ファピアノ系"]=="1") | (peds_copy["その他ミスプロ系"]=="1")).astype(int)
-        peds_copy["大系統ミスプロ"] = peds_copy["大系統ミスプロ"].astype(str)
-        peds_copy["大系統ターントゥ"] = ((peds_copy["ヘイロー系"]=="1") | (peds_copy["ロベルト系"]=="1") | (peds_copy["サーゲイロード系"]=="1")).astype(int)
-        peds_copy["大系統ターントゥ"] = peds_copy["大系統ターントゥ"].astype(str)
-        peds_copy["大系統米国ND"] = ((peds_copy["米国ダンチヒ系"]=="1") | (peds_copy["ヴァイスリージェント系"]=="1") | (peds_copy["ストームバード系"]=="1")).astype(int)
-        peds_copy["大系統米国ND"] = peds_copy["大系統米国ND"].astype(str)
-        peds_copy["大系統欧州ND"] = ((peds_copy["ニジンスキー系"]=="1") | (peds_copy["欧州ND系"]=="1") | (peds_copy["サドラー系"]=="1") | (peds_copy["欧州ダンチヒ系"]=="1")).astype(int)
-        peds_copy["大系統欧州ND"] = peds_copy["大系統欧州ND"].astype(str)
-        peds_copy["日本型"] = ((peds_copy["プリンスリーギフト系"]=="1") | (peds_copy["ダーレー系"]=="1") | (peds_copy["大系統サンデー"]=="1") | (peds_copy["ノーザンテースト系"]=="1")).astype(int)
-        peds_copy["日本型"] = peds_copy["日本型"].astype(str)
-        peds_copy["米国型"] = ((peds_copy["リローンチ系"]=="1") | (peds_copy["米国マイナー系"]=="1") | (peds_copy["大系統米国ND"]=="1") | (peds_copy["ヘイロー系"]=="1") | (peds_copy["米国ネイティヴ系"]=="1") | (peds_copy["49er系"]=="1") | (peds_copy["ファピアノ系"]=="1") | (peds_copy["その他ミスプロ系"]=="1") | (peds_copy["ボールドルーラー系"]=="1")).astype(int)
-        peds_copy["米国型"] = peds_copy["米国型"].astype(str)
-        peds_copy["欧州型"] = ((peds_copy["マイバブー系"]=="1") | (peds_copy["ウォーニング系"]=="1") | (peds_copy["スターリング系"]=="1") | (peds_copy["リボー系"]=="1") | (peds_copy["ハンプトン系"]=="1") | (peds_copy["大系統欧州ND"]=="1") | (peds_copy["ロベルト系"]=="1") | (peds_copy["サーゲイロード系"]=="1") | (peds_copy["欧州ネイティヴ系"]=="1") | (peds_copy["キングマンボ系"]=="1") | (peds_copy["グレイソヴリン系"]=="1") | (peds_copy["レッドゴッド系"]=="1") | (peds_copy["ネヴァーベンド系"]=="1")).astype(int)
-        peds_copy["欧州型"] = peds_copy["欧州型"] .astype(str) 
+        # 祖先名をユニークにして、系統の判定は名前ごとに1回だけ行う。行の系統は世代ごとのビットのOR
+        gens = ["1代", "2代", "3代", "4代", "5代"]
+        codes, names = pd.factorize(peds_copy[gens].values.ravel())
+        codes = codes.reshape(len(peds_copy), len(gens))
+        table = self._lineage_table(names, rules)
+        mask = np.zeros(len(peds_copy), dtype=np.uint64)
+        for g in range(len(gens)):
+            mask |= table[g][codes[:, g]]
+
+        bit = {name: np.uint64(1) << np.uint64(i) for i, (name, _) in enumerate(rules)}
+        for name, members in LINEAGE_GROUPS:
+            if name not in needed:
+                continue
+            bit[name] = np.uint64(1) << np.uint64(len(bit))
+            member_bits = np.bitwise_or.reduce([bit[m] for m in members])
+            mask |= np.where(mask & member_bits, bit[name], np.uint64(0))
+        flags = pd.DataFrame({name: ((mask & b) != 0).astype(np.uint8) for name, b in bit.items() if flags is None or name in flags},
+                             index=peds_copy.index)
+        peds_copy = pd.concat([peds_copy, flags], axis=1)
         
         return peds_copy
 
+    def _lineage_needs(self, flags):
+        # 作るフラグ → 判定が要る系統（大系統・型のメンバーをたどる。グループは前の行しか使わないので後ろから見る）
+        all_flags = [name for name, _ in LINEAGE_RULES] + [name for name, _ in LINEAGE_GROUPS]
+        if flags is None:
+            return set(all_flags)
+        unknown = set(flags) - set(all_flags)
+        if unknown:
+            raise ValueError("未定義の系統フラグです: %s" % ", ".join(sorted(unknown)))
+        needed = set(flags)
+        for name, members in reversed(LINEAGE_GROUPS):
+            if name in needed:
+                needed |= set(members)
+        return needed
+
+    @profiled()
+    def _lineage_table(self, names, rules=LINEAGE_RULES):
+        # 祖先名×世代 → 系統ビット（rulesの並び順）。末尾はNaN（codes=-1）用の0
+        # 祖先名は生年・毛色を落とした名前でlineage_memoを引き、初めて見る名前だけ正規表現で判定する
+        keys, uniq = pd.factorize(pd.Series(names, dtype=object).str.replace(ANCESTOR_SUFFIX, "", regex=True))
+        uniq = pd.Series(uniq, dtype=object)
+        table = np.zeros((5, len(names) + 1), dtype=np.uint64)
+        for i, (name, patterns) in enumerate(rules):
+            if isinstance(patterns, str):
+                patterns = [patterns] * 5
+            memo = self.lineage_memo.setdefault((name, tuple(patterns)), {})
+            gen_bits = uniq.map(memo)
+            missing = gen_bits.isna().values
+            stats = self.memo_stats.setdefault(name, {"hits": 0, "misses": 0})
+            stats["hits"] += int((~missing).sum())
+            stats["misses"] += int(missing.sum())
+            if missing.any():
+                with PROFILER.span("lineage:" + name, int(missing.sum())):
+                    new = uniq[missing]
+                    bits = np.zeros(len(new), dtype=np.uint8)
+                    hits = self._contains(new, list(dict.fromkeys(patterns)))
+                    for g, pattern in enumerate(patterns):
+                        bits |= hits[pattern].astype(np.uint8) << np.uint8(g)
+                memo.update(zip(new.values, bits.tolist()))
+                gen_bits[missing] = bits
+            gen_bits = gen_bits.values.astype(np.uint64)[keys]
+            for g in range(5):
+                table[g, :-1] |= ((gen_bits >> np.uint64(g)) & np.uint64(1)) << np.uint64(i)
+        return table
+
+    def _contains(self, names, patterns):
+        # パターン → 祖先名ごとの一致
+        if self.backend is not None:
+            return self.backend.contains(names, patterns)
+        return {pattern: names.str.contains(pattern).fillna(False).values for pattern in patterns}
+
+    def save_memo(self, path):
+        with open(path, "wb") as f:
+            pickle.dump(self.lineage_memo, f)
+
+    def load_memo(self, path):
+        # 前回までの判定結果を引き継ぐ（ルールのパターンが変わった系統は別のキーになるので、古い結果は使われない）
+        with open(path, "rb") as f:
+            self.lineage_memo = pickle.load(f)
+
+    def memo_report(self):
+        # 系統ごとのメモの当たり・外れ（外れ = 正規表現で判定した祖先名の数）
+        report = pd.DataFrame.from_dict(self.memo_stats, orient="index", columns=["hits", "misses"])
+        report["hit_rate"] = report["hits"] / (report["hits"] + report["misses"])
+        report["size"] = [sum(len(m) for (name, _), m in self.lineage_memo.items() if name == n) for n in report.index]
+        return report
+
+    @profiled(out="df")
     def p_p(self):
-        peds_copy = self.peds.copy()
-        
-        titi = peds_copy[0::4]
-        titi_p = self.p_p_1(titi)
-        titi_p = titi_p.drop(columns={'2代', '3代', '4代', '5代', 'マイバブー系', 'ウォーニング系', 'リローンチ系', 'スターリング系',
-               '米国マイナー系', 'リボー系', 'ハンプトン系', '欧州ND系', 'ヴァイスリージェント系', 'ストームバード系', 'ノーザンテースト系', 'ヘイロー系', 'ロベルト系',
-               'サーゲイロード系', '米国ネイティヴ系', '欧州ネイティヴ系', '49er系', 'ダーレー系',
-               'ファピアノ系', 'その他ミスプロ系', 'グレイソヴリン系', 'プリンスリーギフト系', 'ボールドルーラー系', 'レッドゴッド系',
-               'ネヴァーベンド系'})
-        titi_p.columns = '父_' + titi_p.columns
-        hahatiti = peds_copy[2::4]
-        hahatiti_p = self.p_p_1(hahatiti)
-        hahatiti_p = hahatiti_p.drop(columns={'1代', '3代', '4代', '5代', 'マイバブー系', 'ウォーニング系', 'リローンチ系', 'スターリング系',
-               '米国マイナー系', 'リボー系', 'ハンプトン系', '欧州ND系', 'ヴァイスリージェント系', 'ストームバード系', 'ノーザンテースト系', 'ヘイロー系', 'ロベルト系',
-               'サーゲイロード系', '米国ネイティヴ系', '欧州ネイティヴ系', '49er系', 'ダーレー系',
-               'ファピアノ系', 'その他ミスプロ系', 'グレイソヴリン系', 'プリンスリーギフト系', 'ボールドルーラー系', 'レッドゴッド系',
-               'ネヴァーベンド系'})
-        hahatiti_p.columns = '母父_' + hahatiti_p.columns
-        hahahahatiti = peds_copy[3::4]
-        hahahahatiti_p = self.p_p_1(hahahahatiti)
-        hahahahatiti_p = hahahahatiti_p.drop(columns={'1代', '2代', '4代', '5代', 'マイバブー系', 'ウォーニング系', 'リローンチ系', 'スターリング系',
-               '米国マイナー系', 'リボー系', 'ハンプトン系', 'ニジンスキー系', '欧州ND系', 'サドラー系', '欧州ダンチヒ系',
-               '米国ダンチヒ系', 'ヴァイスリージェント系', 'ストームバード系', 'ノーザンテースト系', 'ヘイロー系', 'ロベルト系',
-               'サーゲイロード系', '米国ネイティヴ系', '欧州ネイティヴ系', 'キングマンボ系', '49er系', 'ダーレー系',
-               'ファピアノ系', 'その他ミスプロ系', 'グレイソヴリン系', 'プリンスリーギフト系', 'ボールドルーラー系', 'レッドゴッド系',
-               'ネヴァーベンド系', 'ディープ系', 'Tサンデー系', 'Pサンデー系', 'Dサンデー系', 
-               '大系統ナスルーラ', '大系統ミスプロ', '大系統ターントゥ', '大系統米国ND', '大系統欧州ND'})
-        hahahahatiti_p.columns = '母母父_' + hahahahatiti_p.columns
-        titihahatiti = peds_copy[1::4]
-        titihahatiti_p = self.p_p_1(titihahatiti)
-        titihahatiti_p = titihahatiti_p.drop(columns={'1代', '2代', '3代', '4代', '5代', 'マイバブー系', 'ウォーニング系', 'リローンチ系', 'スターリング系',
-               '米国マイナー系', 'リボー系', 'ハンプトン系', 'ニジンスキー系', '欧州ND系', 'サドラー系', '欧州ダンチヒ系',
-               '米国ダンチヒ系', 'ヴァイスリージェント系', 'ストームバード系', 'ノーザンテースト系', 'ヘイロー系', 'ロベルト系',
-               'サーゲイロード系', '米国ネイティヴ系', '欧州ネイティヴ系', 'キングマンボ系', '49er系', 'ダーレー系',
-               'ファピアノ系', 'その他ミスプロ系', 'グレイソヴリン系', 'プリンスリーギフト系', 'ボールドルーラー系', 'レッドゴッド系',
-               'ネヴァーベンド系', 'ディープ系', 'Tサンデー系', 'Pサンデー系', 'Dサンデー系',
-               '大系統ナスルーラ', '大系統ミスプロ', '大系統ターントゥ', '大系統米国ND', '大系統欧州ND', '日本型', '米国型',
-               '欧州型'})
-        titihahatiti_p.columns = '父母父_' + titihahatiti_p.columns
-
-        peds_shinba = pd.concat([titi_p, hahatiti_p, titihahatiti_p, hahahahatiti_p], axis=1)  # return peds_shinba
-
-        peds_shinba = peds_shinba.rename(columns={'父_1代':"父", '母父_2代':"母父", "母母父_3代":"母母父"})
-        peds_shinba["父"] = peds_shinba["父"].str.split("\d+", expand=True)[0]
-        peds_shinba["母父"] = peds_shinba["母父"].str.split("\d+", expand=True)[0]
-        peds_shinba["母母父"] = peds_shinba["母母父"].str.split("\d+", expand=True)[0]
-        peds_shinba["非サンデー馬"] = ((peds_shinba['父_大系統サンデー']=="0") & (peds_shinba['母父_大系統サンデー']=="0") & (peds_shinba['父母父_大系統サンデー']=="0") &\
-                                 (peds_shinba['母母父_大系統サンデー']=="0")).astype(int)
-        peds_shinba["非サンデー馬"] = peds_shinba["非サンデー馬"].astype(str)
-        peds_shinba["サンデー_米国"] = (((peds_shinba["父_大系統サンデー"]=="1") & (peds_shinba["母父_米国型"]=="1")) | ((peds_shinba["母父_大系統サンデー"]=="1") &\
-                                                                                                      (peds_shinba["父_米国型"]=="1"))).astype(int)
-        peds_shinba["サンデー_米国"] = peds_shinba["サンデー_米国"].astype(str)
-        peds_shinba["米国B"] = (((peds_shinba["父_米国型"]=="1") & (peds_shinba["母父_米国型"]=="1")) | ((peds_shinba["父_米国型"]=="1") & (peds_shinba["母母父_米国型"]=="1"))).astype(int)
-        peds_shinba["米国B"] = peds_shinba["米国B"].astype(str)
-        peds_shinba["米国A"] = ((peds_shinba["父_米国型"]=="1") & (peds_shinba["母父_米国型"]=="1") & (peds_shinba["母母父_米国型"]=="1")).astype(int)
-        peds_shinba["米国A"] = peds_shinba["米国A"].astype(str)
-        peds_shinba["父_母父_ディープ"] = ((peds_shinba["父_ディープ系"]=="1") | (peds_shinba["母父_ディープ系"]=="1")).astype(int)
-        peds_shinba["父_母父_ディープ"] = peds_shinba["父_母父_ディープ"].astype(str)
-        peds_shinba["父_母父_キングマンボ系"] = ((peds_shinba["父_キングマンボ系"]=="1") | (peds_shinba["母父_キングマンボ系"]=="1")).astype(int)
-        peds_shinba["父_母父_キングマンボ系"] = peds_shinba["父_母父_キングマンボ系"].astype(str)
-        peds_shinba["欧州A"] = ((peds_shinba["父_欧州型"]=="1") & (peds_shinba["母父_欧州型"]=="1") & (peds_shinba["母母父_欧州型"]=="1")).astype(int)
-        peds_shinba["欧州A"] = peds_shinba["欧州A"].astype(str)
-        peds_shinba["欧州B"] = (((peds_shinba["母父_欧州型"]=="1") & (peds_shinba["母母父_欧州型"]=="1")) | \
-                              ((peds_shinba["父_欧州型"]=="1") & (peds_shinba["母母父_欧州型"]=="1")) | \
-                             ((peds_shinba["父_欧州型"]=="1") & (peds_shinba["母父_欧州型"]=="1"))).astype(int)
-        peds_shinba["欧州B"] = peds_shinba["欧州B"] .astype(str)
+        if self.cache is None:
+            self.df = self.schema.apply(pd.concat(self.iter_p_p()), "peds")
+        else:
+            source = self.peds if self.peds is not None else self._peds_files(self.paths)
+            self.df = self.cache.run("peds", lambda source, columns, features: self.schema.apply(pd.concat(self.iter_p_p()), "peds"),
+                                     source, self.columns, self.features)
+
+    @profiled(out="df")
+    def update(self, peds):
+        # まだ分類していない馬の血統だけ分類して追加する
+        new = peds.loc[~peds.index.isin(self.df["horse_id"])]
+        if len(new):
+            self.df = self.schema.apply(pd.concat([self.df, self._p_p(new)]), "peds")
+
+    def save_state(self, path):
+        self.df.to_pickle(path)
+
+    def load_state(self, path):
+        self.df = pd.read_pickle(path)
+
+    @profiled()
+    def _p_p(self, peds):
+        # 位置ごとに、選んだ系統フラグだけ判定して「父_」等の接頭辞を付ける。祖先名の列は父・母父・母母父にする
+        parts = []
+        for position, row, gen in PEDS_POSITIONS:
+            flags = list(self.features.get(position, []))
+            part = self.p_p_1(peds[row::4], flags)
+            part = part.drop(columns=[g for g in ["1代", "2代", "3代", "4代", "5代"] if g != gen])
+            part = part.rename(columns={gen: position})
+            part.columns = [c if c == position else position + "_" + c for c in part.columns]
+            parts.append(part)
+        peds_shinba = pd.concat(parts, axis=1)
+        for position, _, gen in PEDS_POSITIONS:
+            if gen is not None:
+                peds_shinba[position] = peds_shinba[position].str.split(r"\d+", expand=True)[0]
+        for name, terms, negate in PEDIGREE_COMBOS:
+            cols = {c for term in terms for c in term}
+            if not cols <= set(peds_shinba.columns):
+                continue
+            hit = np.zeros(len(peds_shinba), dtype=bool)
+            for term in terms:
+                hit |= (peds_shinba[term] == 1).all(axis=1).values
+            peds_shinba[name] = (hit != negate).astype(np.uint8)
         peds_shinba["horse_id"] = peds_shinba.index
         
-        self.df = peds_shinba.copy()
+        return peds_shinba
     
+    @profiled(out="merged_df")
     def merge(self, results):
         df = pd.merge(results, self.df, on="horse_id", how="left")
         df["course_len"] = df["course_len"].astype(str)
-        df["course"] = df["競馬場"]+df["race_type"]+df["course_len"]
+        df["course"] = df["競馬場"].astype(object) + df["race_type"].astype(object) + df["course_len"]
         df["distance"] = df["course_len"].astype(int)
-        df["blood_point"] = 0
-        turf_a_list = ["06芝1600", "05芝1600", "08芝1600", "05芝1400", "09芝1600", "09芝1800", "05芝1800", "06芝1200", "08芝1800", "03芝1200",\
-                       "09芝2000", "06芝2000", "06芝1800", "09芝1400", "08芝1400", "05芝2000", "04芝1000", "07芝1600", "09芝1200", "10芝1200",\
-                       "08芝1200", "07芝1200"]
-        turf_b_list = ["10芝1200", "03芝1200", "02芝1200", "10芝1800", "10芝2000", "08芝2000", "07芝2000", "01芝1200", "06芝2000", "08芝1600", "03芝2000",\
-                       "03芝1800", "04芝1000", "09芝2000", "06芝1600", "09芝1400", "06芝1800", "09芝1600", "09芝1800", "06芝1200"]
-        turf_c_list = ["10芝2000", "08芝2000", "03芝2000", "05芝2400", "01芝2000", "10芝1800", "03芝2600", "10芝2600", "06芝2000", "09芝2000", "09芝2400",\
-                       "02芝2000", "07芝2200", "04芝1800", "04芝2000", "02芝1800", "08芝1800", "03芝1800", "06芝2200", "05芝2000", "07芝2000", "04芝2400",\
-                       "08芝2400", "04芝2200", "02芝2600", "01芝2600", "08芝2200", "09芝2200"]
-        turf_d_list = ["05芝1600", "05芝1800", "06芝1600", "05芝1400", "10芝1200", "05芝2000", "09芝1600", "06芝2000", "05芝2400", "03芝1200", "07芝2000",\
-                       "04芝1800", "09芝1800", "08芝1600", "04芝2000", "08芝1800", "07芝1400", "04芝1600", "08芝1400", "02芝1200"]
-        dart_a_list = ["06ダート1200", "08ダート1200", "09ダート1400", "09ダート1200", "04ダート1200", "05ダート1600", "08ダート1800", "05ダート1400",\
-                       "08ダート1400", "09ダート1800", "06ダート1800", "07ダート1400", "07ダート1200", "03ダート1150", "10ダート1000", "10ダート1700",\
-                       "05ダート1300", "01ダート1000"]
-        dart_b_list = ["06ダート1800", "09ダート1800", "08ダート1800", "04ダート1800", "03ダート1700", "05ダート1600", "06ダート1200", "07ダート1800",\
-                       "10ダート1700", "02ダート1700", "01ダート1700", "09ダート1400", "04ダート1200", "05ダート1400", "08ダート1400", "03ダート1150"]
-        dart_c_list = ["06ダート1800", "09ダート1800", "04ダート1800", "05ダート1600", "08ダート1800", "05ダート2100", "03ダート1700", "07ダート1800",\
-                       "10ダート1700", "02ダート1700", "01ダート1700", "05ダート1400", "06ダート1200", "09ダート1400", "06ダート2400", "07ダート1900",\
-                       "09ダート2000"]
-        dart_d_list = ["05ダート1400", "05ダート1600", "09ダート1800", "06ダート1200", "06ダート1800", "08ダート1800", "09ダート1400",\
-                       "08ダート1400", "05ダート2100", "07ダート1800", "07ダート1400", "04ダート1800", "08ダート1200", "10ダート1700", "08ダート1900"]
+        # 父・性別・コース・血統フラグの組み合わせごとにルールを1回だけ評価し、行へは添字で配る
+        pedigree_flags = sorted({f for any_flags, all_flags, _, _ in pedigree_rules(df.columns) for f in any_flags + all_flags})
+        df["blood_point"] = self._rule_points(df, ["父", "sex", "course", "race_type"] + pedigree_flags, self._blood_rules)
+        pace_down = df.父.isin(PACE_SIRES["down"])
+        pace_up = df.父.isin(PACE_SIRES["up"])
+        shorter = df.今回距離変化 < 0
+        longer = df.今回距離変化 > 0
+        rest = df.今回間隔 > "65 days"
+        back = (df.前走間隔 > "65 days") & (df.今回間隔 < "40 days")
+        df["blood_point"] += 2 * (shorter & pace_down) - 2 * (shorter & pace_up) + 2 * (longer & pace_up) - 2 * (longer & pace_down) \
+            + 1 * ((df.前走距離変化 > 0) & (df.今回距離変化 == 0) & pace_down) \
+            + 1 * (rest & pace_down) - 1 * (back & (df.着順_1走前 <= 5) & pace_down) \
+            - 1 * (rest & pace_up) + 1 * (back & (df.着順_1走前 <= 9) & pace_up)
         
-        df.loc[(df.父=="ディープインパクト ") & ((df.course=="05芝1600") | (df.course=="05芝1800") | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] = \
-            df.loc[(df.父=="ディープインパクト ") & ((df.course=="05芝1600") | (df.course=="05芝1800") | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] +1
-        df.loc[(df.父=="ディープインパクト ") & (df.course.isin(turf_a_list+turf_c_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ディープインパクト ") & (df.course.isin(turf_a_list+turf_c_list+turf_d_list)), "blood_point"] +1
-        df.loc[(df.父=="ディープインパクト ") & ((df.course.isin(turf_b_list)) | ((df.sex=="牝") & (df.course.isin(turf_c_list)))), "blood_point"] = \
-            df.loc[(df.父=="ディープインパクト ") & ((df.course.isin(turf_b_list)) | ((df.sex=="牝") & (df.course.isin(turf_c_list)))), "blood_point"] -1
-        df.loc[(df.父=="ハーツクライ ") & (((df.sex=="牡") & (df.course.isin(turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] = \
-            df.loc[(df.父=="ハーツクライ ") & (((df.sex=="牡") & (df.course.isin(turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] +1
-        df.loc[(df.父=="ハーツクライ ") & (df.course.isin(turf_a_list+turf_c_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ハーツクライ ") & (df.course.isin(turf_a_list+turf_c_list+turf_d_list)), "blood_point"] +1
-        df.loc[(df.父=="ハーツクライ ") & ((df.sex=="牝") & (df.course.isin(turf_b_list))), "blood_point"] = \
-            df.loc[(df.父=="ハーツクライ ") & ((df.sex=="牝") & (df.course.isin(turf_b_list))), "blood_point"] -1
-        df.loc[(df.父=="ハーツクライ ") & (df.sex=="牡") & (df.course.isin(dart_b_list+dart_c_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ハーツクライ ") & (df.sex=="牡") & (df.course.isin(dart_b_list+dart_c_list+dart_d_list)), "blood_point"] +1
-        df.loc[(df.父=="ダイワメジャー ") & (df.course.isin(turf_a_list)), "blood_point"] = \
-            df.loc[(df.父=="ダイワメジャー ") & (df.course.isin(turf_a_list)), "blood_point"] +2
-        df.loc[(df.父=="ダイワメジャー ") & ((df.sex=="牡") & (df.course.isin(turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="ダイワメジャー ") & ((df.sex=="牡") & (df.course.isin(turf_d_list))), "blood_point"] +1
-        df.loc[(df.父=="ダイワメジャー ") & (df.course.isin(turf_b_list+turf_c_list)), "blood_point"] = \
-            df.loc[(df.父=="ダイワメジャー ") & (df.course.isin(turf_b_list+turf_c_list)), "blood_point"] -1
-        df.loc[(df.父=="ダイワメジャー ") & ((df.sex=="牡") & (df.course.isin(dart_a_list))), "blood_point"] = \
-            df.loc[(df.父=="ダイワメジャー ") & ((df.sex=="牡") & (df.course.isin(dart_a_list))), "blood_point"] +1
-        df.loc[(df.父=="ハービンジャー Harbinger(英) ") & (df.course.isin(turf_c_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ハービンジャー Harbinger(英) ") & (df.course.isin(turf_c_list+turf_d_list)), "blood_point"] +2
-        df.loc[(df.父=="ハービンジャー Harbinger(英) ") & ((df.sex=="牡") & (df.course.isin(turf_b_list))), "blood_point"] = \
-            df.loc[(df.父=="ハービンジャー Harbinger(英) ") & ((df.sex=="牡") & (df.course.isin(turf_b_list))), "blood_point"] +1
-        df.loc[(df.父=="ハービンジャー Harbinger(英) ") & (df.course.isin(turf_a_list)), "blood_point"] = \
-            df.loc[(df.父=="ハービンジャー Harbinger(英) ") & (df.course.isin(turf_a_list)), "blood_point"] -1
-        df.loc[(df.父=="ルーラーシップ ") & (((df.sex=="牡") & (df.course.isin(turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] = \
-            df.loc[(df.父=="ルーラーシップ ") & (((df.sex=="牡") & (df.course.isin(turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] +2
-        df.loc[(df.父=="ルーラーシップ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_c_list)))), "blood_point"] = \
-            df.loc[(df.父=="ルーラーシップ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_c_list)))), "blood_point"] +1
-        df.loc[(df.父=="ルーラーシップ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ルーラーシップ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] -1
-        df.loc[(df.父=="ルーラーシップ ") & ((df.sex=="牡") & (df.course.isin(dart_c_list))), "blood_point"] = \
-            df.loc[(df.父=="ルーラーシップ ") & ((df.sex=="牡") & (df.course.isin(dart_c_list))), "blood_point"] +1
-        df.loc[(df.父=="ロードカナロア ") & (df.course.isin(turf_a_list)), "blood_point"] = \
-            df.loc[(df.父=="ロードカナロア ") & (df.course.isin(turf_a_list)), "blood_point"] +2
-        df.loc[(df.父=="ロードカナロア ") & ((df.sex=="牡") & (df.course.isin(turf_b_list))), "blood_point"] = \
-            df.loc[(df.父=="ロードカナロア ") & ((df.sex=="牡") & (df.course.isin(turf_b_list))), "blood_point"] +1
-        df.loc[(df.父=="ロードカナロア ") & (df.course.isin(turf_c_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ロードカナロア ") & (df.course.isin(turf_c_list+turf_d_list)), "blood_point"] -1
-        df.loc[(df.父=="ロードカナロア ") & (df.course.isin(dart_a_list+dart_b_list)), "blood_point"] = \
-            df.loc[(df.父=="ロードカナロア ") & (df.course.isin(dart_a_list+dart_b_list)), "blood_point"] +1
-        df.loc[(df.父=="ステイゴールド ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="ステイゴールド ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] +2
-        df.loc[(df.父=="ステイゴールド ") & (((df.sex=="牝") & (df.course.isin(turf_d_list))) | (df.course.isin(turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="ステイゴールド ") & (((df.sex=="牝") & (df.course.isin(turf_d_list))) | (df.course.isin(turf_c_list))), "blood_point"] +1
-        df.loc[(df.父=="ステイゴールド ") & (df.course.isin(turf_b_list)), "blood_point"] = \
-            df.loc[(df.父=="ステイゴールド ") & (df.course.isin(turf_b_list)), "blood_point"] -1
-        df.loc[(df.父=="キングカメハメハ ") & (((df.sex=="牡") & (df.course.isin(turf_a_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] = \
-            df.loc[(df.父=="キングカメハメハ ") & (((df.sex=="牡") & (df.course.isin(turf_a_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] +2
-        df.loc[(df.父=="キングカメハメハ ") & (((df.sex=="牡") & (df.course.isin(turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] = \
-            df.loc[(df.父=="キングカメハメハ ") & (((df.sex=="牡") & (df.course.isin(turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] +1
-        df.loc[(df.父=="キングカメハメハ ") & (df.course.isin(turf_b_list)), "blood_point"] = \
-            df.loc[(df.父=="キングカメハメハ ") & (df.course.isin(turf_b_list)), "blood_point"] -1
-        df.loc[(df.父=="キングカメハメハ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="キングカメハメハ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="オルフェーヴル ") & ((df.sex=="牡") & (df.course.isin(turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="オルフェーヴル ") & ((df.sex=="牡") & (df.course.isin(turf_c_list))), "blood_point"] +2
-        df.loc[(df.父=="オルフェーヴル ") & ((df.sex=="牝") & (df.course.isin(turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="オルフェーヴル ") & ((df.sex=="牝") & (df.course.isin(turf_c_list))), "blood_point"] +1
-        df.loc[(df.父=="オルフェーヴル ") & (df.course.isin(turf_a_list)), "blood_point"] = \
-            df.loc[(df.父=="オルフェーヴル ") & (df.course.isin(turf_a_list)), "blood_point"] -1
-        df.loc[(df.父=="オルフェーヴル ") & (df.course.isin(dart_c_list)), "blood_point"] = \
-            df.loc[(df.父=="オルフェーヴル ") & (df.course.isin(dart_c_list)), "blood_point"] +1
-        df.loc[(df.父=="ヴィクトワールピサ ") & ((df.sex=="牝") & (df.course.isin(turf_c_list+turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="ヴィクトワールピサ ") & ((df.sex=="牝") & (df.course.isin(turf_c_list+turf_d_list))), "blood_point"] +1
-        df.loc[(df.父=="キンシャサノキセキ ") & ((df.sex=="牡") & (df.course.isin(turf_a_list))), "blood_point"] = \
-            df.loc[(df.父=="キンシャサノキセキ ") & ((df.sex=="牡") & (df.course.isin(turf_a_list))), "blood_point"] +2
-        df.loc[(df.父=="キンシャサノキセキ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list+turf_d_list)))), "blood_point"] = \
-            df.loc[(df.父=="キンシャサノキセキ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list+turf_d_list)))), "blood_point"] +1
-        df.loc[(df.父=="キンシャサノキセキ ") & ((df.sex=="牡") & (df.course.isin(dart_a_list+dart_d_list))), "blood_point"] = \
-            df.loc[(df.父=="キンシャサノキセキ ") & ((df.sex=="牡") & (df.course.isin(dart_a_list+dart_d_list))), "blood_point"] +1
-        df.loc[(df.父=="マンハッタンカフェ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="マンハッタンカフェ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] +1
-        df.loc[(df.父=="ディープブリランテ ") & (((df.sex=="牡") & (df.course.isin(turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] = \
-            df.loc[(df.父=="ディープブリランテ ") & (((df.sex=="牡") & (df.course.isin(turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] +1
-        df.loc[(df.父=="スクリーンヒーロー ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] = \
-            df.loc[(df.父=="スクリーンヒーロー ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] +1
-        df.loc[(df.父=="ブラックタイド ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] = \
-            df.loc[(df.父=="ブラックタイド ") & (((df.sex=="牡") & (df.course.isin(turf_b_list))) | ((df.sex=="牝") & (df.course.isin(turf_d_list)))), "blood_point"] +1
-        df.loc[(df.父=="ノヴェリスト Novellist(愛) ") & (((df.sex=="牡") & (df.course.isin(turf_a_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] = \
-            df.loc[(df.父=="ノヴェリスト Novellist(愛) ") & (((df.sex=="牡") & (df.course.isin(turf_a_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] +1
-        df.loc[(df.父=="エイシンフラッシュ ") & ((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="エイシンフラッシュ ") & ((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] +1
-        df.loc[(df.父=="キズナ ") & ((df.sex=="牝") & (df.course.isin(turf_b_list))), "blood_point"] = \
-            df.loc[(df.父=="キズナ ") & ((df.sex=="牝") & (df.course.isin(turf_b_list))), "blood_point"] +2
-        df.loc[(df.父=="キズナ ") & (df.sex=="牡") & (((df.course.isin(turf_b_list))) | (df.race_type=="ダート")), "blood_point"] = \
-            df.loc[(df.父=="キズナ ") & (df.sex=="牡") & (((df.course.isin(turf_b_list))) | (df.race_type=="ダート")), "blood_point"] +1
-        df.loc[(df.父=="アドマイヤムーン ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="アドマイヤムーン ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] +1
-        df.loc[(df.父=="ジャスタウェイ ") & ((df.sex=="牡") & (df.course.isin(turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="ジャスタウェイ ") & ((df.sex=="牡") & (df.course.isin(turf_c_list))), "blood_point"] +1
-        df.loc[(df.父=="エピファネイア ") & ((df.sex=="牝") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="エピファネイア ") & ((df.sex=="牝") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] +2
-        df.loc[(df.父=="エピファネイア ") & ((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] = \
-            df.loc[(df.父=="エピファネイア ") & ((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))), "blood_point"] +1
-        df.loc[(df.父=="ドリームジャーニー ") & ((df.sex=="牡") & (df.course.isin(turf_c_list+turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="ドリームジャーニー ") & ((df.sex=="牡") & (df.course.isin(turf_c_list+turf_d_list))), "blood_point"] +1
-        df.loc[(df.父=="ジャングルポケット ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] = \
-            df.loc[(df.父=="ジャングルポケット ") & ((df.sex=="牡") & (df.course.isin(turf_a_list+turf_d_list))), "blood_point"] +1
-        df.loc[(df.父=="メイショウサムソン ") & (df.course.isin(turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="メイショウサムソン ") & (df.course.isin(turf_d_list)), "blood_point"] +1
-        df.loc[(df.父=="ワークフォース Workforce(英) ") & (df.course.isin(turf_c_list)), "blood_point"] = \
-            df.loc[(df.父=="ワークフォース Workforce(英) ") & (df.course.isin(turf_c_list)), "blood_point"] +1
-        df.loc[(df.父=="マツリダゴッホ ") & ((df.sex=="牝") & (df.course.isin(turf_a_list))), "blood_point"] = \
-            df.loc[(df.父=="マツリダゴッホ ") & ((df.sex=="牝") & (df.course.isin(turf_a_list))), "blood_point"] +2
-        df.loc[(df.父=="マツリダゴッホ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] = \
-            df.loc[(df.父=="マツリダゴッホ ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_d_list))) | ((df.sex=="牝") & (df.course.isin(turf_b_list)))), "blood_point"] +1
-        df.loc[(df.父=="ゴールドアリュール ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="ゴールドアリュール ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] +2
-        df.loc[(df.父=="ゴールドアリュール ") & (df.sex=="牝") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="ゴールドアリュール ") & (df.sex=="牝") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="クロフネ ") & (df.sex=="牝") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="クロフネ ") & (df.sex=="牝") & (df.race_type=="ダート"), "blood_point"] +2
-        df.loc[(df.父=="クロフネ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="クロフネ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="サウスヴィグラス ") & (df.course.isin(dart_a_list)), "blood_point"] = \
-            df.loc[(df.父=="サウスヴィグラス ") & (df.course.isin(dart_a_list)), "blood_point"] +2
-        df.loc[(df.父=="ヘニーヒューズ Henny Hughes(米) ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ヘニーヒューズ Henny Hughes(米) ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] +2
-        df.loc[(df.父=="エンパイアメーカー Empire Maker(米) ") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="エンパイアメーカー Empire Maker(米) ") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="アイルハヴアナザー I\'ll Have Another(米) ") & (df.course.isin(dart_c_list)), "blood_point"] = \
-            df.loc[(df.父=="アイルハヴアナザー I\'ll Have Another(米) ") & (df.course.isin(dart_c_list)), "blood_point"] +1
-        df.loc[(df.父=="シニスターミニスター Sinister Minister(米) ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="シニスターミニスター Sinister Minister(米) ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="ネオユニヴァース ") & (df.sex=="牡") & (df.course.isin(dart_c_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ネオユニヴァース ") & (df.sex=="牡") & (df.course.isin(dart_c_list+dart_d_list)), "blood_point"] +1
-        df.loc[(df.父=="シンボリクリスエス ") & (df.sex=="牡") & (df.course.isin(dart_c_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="シンボリクリスエス ") & (df.sex=="牡") & (df.course.isin(dart_c_list+dart_d_list)), "blood_point"] +1
-        df.loc[(df.父=="メイショウボーラー ") & (df.sex=="牡") & (df.course.isin(dart_a_list)), "blood_point"] = \
-            df.loc[(df.父=="メイショウボーラー ") & (df.sex=="牡") & (df.course.isin(dart_a_list)), "blood_point"] +1
-        df.loc[(df.父=="カネヒキリ ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="カネヒキリ ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] +1
-        df.loc[(df.父=="パイロ Pyro(米) ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] = \
-            df.loc[(df.父=="パイロ Pyro(米) ") & (df.course.isin(dart_a_list+dart_d_list)), "blood_point"] +1
-        df.loc[(df.父=="スマートファルコン ") & (df.course.isin(dart_c_list)), "blood_point"] = \
-            df.loc[(df.父=="スマートファルコン ") & (df.course.isin(dart_c_list)), "blood_point"] +1
-        df.loc[(df.父=="ドゥラメンテ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="ドゥラメンテ ") & (df.course.isin(turf_a_list+turf_d_list)), "blood_point"] +2
-        df.loc[(df.父=="ドゥラメンテ ") & (df.course.isin(turf_b_list)), "blood_point"] = \
-            df.loc[(df.父=="ドゥラメンテ ") & (df.course.isin(turf_b_list)), "blood_point"] -1
-        df.loc[(df.父=="ドゥラメンテ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] = \
-            df.loc[(df.父=="ドゥラメンテ ") & (df.sex=="牡") & (df.race_type=="ダート"), "blood_point"] +1
-        df.loc[(df.父=="モーリス ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] = \
-            df.loc[(df.父=="モーリス ") & (((df.sex=="牡") & (df.course.isin(turf_b_list+turf_c_list))) | ((df.sex=="牝") & (df.course.isin(turf_a_list)))), "blood_point"] +2
-        df.loc[(df.父=="モーリス ") & (df.course.isin(turf_d_list)), "blood_point"] = \
-            df.loc[(df.父=="モーリス ") & (df.course.isin(turf_d_list)), "blood_point"] -1
-        df.loc[(df.父=="ダノンレジェンド ") & (df.course.isin(dart_a_list+dart_b_list)), "blood_point"] = \
-            df.loc[(df.父=="ダノンレジェンド ") & (df.course.isin(dart_a_list+dart_b_list)), "blood_point"] +2
-        df.loc[((df.母父_米国型=="1") | (df.母母父_米国型=="1") | (df.非サンデー馬=="1")) & (df.course.isin(turf_a_list)), "blood_point"] =\
-            df.loc[((df.母父_米国型=="1") | (df.母母父_米国型=="1") | (df.非サンデー馬=="1")) & (df.course.isin(turf_a_list)), "blood_point"] +1
-        df.loc[((df.父_米国型=="1") | (df.父_欧州型=="1") | (df.非サンデー馬=="1") | (df.母父_日本型=="1")) & (df.course.isin(turf_b_list)), "blood_point"] =\
-            df.loc[((df.母父_米国型=="1") | (df.母母父_米国型=="1") | (df.非サンデー馬=="1") | (df.母父_日本型=="1")) & (df.course.isin(turf_b_list)), "blood_point"] +1
-        df.loc[((df.欧州A=="1") | (df.欧州B=="1")) & (df.course.isin(turf_c_list)), "blood_point"] =\
-            df.loc[((df.欧州A=="1") | (df.欧州B=="1")) & (df.course.isin(turf_c_list)), "blood_point"] +1
-        df.loc[((df.母父_欧州型=="1") | (df.母母父_欧州型=="1")) & (df.父_日本型=="1") & (df.course.isin(turf_d_list)), "blood_point"] =\
-            df.loc[((df.母父_欧州型=="1") | (df.母父_欧州型=="1")) & (df.父_日本型=="1") & (df.course.isin(turf_d_list)), "blood_point"] +1
-        df.loc[((df.米国A=="1") | (df.米国B=="1") | (df.非サンデー馬=="1")) & (df.course.isin(dart_a_list)), "blood_point"] =\
-            df.loc[((df.米国A=="1") | (df.米国B=="1") | (df.父_米国型=="1")) & (df.course.isin(dart_a_list)), "blood_point"] +1
-        df.loc[((df.欧州A=="1") | (df.父_母父_ディープ=="1")) & (df.course.isin(dart_a_list)), "blood_point"] =\
-            df.loc[((df.欧州A=="1") | (df.父_母父_ディープ=="1")) & (df.course.isin(dart_a_list)), "blood_point"] -1
-        df.loc[((df.父_母父_ディープ=="1") | (df.父_母父_キングマンボ系=="1") | (df.母父_大系統ナスルーラ=="1")) & (df.course.isin(dart_b_list)), "blood_point"] =\
-            df.loc[((df.父_母父_ディープ=="1") | (df.父_母父_キングマンボ系=="1") | (df.母父_大系統ナスルーラ=="1")) & (df.course.isin(dart_b_list)), "blood_point"] +1
-        df.loc[((df.父_日本型=="1") | (df.父_欧州型=="1") | (df.母父_ニジンスキー系=="1")) & (df.course.isin(dart_c_list)), "blood_point"] =\
-            df.loc[((df.父_日本型=="1") | (df.父_欧州型=="1") | (df.母父_ニジンスキー系=="1")) & (df.course.isin(dart_c_list)), "blood_point"] +1
-        df.loc[((df.欧州B=="1") | (df.父_大系統ナスルーラ=="1") | (df.父_サドラー系=="1")) & (df.course.isin(dart_d_list)), "blood_point"] =\
-            df.loc[((df.欧州B=="1") | (df.父_大系統ナスルーラ=="1") | (df.父_サドラー系=="1")) & (df.course.isin(dart_d_list)), "blood_point"] +1
-        df.loc[(df.sex=="牝") & (df.course.isin(turf_c_list)), "blood_point"] =\
-            df.loc[(df.sex=="牝") & (df.course.isin(turf_c_list)), "blood_point"] -1
-        df.loc[(df.sex=="牝") & (df.course.isin(dart_d_list)), "blood_point"] =\
-            df.loc[(df.sex=="牝") & (df.course.isin(dart_d_list)), "blood_point"] -1
-        pace_down_list = ["ディープインパクト ", "エピファネイア ", "ルーラーシップ ", "パイロ Pyro(米) ", "トゥザグローリー ",\
-                         "ノヴェリスト Novellist(愛) ", "ヨハネスブルグ Johannesburg(米) ", "ハービンジャー Harbinger(英) ",\
-                         "ネオユニヴァース ", "ワールドエース ", "ジャスタウェイ "]
-        pace_up_list = ["キングカメハメハ ", "ロードカナロア ", "ドゥラメンテ ", "サウスヴィグラス ", "カジノドライヴ ",\
-                       "アイルハヴアナザー I\'ll Have Another(米) ", "エンパイアメーカー Empire Maker(米) ", "ベルシャザール ",\
-                       "エスケンデレヤ ", "タートルボウル Turtle Bowl(愛) ", "スクリーンヒーロー ", "モーリス "]
-        df.loc[(df.今回距離変化 < 0) & (df.父.isin(pace_down_list)), "blood_point"] = \
-            df.loc[(df.今回距離変化 < 0) & (df.父.isin(pace_down_list)), "blood_point"] +2
-        df.loc[(df.今回距離変化 < 0) & (df.父.isin(pace_up_list)), "blood_point"] = \
-            df.loc[(df.今回距離変化 < 0) & (df.父.isin(pace_up_list)), "blood_point"] -2
-        df.loc[(df.今回距離変化 > 0) & (df.父.isin(pace_up_list)), "blood_point"] = \
-            df.loc[(df.今回距離変化 > 0) & (df.父.isin(pace_up_list)), "blood_point"] +2
-        df.loc[(df.今回距離変化 > 0) & (df.父.isin(pace_down_list)), "blood_point"] = \
-            df.loc[(df.今回距離変化 > 0) & (df.父.isin(pace_down_list)), "blood_point"] -2
-        df.loc[(df.前走距離変化 > 0) & (df.今回距離変化 == 0) & (df.父.isin(pace_down_list)), "blood_point"] = \
-            df.loc[(df.前走距離変化 > 0) & (df.今回距離変化 == 0) & (df.父.isin(pace_down_list)), "blood_point"] +1
-        df.loc[(df.今回間隔 > "65 days") & (df.父.isin(pace_down_list)), "blood_point"] =\
-            df.loc[(df.今回間隔 > "65 days") & (df.父.isin(pace_down_list)), "blood_point"] +1
-        df.loc[(df.前走間隔 > "65 days") & (df.着順_1走前 <= 5) & (df.今回間隔 < "40 days") & (df.父.isin(pace_down_list)), "blood_point"] =\
-            df.loc[(df.前走間隔 > "65 days") & (df.着順_1走前 <= 5) & (df.今回間隔 < "40 days") & (df.父.isin(pace_down_list)), "blood_point"] -1
-        df.loc[(df.今回間隔 > "65 days") & (df.父.isin(pace_up_list)), "blood_point"] =\
-            df.loc[(df.今回間隔 > "65 days") & (df.父.isin(pace_up_list)), "blood_point"] -1
-        df.loc[(df.前走間隔 > "65 days") & (df.着順_1走前 <= 9) & (df.今回間隔 < "40 days") & (df.父.isin(pace_up_list)), "blood_point"] =\
-            df.loc[(df.前走間隔 > "65 days") & (df.着順_1走前 <= 9) & (df.今回間隔 < "40 days") & (df.父.isin(pace_up_list)), "blood_point"] +1
+        df["advantage_point"] = self._rule_points(df, ["馬番", "course"], self._gate_rules)
+        df["advantage_point"] += - 2 * ((df.前走距離変化 > 0) & (df.着順_1走前 <=3)) \
+            + 1 * ((df.前々走距離変化 > 0) & (df.着順_2走前 <= 3) & (df.着順_1走前 >= 5)) \
+            - 1 * ((df.race_type == "芝") & (df.馬番_1走前 <=5) & (df.着順_1走前 <=4) & (df.馬番 >= 14)) \
+            - 1 * ((df.race_type == "ダート") & (df.馬番 <=5) & (df.着順_1走前 <=3 ) & (df.馬番_1走前 >=14)) \
+            - 1 * ((df.first_corner_1走前==1) & (df.着順_1走前==1))
+        season = df["実績季節"].fillna(0).astype(np.uint8).values & df["季節"].astype(object).map(SEASON_BITS).fillna(0).astype(np.uint8).values
+        df["advantage_point"] += 1 * (season != 0)
         
-        df["advantage_point"] = 0
-        df.loc[(df.前走距離変化 > 0) & (df.着順_1走前 <=3), "advantage_point"] =\
-            df.loc[(df.前走距離変化 > 0) & (df.着順_1走前 <=3), "advantage_point"] -2
-        df.loc[(df.前々走距離変化 > 0) & (df.着順_2走前 <= 3) & (df.着順_1走前 >= 5), "advantage_point"] =\
-            df.loc[(df.前々走距離変化 > 0) & (df.着順_2走前 <= 3) & (df.着順_1走前 >= 5), "advantage_point"] +1
-        dart_gate_a_plus = ["01ダート1700", "02ダート1700", "05ダート1300", "05ダート1600", "07ダート1200", "07ダート1800"]
-        dart_gate_b_plus = ["02ダート1700", "05ダート1300", "07ダート1800"]
-        dart_gate_c_plus = ["05ダート1400", "05ダート2100", "07ダート1200"]
-        dart_gate_d_plus = ["05ダート2100", "09ダート1200", "09ダート1400"]
-        dart_gate_a_minus = ["03ダート1150", "03ダート1700", "04ダート1200", "05ダート2100", "07ダート1400", "08ダート1200",\
-                             "08ダート1400", "08ダート1800", "09ダート1200", "09ダート1400", "10ダート1000", "10ダート1700"]
-        dart_gate_c_minus = ["04ダート1800", "07ダート1800", "10ダート1000"]
-        dart_gate_d_minus = ["05ダート1600", "06ダート1800", "07ダート1200", "07ダート1800", "10ダート1700"]
-        df.loc[(df.馬番 <= 4) & (df.course.isin(dart_gate_a_plus)), "advantage_point"] =\
-            df.loc[(df.馬番 <= 4) & (df.course.isin(dart_gate_a_plus)), "advantage_point"] +1
-        df.loc[(df.馬番 <= 9) & (df.馬番 >= 5) & (df.course.isin(dart_gate_b_plus)), "advantage_point"] =\
-            df.loc[(df.馬番 <= 9) & (df.馬番 >= 5) & (df.course.isin(dart_gate_b_plus)), "advantage_point"] +1
-        df.loc[(df.馬番 <= 14) & (df.馬番 >= 10) & (df.course.isin(dart_gate_c_plus)), "advantage_point"] =\
-            df.loc[(df.馬番 <= 14) & (df.馬番 >= 10) & (df.course.isin(dart_gate_c_plus)), "advantage_point"] +1
-        df.loc[(df.馬番 >= 15) & (df.course.isin(dart_gate_d_plus)), "advantage_point"] =\
-            df.loc[(df.馬番 >= 15) & (df.course.isin(dart_gate_d_plus)), "advantage_point"] +1
-        df.loc[(df.馬番 <= 4) & (df.course.isin(dart_gate_a_minus)), "advantage_point"] =\
-            df.loc[(df.馬番 <= 4) & (df.course.isin(dart_gate_a_minus)), "advantage_point"] -1
-        df.loc[(df.馬番 <= 14) & (df.馬番 >= 10) & (df.course.isin(dart_gate_c_minus)), "advantage_point"] =\
-            df.loc[(df.馬番 <= 14) & (df.馬番 >= 10) & (df.course.isin(dart_gate_c_minus)), "advantage_point"] -1
-        df.loc[(df.馬番 >= 15) & (df.course.isin(dart_gate_d_minus)), "advantage_point"] =\
-            df.loc[(df.馬番 >= 15) & (df.course.isin(dart_gate_d_minus)), "advantage_point"] -1
-        df.loc[(df.race_type == "芝") & (df.馬番_1走前 <=5) & (df.着順_1走前 <=4) & (df.馬番 >= 14), "advantage_point"] =\
-            df.loc[(df.race_type == "芝") & (df.馬番_1走前 <=5) & (df.着順_1走前 <=4) & (df.馬番 >= 14), "advantage_point"] -1
-        df.loc[(df.race_type == "ダート") & (df.馬番 <=5) & (df.着順_1走前 <=3 ) & (df.馬番_1走前 >=14), "advantage_point"] =\
-            df.loc[(df.race_type == "ダート") & (df.馬番 <=5) & (df.着順_1走前 <=3 ) & (df.馬番_1走前 >=14), "advantage_point"] -1
-        df.loc[(df.first_corner_1走前==1) & (df.着順_1走前==1), "advantage_point"] =\
-            df.loc[(df.first_corner_1走前==1) & (df.着順_1走前==1), "advantage_point"] -1
-        df["実績季節"] = df["実績季節"].fillna("無し")
-        df.loc[df.apply(lambda x: x.季節 in x.実績季節, axis=1), "advantage_point"] =\
-            df.loc[df.apply(lambda x: x.季節 in x.実績季節, axis=1), "advantage_point"] +1
-        
-        self.merged_df = df.copy()
+        flags = [col for col in self.df.columns if self.df[col].dtype == np.uint8]
+        self.merged_df = self.schema.apply(df, "merged_df", flags=flags)
+
+    @profiled()
+    def _rule_points(self, df, keys, rules):
+        # keysの組み合わせをカテゴリにして、ルールはユニークな組み合わせの上でだけ評価する
+        if self.backend is not None and self.rule_memo is None:
+            return self.backend.rule_points(df, keys, rules.__name__)
+        codes = df.groupby(keys, dropna=False, sort=False, observed=True).ngroup().values
+        uniq = df[keys].iloc[np.unique(codes, return_index=True)[1]].reset_index(drop=True)
+        if self.rule_memo is None:
+            return self._eval_rules(uniq, rules)[codes]
+        # 常駐プロセスでは、評価済みの組み合わせの点数を使い回す
+        memo = self.rule_memo.setdefault(rules.__name__, {})
+        # キーの欠損（NaNはNaN自身と等しくならず、メモに当たらない）はNoneにそろえる
+        tuples = list(uniq.astype(object).where(uniq.notna(), None).itertuples(index=False, name=None))
+        missing = [i for i, t in enumerate(tuples) if t not in memo]
+        if missing:
+            for i, point in zip(missing, self._eval_rules(uniq.iloc[missing].reset_index(drop=True), rules)):
+                memo[tuples[i]] = point
+        return np.array([memo[t] for t in tuples], dtype=np.int64)[codes]
+
+    def _eval_rules(self, uniq, rules):
+        points = np.zeros(len(uniq), dtype=np.int64)
+        for _, cond, delta in PROFILER.iterate(rules(uniq), rules.__name__ + ":"):
+            points += delta * np.asarray(cond, dtype=bool)
+        return points
+
+    def _course_in(self, uniq, courses):
+        cond = pd.Series(False, index=uniq.index)
+        for course in courses:
+            if course in COURSE_CLASSES:
+                cond |= uniq.course.isin(COURSE_CLASSES[course])
+            elif course in ("芝", "ダート", "障害"):
+                cond |= uniq.race_type == course
+            else:
+                cond |= uniq.course == course
+        return cond
+
+    def _blood_rules(self, uniq):
+        for sire, conditions, delta in BLOOD_RULES:
+            cond = pd.Series(False, index=uniq.index)
+            for sex, courses in conditions:
+                cond |= self._course_in(uniq, courses) & ((uniq.sex == sex) if sex is not None else True)
+            if sire is not None:
+                cond &= uniq.父 == sire
+            yield (sire or "性別").strip(), cond, delta
+        for any_flags, all_flags, courses, delta in pedigree_rules(uniq.columns):
+            cond = pd.concat([uniq[f] == 1 for f in any_flags], axis=1).any(axis=1)
+            for f in all_flags:
+                cond &= uniq[f] == 1
+            yield "+".join(any_flags + all_flags), cond & self._course_in(uniq, courses), delta
+
+    def _gate_rules(self, uniq):
+        for low, high, courses, delta in GATE_RULES:
+            cond = uniq.course.isin(courses)
+            if low is not None:
+                cond &= uniq.馬番 >= low
+            if high is not None:
+                cond &= uniq.馬番 <= high
+            yield "馬番%s-%s" % (low or "", high or ""), cond, delta
         
+    @profiled(out="pointed")
     def point(self):
         df = self.merged_df.copy()
-        df["jockey_point"] = 0
-        df["trainer_point"] = 0
-        plus_trainer_list = ["01148","01092","01075","00438","01105","01086","01002","01126"]
-        plus_jockey_list = ["01126","05339","01014","01075","01088","01102","01093","05386","00666"]
-        df.loc[df.jockey_id.isin(plus_jockey_list), "jockey_point"] =\
-            df.loc[df.jockey_id.isin(plus_jockey_list), "jockey_point"] +2
-        df.loc[df.trainer_id.isin(plus_trainer_list), "trainer_point"] =\
-            df.loc[df.trainer_id.isin(plus_trainer_list), "trainer_point"] +2
-        df["実績騎手"] = df["実績騎手"].fillna("無し")
-        df.loc[df.apply(lambda x: x.jockey_id in x.実績騎手, axis=1), "jockey_point"] =\
-            df.loc[df.apply(lambda x: x.jockey_id in x.実績騎手, axis=1), "jockey_point"] +2
+        # その日より前の連対率が高い騎手・調教師に加点（成績の列が無ければ0点）
+        for prefix, col in (("騎手", "jockey_point"), ("調教師", "trainer_point")):
+            starts, places = df.get(prefix + "_出走", 0), df.get(prefix + "_連対", 0)
+            df[col] = 2 * ((starts >= CAMP_MIN_STARTS) & (places >= CAMP_MIN_RATE * starts))
+        df["jockey_point"] += 2 * (df["実績騎手"].fillna(0) > 0)
 
         df["着差_point"] = 0
         df.loc[df.着差_1走前 <= (-0.3), "着差_point"] =\
@@ -553,9 +1297,9 @@ class Peds:
         df.loc[df.着差_1走前 >= 1, "着差_point"] =\
             df.loc[df.着差_1走前 >= 1, "着差_point"] -2
 
-        df["上り_1走前"].fillna(0, inplace=True)
-        df["上り_2走前"].fillna(0, inplace=True)
-        df["上り_3走前"].fillna(0, inplace=True)
+        df["上り_1走前"] = df["上り_1走前"].fillna(0)
+        df["上り_2走前"] = df["上り_2走前"].fillna(0)
+        df["上り_3走前"] = df["上り_3走前"].fillna(0)
         df["上り_ave"] = (df["上り_1走前"] + df["上り_2走前"] + df["上り_3走前"]) / 3
 
         df["着順_point"] = 0
@@ -582,42 +1326,915 @@ class Peds:
         df.loc[(df.実質着順_3走前 < 0.3), "着順_point"] =\
             df.loc[(df.実質着順_3走前 < 0.3), "着順_point"] -2
         
-        df["blood_point"].fillna(0, inplace=True)
+        df["blood_point"] = df["blood_point"].fillna(0)
         df["camp"] = df["jockey_point"] + df["trainer_point"]
-        df = pd.merge(df, df.groupby("race_id")[["blood_point", "着差_point", "着順_point", "camp", "上り_ave"]].mean().rename(columns={"blood_point":"blood_point_race_ave",\
-                                        "着差_point":"着差_race_ave", "着順_point":"着順_race_ave", "camp":"camp_race_ave", "上り_ave":"上り_race_ave"}), on="race_id", how="left")
-        df = pd.merge(df, df.groupby("race_id")[["blood_point", "着差_point", "着順_point", "camp", "上り_ave"]].std().rename(columns={"blood_point":"blood_point_race_std",\
-                                        "着差_point":"着差_race_std", "着順_point":"着順_race_std", "camp":"camp_race_std", "上り_ave":"上り_race_std"}), on="race_id", how="left")
-        df["blood_point_race_std"] = df["blood_point_race_std"].replace(0)
-        df["bld_point"] = df.apply(lambda x: (x.blood_point - x.blood_point_race_ave) / x.blood_point_race_std, axis=1)
-        df["着差_race_std"] = df["着差_race_std"].replace(0)
-        df["lead_point"] = df.apply(lambda x: (x.着差_point - x.着差_race_ave) / x.着差_race_std, axis=1)
-        df["着順_race_std"] = df["着順_race_std"].replace(0)
-        df["rank_point"] = df.apply(lambda x: (x.着順_point - x.着順_race_ave) / x.着順_race_std, axis=1)
-        df["camp_race_std"] = df["camp_race_std"].replace(0)
-        df["camp_point"] = df.apply(lambda x: (x.camp - x.camp_race_ave) / x.camp_race_std, axis=1)
-        df["上り_race_std"] = df["上り_race_std"].replace(0)
-        df["agari_point"] = df.apply(lambda x: (x.上り_ave - x.上り_race_ave) / x.上り_race_std, axis=1)
+        z = (self.backend or self).race_z(df, ["blood_point", "着差_point", "着順_point", "camp", "上り_ave"])
+        df["bld_point"] = z["blood_point"]
+        df["lead_point"] = z["着差_point"]
+        df["rank_point"] = z["着順_point"]
+        df["camp_point"] = z["camp"]
+        df["agari_point"] = z["上り_ave"]
         df["point_all"] = df["bld_point"] + df["lead_point"] + df["rank_point"] + df["agari_point"] + df["camp_point"] + df["advantage_point"]
         
         df = df.set_index("race_id")
         df = df[['着順', 'race_type', '馬番', 'bld_point', 'lead_point', 'rank_point', 'agari_point', 'camp_point', 'advantage_point', 'point_all']]
         
         self.pointed = df.copy()
+
+    def race_z(self, df, columns):
+        # レースごとの標準化（平均0・標準偏差1）。全頭同じ値（std=0）のレースは0、1頭立て（std=NaN）はNaN
+        g = df.groupby("race_id")[columns]
+        mean = g.transform("mean")
+        std = g.transform("std")
+        return ((df[columns] - mean) / std).where(std != 0, 0.0)
     
 
-df = Peds.pointed.copy()
-df["quinella"] = df["着順"].map(lambda x: 1 if x <= 2 else 0)
-train_data = df.drop(columns={"quinella", "馬番"})
-y = df_quinella["quinella"]
-X = train_data
-X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=0.3, random_state=1234)
-
-clf = RandomForestClassifier(random_state=1234)
-clf.fit(X_train, y_train)
-fi = clf.feature_importances_
-print("score=", clf.score(X_test, y_test))
-idx = np.argsort(fi)[::-1]
-top_cols, top_importances = X_train.columns.values[idx], fi[idx]
-print("random forest importance")
-print(top_cols, top_importances)
\ No newline at end of file
+class PolarsBackend:
+    # Results・Pedsの重い段をPolarsのLazyFrameで回す実装（Results(backend=...)・Peds(backend=...)に渡す）。
+    # 過去走の結合・系統の文字列判定・コース/血統ルールの点数・レース内の標準化を1本の遅延クエリにして、
+    # Polarsの最適化とマルチスレッドに任せる。出力はpandasの実装と同じ列・同じ並びのpandasのフレーム（cross_checkで確かめる）
+    def __init__(self, streaming=False):
+        import polars  # noqa: F401  Polarsが無ければここで落とす
+        self.engine = "streaming" if streaming else "auto"
+
+    def _lazy(self, df, columns):
+        # 使う列だけPolarsにする。カテゴリは文字列に戻す（フレームをまたいだ結合・比較のため）
+        import polars as pl
+        df = df[[c for c in dict.fromkeys(columns) if c in df.columns]]
+        cats = [c for c in df.columns if isinstance(df[c].dtype, pd.CategoricalDtype)]
+        return pl.from_pandas(df).lazy().with_columns([pl.col(c).cast(pl.String) for c in cats])
+
+    def _asof(self, left, right, by, values):
+        # leftの各行について、同じbyのrightの行のうち日付がその日より前で最新の行の値（Noneは該当なし）
+        # 両方とも日付で並べ直してから結合する（byがあるとPolarsは並びを確かめられないので確認は切る）
+        return (left.sort("date").join_asof(right.sort("date"), on="date", by=by, allow_exact_matches=False, check_sortedness=False)
+                .select(["_row"] + values))
+
+    @profiled()
+    def asof_merge(self, results, hr, performance_by=()):
+        # Results.asof_merge(Results.camp_stats(results, ...), hr)と同じもの
+        import polars as pl
+        source = results
+        results = results.loc[results["date"].notna()]
+        date_codes, _ = pd.factorize(results["date"], sort=False)
+        order = np.argsort(date_codes, kind="stable")
+        merged = results.iloc[order].reset_index(drop=True)
+        date_codes = date_codes[order]
+        by = list(performance_by)
+        hr = hr if "horse_id" in hr.columns else hr.reset_index()
+        lag_cols = list(dict.fromkeys(c for cols in LAG_COLS.values() for c in cols))
+
+        R = self._lazy(merged, ["horse_id", "jockey_id", "trainer_id", "date", "course_len"] + by).with_row_index("_row")
+        H = (self._lazy(hr, ["horse_id", "jockey_id", "競馬場", "着順", "季節"] + by + lag_cols).with_row_index("_pos")
+             .filter(pl.col("date").is_not_null()))
+        jra = H.filter(pl.col("競馬場").is_in(list(KEIBAJO_CODES.values())))
+        placed = jra.filter((pl.col("着順") == 1) | (pl.col("着順") == 2))
+        parts = []
+
+        # 騎手・調教師の成績（PerformanceIndexと同じく、同じ馬・同じ日の出走は1回だけ、着順のある行・後の行を優先して数える）
+        performance = [("騎手", H, "jockey_id")]
+        if "trainer_id" in merged.columns:
+            performance.append(("調教師", self._lazy(source, ["horse_id", "trainer_id", "date", "着順"] + by)
+                                .filter(pl.col("date").is_not_null()), "trainer_id"))
+        for prefix, runs, key in performance:
+            names = [prefix + "_出走", prefix + "_勝利", prefix + "_連対"]
+            stats = (runs.filter(pl.col(key).is_not_null()).with_row_index("_n")
+                     .sort([pl.col("着順").is_not_null(), "_n"]).unique(["horse_id", "date"], keep="last")
+                     .group_by([key] + by + ["date"])
+                     .agg(pl.len().cast(pl.Int64).alias(names[0]), (pl.col("着順") == 1).fill_null(False).cast(pl.Int64).sum().alias(names[1]),
+                          (pl.col("着順") <= 2).fill_null(False).cast(pl.Int64).sum().alias(names[2]))
+                     .sort("date").with_columns([pl.col(n).cum_sum().over([key] + by) for n in names]))
+            parts.append(self._asof(R, stats, [key] + by, names).with_columns([pl.col(n).fill_null(0) for n in names]))
+
+        # 出走回数・実績季節・実績騎手
+        count = H.group_by(["horse_id", "date"]).agg(pl.len().cast(pl.Int64).alias("出走回数")).sort("date") \
+            .with_columns(pl.col("出走回数").cum_sum().over("horse_id"))
+        parts.append(self._asof(R, count, ["horse_id"], ["出走回数"]))
+        seasons = placed.group_by(["horse_id", "date"]) \
+            .agg([(pl.col("季節") == name).max().cast(pl.UInt8).alias(name) for name in SEASON_BITS]).sort("date") \
+            .with_columns([pl.col(name).cum_max().over("horse_id") for name in SEASON_BITS])
+        seasons = seasons.with_columns(pl.sum_horizontal([pl.col(name) * bit for name, bit in SEASON_BITS.items()]).cast(pl.UInt8).alias("実績季節"))
+        parts.append(self._asof(R, seasons, ["horse_id"], ["実績季節"]).with_columns(pl.col("実績季節").fill_null(0)))
+        pairs = placed.group_by(["horse_id", "jockey_id", "date"]).agg(pl.len().cast(pl.Int64).alias("実績騎手")).sort("date") \
+            .with_columns(pl.col("実績騎手").cum_sum().over(["horse_id", "jockey_id"]))
+        parts.append(self._asof(R, pairs, ["horse_id", "jockey_id"], ["実績騎手"]).with_columns(pl.col("実績騎手").fill_null(0)))
+
+        # N走前: JRAの戦績を馬ごとに（日付, 元の並びの逆順）で番号付けし、その日より前の最後の番号から数える
+        jra = jra.sort(["horse_id", "date", "_pos"], descending=[False, False, True]) \
+            .with_columns(pl.int_range(pl.len()).over("horse_id").alias("_idx"))
+        last = jra.group_by(["horse_id", "date"]).agg(pl.col("_idx").max().alias("_last"))
+        lagged = self._asof(R.select(["_row", "horse_id", "date"]), last, ["horse_id"], ["horse_id", "_last"])
+        for n, cols in LAG_COLS.items():
+            right = jra.select(["horse_id", "_idx"] + [pl.col(c).alias("%s_%d走前" % (c, n)) for c in cols])
+            lagged = lagged.with_columns((pl.col("_last") - (n - 1)).alias("_idx")) \
+                .join(right, on=["horse_id", "_idx"], how="left").drop("_idx")
+        lagged = lagged.join(R.select(["_row", "date", "course_len"]), on="_row", how="left")
+        lagged = lagged.with_columns(
+            (pl.col("distance_3走前") - pl.col("distance_2走前")).alias("前々走距離変化"),
+            (pl.col("distance_2走前") - pl.col("distance_1走前")).alias("前走距離変化"),
+            (pl.col("distance_1走前") - pl.col("course_len")).alias("今回距離変化"),
+            (pl.col("date_2走前") - pl.col("date_3走前")).alias("前々走間隔"),
+            (pl.col("date_1走前") - pl.col("date_2走前")).alias("前走間隔"),
+            (pl.col("date") - pl.col("date_1走前")).alias("今回間隔")).drop(["horse_id", "_last", "date", "course_len"])
+        parts.append(lagged)
+
+        out = R.select("_row")
+        for part in parts:
+            out = out.join(part, on="_row", how="left")
+        out = out.sort("_row").drop("_row").collect(engine=self.engine).to_pandas()
+        for col in out.columns:
+            merged[col] = out[col].values
+        merged.index = pd.Series(date_codes).groupby(date_codes).cumcount().values
+        return merged
+
+    def contains(self, names, patterns):
+        # 祖先名×パターンの一致（Peds._lineage_tableの正規表現判定）。パターンごとの判定を1回のselectにまとめる
+        import polars as pl
+        frame = pl.DataFrame({"name": pd.Series(names, dtype=object).values}).lazy()
+        hits = frame.select([pl.col("name").str.contains(p).fill_null(False).alias(str(i)) for i, p in enumerate(patterns)]) \
+            .collect(engine=self.engine)
+        return {p: hits[str(i)].to_numpy() for i, p in enumerate(patterns)}
+
+    def _course_in(self, courses):
+        import polars as pl
+        cond = pl.lit(False)
+        for course in courses:
+            if course in COURSE_CLASSES:
+                cond = cond | pl.col("course").is_in(COURSE_CLASSES[course])
+            elif course in ("芝", "ダート", "障害"):
+                cond = cond | (pl.col("race_type") == course)
+            else:
+                cond = cond | (pl.col("course") == course)
+        return cond
+
+    def _blood_rules(self, columns):
+        import polars as pl
+        for sire, conditions, delta in BLOOD_RULES:
+            cond = pl.lit(False)
+            for sex, courses in conditions:
+                cond = cond | (self._course_in(courses) & ((pl.col("sex") == sex) if sex is not None else pl.lit(True)))
+            if sire is not None:
+                cond = cond & (pl.col("父") == sire)
+            yield cond, delta
+        for any_flags, all_flags, courses, delta in pedigree_rules(columns):
+            cond = pl.any_horizontal([pl.col(f) == 1 for f in any_flags])
+            for f in all_flags:
+                cond = cond & (pl.col(f) == 1)
+            yield cond & self._course_in(courses), delta
+
+    def _gate_rules(self, columns):
+        import polars as pl
+        for low, high, courses, delta in GATE_RULES:
+            cond = pl.col("course").is_in(courses)
+            if low is not None:
+                cond = cond & (pl.col("馬番") >= low)
+            if high is not None:
+                cond = cond & (pl.col("馬番") <= high)
+            yield cond, delta
+
+    def rule_points(self, df, keys, rules):
+        # Peds._rule_pointsと同じ点数。ルール表を式にして、全部の行で1回のselectで足す（nullの条件は外れ）
+        import polars as pl
+        exprs = [pl.when(cond.fill_null(False)).then(delta).otherwise(0) for cond, delta in getattr(self, rules)(keys)]
+        points = self._lazy(df, keys).select(pl.sum_horizontal(exprs).cast(pl.Int64).alias("point")).collect(engine=self.engine)
+        return points["point"].to_numpy()
+
+    def race_z(self, df, columns):
+        # Peds.race_zと同じ（std=0のレースは0、1頭立てはNaN）
+        import polars as pl
+        z = self._lazy(df, ["race_id"] + columns).select([
+            pl.when(pl.col(c).std().over("race_id") == 0).then(0.0)
+            .otherwise((pl.col(c) - pl.col(c).mean().over("race_id")) / pl.col(c).std().over("race_id")).alias(c)
+            for c in columns]).collect(engine=self.engine).to_pandas()
+        z.index = df.index
+        return z.astype(float)
+
+
+def cross_check(results, horse_results, peds, backend=None, performance_by=(), rtol=1e-9):
+    # 同じ入力をpandasの実装とbackend（既定はPolarsBackend）で回し、段ごと・列ごとの食い違いを返す（mismatchesが全部0なら一致）
+    backend = backend if backend is not None else PolarsBackend()
+    frames = []
+    for b in (None, backend):
+        r = Results(performance_by=performance_by, backend=b)
+        r.p_p(results)
+        r.merge(horse_results)
+        p = Peds(backend=b)
+        p.peds = peds
+        p.p_p()
+        p.merge(r.merged)
+        p.point()
+        frames.append({"merged": r.merged, "peds": p.df, "merged_df": p.merged_df, "pointed": p.pointed})
+    rows = []
+    for stage, expected in frames[0].items():
+        actual = frames[1][stage]
+        for col in expected.columns.union(actual.columns, sort=False):
+            if col not in expected.columns or col not in actual.columns or len(expected) != len(actual):
+                rows.append({"stage": stage, "column": col, "mismatches": max(len(expected), len(actual)), "max_abs_diff": np.nan})
+                continue
+            a, b = expected[col], actual[col]
+            if pd.api.types.is_timedelta64_dtype(a) or pd.api.types.is_datetime64_any_dtype(a):
+                a, b = a.astype("int64").where(a.notna()), b.astype("int64").where(b.notna())
+            if pd.api.types.is_numeric_dtype(a) and pd.api.types.is_numeric_dtype(b) and not pd.api.types.is_bool_dtype(a):
+                a, b = a.astype(float).values, b.astype(float).values
+                same = np.isclose(a, b, rtol=rtol, atol=rtol) | (np.isnan(a) & np.isnan(b))
+                diff = np.nanmax(np.abs(a - b)) if (~np.isnan(a - b)).any() else 0.0
+            else:
+                a, b = a.astype(object).values, b.astype(object).values
+                same = (a == b) | (pd.isna(a) & pd.isna(b))
+                diff = np.nan
+            rows.append({"stage": stage, "column": col, "mismatches": int((~same).sum()), "max_abs_diff": diff})
+        rows.append({"stage": stage, "column": "<index>", "mismatches": int((expected.index != actual.index).sum())
+                     if len(expected) == len(actual) else max(len(expected), len(actual)), "max_abs_diff": np.nan})
+    return pd.DataFrame(rows)
+
+
+class ParallelPipeline:
+    # 戦績が決まっていれば開催日ごとに独立なので、resultsを開催日の塊に分けて
+    # asof_merge → Peds.merge → Peds.point をプロセスごとに回し、元の順番でつなぐ（直列と同じ結果）
+    def __init__(self, n_jobs=None, n_shards=None):
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.n_shards = n_shards or self.n_jobs
+
+    @profiled()
+    def run(self, results, peds):
+        # results: p_pとmergeを済ませたResults（hrを使う）、peds: p_pを済ませたPeds
+        # 騎手・調教師の成績は全体の戦績で引いてから塊に分ける（塊の中の戦績は、その塊の馬の分しか無い）
+        shards = self.shards(results.camp_stats(results.results, results.performance_indexes(results.hr, results.results)))
+        # 戦績と血統はArrowのファイルに書いて、各プロセスはメモリマップで読む
+        hr_cols = sorted(set(HISTORY_COLS) | {c for cols in LAG_COLS.values() for c in cols}, key=list(results.hr.columns).index)
+        with tempfile.TemporaryDirectory() as tmp:
+            hr_path = self._write(results.hr[hr_cols], os.path.join(tmp, "hr.arrow"))
+            peds_path = self._write(peds.df, os.path.join(tmp, "peds.arrow"))
+            with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+                parts = list(progress(pool.map(ParallelPipeline._run_shard, shards, [hr_path] * len(shards), [peds_path] * len(shards)),
+                                      desc="shards", total=len(shards)))
+        flags = [col for col in peds.df.columns if peds.df[col].dtype == np.uint8]
+        results.merged = results.schema.apply(pd.concat([m for m, _, _ in parts]), "merged")
+        peds.merged_df = peds.schema.apply(pd.concat([m for _, m, _ in parts], ignore_index=True), "merged_df", flags=flags)
+        peds.pointed = peds.schema.apply(pd.concat([pt for _, _, pt in parts]), "pointed")
+
+    def shards(self, results):
+        # 開催日は出てきた順（asof_mergeの並び）のまま、行数がだいたい同じになるように切る
+        results = results.loc[results["date"].notna()]
+        codes, dates = pd.factorize(results["date"], sort=False)
+        n = min(self.n_shards, len(dates))
+        sizes = np.cumsum(np.bincount(codes, minlength=len(dates)))
+        bounds = np.searchsorted(sizes, np.arange(1, n) * len(results) / n)
+        return [results.loc[np.isin(codes, part)] for part in np.split(np.arange(len(dates)), np.unique(bounds)) if len(part)]
+
+    def _write(self, df, path):
+        import pyarrow as pa
+        table = pa.Table.from_pandas(df, preserve_index=True)
+        with pa.OSFile(path, "wb") as sink:
+            with pa.ipc.new_file(sink, table.schema) as writer:
+                writer.write_table(table)
+        return path
+
+    @staticmethod
+    def _read(path, horse_ids):
+        # メモリマップしたArrowの表を、この塊に出てくる馬の行だけに絞ってからpandasにする
+        # （表全体をpandasにしないので、プロセスごとに持つのは塊の分だけ）
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        with pa.memory_map(path) as source:
+            table = pa.ipc.open_file(source).read_all()
+            ids = pa.array(pd.unique(np.asarray(horse_ids, dtype=object))).cast(table.schema.field("horse_id").type)
+            return table.filter(pc.is_in(table["horse_id"], value_set=ids)).to_pandas()
+
+    @staticmethod
+    def _run_shard(results, hr_path, peds_path):
+        r = Results()
+        hr = ParallelPipeline._read(hr_path, results["horse_id"].values)
+        r.merged = r.schema.apply(r.asof_merge(results, hr), "merged")
+        p = Peds()
+        p.df = ParallelPipeline._read(peds_path, results["horse_id"].values)
+        p.merge(r.merged)
+        p.point()
+        return r.merged, p.merged_df, p.pointed
+
+
+class ScoringService:
+    # 出馬表を受け取ってpoint_allとモデルの確率を返す常駐プロセス。
+    # 血統・馬ごとの状態・モデルは起動時に1回だけ読み、リクエストごとには読み直さない（読むだけなので並行に呼べる）
+    def __init__(self, results, peds, model=None, features=FEATURES):
+        # results: build_stateかload_stateを済ませたResults、peds: p_pかload_stateを済ませたPeds
+        self.results = results
+        self.peds = peds
+        self.model = model
+        self.features = features
+        # 出馬表の馬の行だけを引けるように、馬ごとの行位置を先に作っておく
+        self.indexes = results.history_indexes(results.state["runs"])
+        self.peds_rows = peds.df.groupby("horse_id", sort=False).indices
+        self.rule_memo = {}
+
+    @classmethod
+    def from_files(cls, state_path, peds_path, model_path=None):
+        results = Results()
+        results.load_state(state_path)
+        peds = Peds()
+        peds.load_state(peds_path)
+        model, features = None, FEATURES
+        if model_path is not None:
+            # Trainerの保存物（モデルと特徴量の辞書）か、モデルそのもの
+            with open(model_path, "rb") as f:
+                model = pickle.load(f)
+            if isinstance(model, dict):
+                model, features = model["model"], model["features"]
+        return cls(results, peds, model, features)
+
+    def card_results(self, card):
+        # 出馬表（race_id, horse_id, 馬番, jockey_id, trainer_id, course, date、あれば性齢）をResults.p_p後の形にする
+        df = card.copy()
+        course = df["course"].astype(str).str.extract(r"^(\d{2})(芝|ダート|障害)(\d+)$")
+        df["競馬場"] = course[0]
+        df["race_type"] = course[1]
+        df["course_len"] = pd.to_numeric(course[2])
+        df["date"] = pd.to_datetime(df["date"])
+        df["month"] = df["date"].dt.month
+        df["季節"] = df["month"].map(MONTH_SEASON)
+        df["sex"] = df["性齢"].map(lambda x: str(x)[0]) if "性齢" in df.columns else np.nan
+        df["着順"] = np.nan
+        if "race_id" not in df.columns:
+            df["race_id"] = "card"
+        return df.drop(columns=["course"])
+
+    @profiled()
+    def score(self, card):
+        results = Schema(measure=False).apply(self.card_results(card), "card")
+        if (results["date"] <= self.results.state["watermark"]).any():
+            raise ValueError("取り込み済みの戦績（%s まで）より前の日付の出馬表は採点できません" % self.results.state["watermark"])
+        results = self.results.camp_stats(results, self.results.state.get("performance", {}))
+        ids = pd.unique(results["horse_id"])
+        r = Results()
+        r.state = self.results.state
+        p = Peds()
+        p.df = self.peds.df.iloc[self._rows(self.peds_rows, ids)]
+        p.rule_memo = self.rule_memo
+        p.schema = Schema(measure=False)
+        p.merge(Schema(measure=False).apply(r._state_merge(results, self.indexes), "merged"))
+        p.point()
+        if self.model is None:
+            return p.pointed
+        return Predictor(self.model, self.features).predict(p.pointed)
+
+    def _rows(self, rows, ids):
+        empty = np.array([], dtype=np.int64)
+        return np.concatenate([empty] + [rows.get(h, empty) for h in ids])
+
+    def serve(self, host="127.0.0.1", port=8765):
+        # POST /score に出馬表のJSON（レコードのリスト）を送ると、採点結果をレコードのリストで返す
+        asyncio.run(self._serve(host, port))
+
+    async def _serve(self, host, port):
+        server = await asyncio.start_server(self._handle, host, port)
+        async with server:
+            await server.serve_forever()
+
+    async def _handle(self, reader, writer):
+        try:
+            head = (await reader.readuntil(b"\r\n\r\n")).decode("latin-1").split("\r\n")
+            method, path = head[0].split(" ")[:2]
+            headers = dict(line.split(": ", 1) for line in head[1:] if ": " in line)
+            body = await reader.readexactly(int(headers.get("Content-Length", headers.get("content-length", 0))))
+            if method != "POST" or path != "/score":
+                status, out = "404 Not Found", {"error": "POST /score only"}
+            else:
+                card = pd.DataFrame(json.loads(body.decode("utf-8")))
+                # 採点はpandasの計算なので、イベントループを止めないようにスレッドで回す
+                pointed = await asyncio.get_running_loop().run_in_executor(None, self.score, card)
+                status, out = "200 OK", json.loads(pointed.reset_index().to_json(orient="records", force_ascii=False))
+        except (ValueError, KeyError) as e:
+            status, out = "400 Bad Request", {"error": str(e)}
+        except Exception as e:
+            # 想定外のエラーでも接続を黙って切らずに返す
+            status, out = "500 Internal Server Error", {"error": "%s: %s" % (type(e).__name__, e)}
+        data = json.dumps(out, ensure_ascii=False).encode("utf-8")
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: %d\r\n"
+                      "Connection: close\r\n\r\n" % (status, len(data))).encode("latin-1") + data)
+        await writer.drain()
+        writer.close()
+
+
+# walk-forwardの評価表の列（Trainer._evaluateの1行）
+METRIC_COLUMNS = ["fold", "n_train", "n_test", "auc", "race_auc"]
+
+
+class TrainingMatrix:
+    # Trainer.datasetの特徴量と目的変数（quinella）を、開催日順に並べて連続したfloat32のファイルに書き出し、メモリマップで読む。
+    # 書き出しは開催日の塊ごとに追記するので、全体を一度にメモリに載せなくてよい（大きさはディスクで決まる）。
+    # 開催日順なので「ある月より前」は先頭からの区間になり、学習にはコピー無しのスライスをそのまま渡せる
+    FILES = {"X": ("X.f32", np.float32), "y": ("y.u1", np.uint8), "date": ("date.i8", "datetime64[ns]"), "race": ("race.i8", np.int64)}
+
+    def __init__(self, path, features=FEATURES):
+        self.path = path
+        self.features = list(features)
+        self.n = 0
+
+    @profiled()
+    def export(self, frames):
+        # frames: Trainer.datasetのDataFrame、またはその塊を開催日順に並べたもの（塊どうしで同じ開催日を持たないこと）
+        if isinstance(frames, pd.DataFrame):
+            frames = [frames]
+        os.makedirs(self.path, exist_ok=True)
+        files = {name: open(os.path.join(self.path, file), "wb") for name, (file, _) in self.FILES.items()}
+        dates, offsets, n, n_races, last = [], [], 0, 0, None
+        try:
+            for df in progress(frames, desc="export"):
+                df = df.loc[df["date"].notna()]
+                if not len(df):
+                    continue
+                df = df.iloc[np.argsort(df["date"].values, kind="mergesort")]
+                if last is not None and df["date"].iloc[0] <= last:
+                    raise ValueError("書き出し済みの開催日（%s まで）以前の行は追記できません" % last)
+                race = pd.factorize(df.index)[0] + n_races
+                files["X"].write(np.ascontiguousarray(df[self.features].astype(np.float32).fillna(0).values).tobytes())
+                files["y"].write(df["quinella"].values.astype(np.uint8).tobytes())
+                files["date"].write(df["date"].values.astype("datetime64[ns]").tobytes())
+                files["race"].write(race.astype(np.int64).tobytes())
+                first = np.flatnonzero(np.r_[True, df["date"].values[1:] != df["date"].values[:-1]])
+                dates.extend(str(d) for d in df["date"].values[first])
+                offsets.extend((first + n).tolist())
+                n += len(df)
+                n_races = int(race.max()) + 1
+                last = df["date"].iloc[-1]
+        finally:
+            for f in files.values():
+                f.close()
+        with open(os.path.join(self.path, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"features": self.features, "rows": n, "dates": dates, "offsets": offsets}, f, ensure_ascii=False)
+        return self.open()
+
+    def open(self):
+        # 書き出したファイルを読み取り専用のメモリマップで開く。dates / offsets は開催日ごとの先頭行（CSRと同じ並び）
+        with open(os.path.join(self.path, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.features, self.n = meta["features"], meta["rows"]
+        self.dates = pd.DatetimeIndex(meta["dates"])
+        self.offsets = np.array(meta["offsets"] + [self.n], dtype=np.int64)
+        for name, (file, dtype) in self.FILES.items():
+            shape = (self.n, len(self.features)) if name == "X" else (self.n,)
+            array = np.memmap(os.path.join(self.path, file), dtype=dtype, mode="r", shape=shape) if self.n else np.zeros(shape, dtype)
+            setattr(self, name, array)
+        return self
+
+    def __len__(self):
+        return self.n
+
+    def folds(self, freq="M", min_train_months=12):
+        # Trainer.foldsと同じ月の切り方。学習は [0, start)、評価は [start, stop) の行
+        periods = self.dates.to_period(freq)
+        months = np.sort(periods.unique())
+        for month in months[min_train_months:]:
+            days = np.flatnonzero(periods == month)
+            yield str(month), slice(0, self.offsets[days[0]]), slice(self.offsets[days[0]], self.offsets[days[-1] + 1])
+
+    def batches(self, stop, max_rows):
+        # [0, stop) を、開催日の境目で max_rows 行くらいずつの区間に切る（1日で max_rows を超える日はその日だけで1区間）
+        start = 0
+        while start < stop:
+            end = self.offsets[np.searchsorted(self.offsets, min(start + max_rows, stop), side="right") - 1]
+            if end <= start:
+                end = self.offsets[np.searchsorted(self.offsets, start, side="right")]
+            end = min(end, stop)
+            yield slice(start, end)
+            start = end
+
+    def data_hash(self, rows, batch_rows=None):
+        # 学習区間の中身のハッシュ（区間を少しずつ読むので、全体を一度に読まない）
+        h = hashlib.sha1(repr((self.features, batch_rows)).encode())
+        for part in self.batches(rows.stop, 1000000):
+            h.update(self.X[part].tobytes())
+            h.update(self.y[part].tobytes())
+        return h.hexdigest()
+
+
+class Trainer:
+    # 開催月ごとのwalk-forward（その月より前のレースで学習し、その月のレースで評価）で連対（2着以内）を当てるモデルを作る。
+    # 学習済みのfoldは model_dir/<version>/ に保存し、学習データが変わっていなければ作り直さない
+    def __init__(self, features=FEATURES, params=None, model_dir="models", n_jobs=None, min_train_months=12, freq="M",
+                 batch_rows=None):
+        # batch_rows: TrainingMatrixから学習するとき、この行数くらいの開催日の塊ごとに木を足していく（Noneなら区間全体で一度に学習）
+        self.features = features
+        self.params = dict({"random_state": 1234}, **(params or {}))
+        self.model_dir = model_dir
+        self.n_jobs = n_jobs or os.cpu_count()
+        self.min_train_months = min_train_months
+        self.freq = freq
+        self.batch_rows = batch_rows
+        # 保存先は学習の設定ごと。DataFrameから学習する分（frame）とTrainingMatrixから学習する分（matrix、batch_rowsも含む）は分ける
+        self.versions = {source: hashlib.sha1(repr(("RandomForestClassifier", sorted(self.params.items()), list(features), freq, source,
+                                                    batch_rows if source == "matrix" else None)).encode()).hexdigest()[:12]
+                         for source in ("frame", "matrix")}
+        self.version = self.versions["frame"]
+        self.metrics = pd.DataFrame()
+        self.model = None
+
+    def dataset(self, peds):
+        # Peds.pointedに開催日と目的変数を付ける（pointedはmerged_dfと同じ行の並び）
+        df = peds.pointed.assign(date=peds.merged_df["date"].values)
+        df["quinella"] = (df["着順"] <= 2).astype(int)
+        return df
+
+    def folds(self, df):
+        # 学習データが min_train_months 以上ある月から、1か月ずつ評価する
+        periods = df["date"].dt.to_period(self.freq)
+        months = np.sort(periods.unique())
+        for month in months[self.min_train_months:]:
+            yield str(month), (periods < month).values, (periods == month).values
+
+    def walk_forward(self, df):
+        X = df[self.features].astype(float).fillna(0).values
+        y = df["quinella"].values
+        race = pd.factorize(df.index)[0]
+        path = os.path.join(self.model_dir, self.version)
+        os.makedirs(path, exist_ok=True)
+        todo, rows = [], []
+        for fold, train, test in self.folds(df):
+            data_hash = hashlib.sha1(X[train].tobytes() + y[train].tobytes()).hexdigest()
+            artifact = os.path.join(path, "fold-%s.pkl" % fold)
+            saved = pd.read_pickle(artifact) if os.path.exists(artifact) else {}
+            if saved.get("data_hash") == data_hash:
+                rows.append(self._evaluate(fold, saved["model"], X, y, race, train, test))
+            else:
+                todo.append((fold, train, test, data_hash, artifact))
+        # 新しいfoldだけ、プロセスごとに1つずつ学習する（RandomForestの中はn_jobs=1）
+        # 特徴量は一時ファイルに1回だけ書き、各プロセスがメモリマップで開いて自分のfoldの行だけ取り出す
+        # （foldごとの学習データを親プロセスで全部作って渡すと、全foldの分が同時にメモリに載る）
+        with tempfile.TemporaryDirectory() as tmp, ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+            x_path = os.path.join(tmp, "X.npy")
+            np.save(x_path, X)
+            models = pool.map(Trainer._fit_rows, [x_path] * len(todo), [t[1] for t in todo], [y[t[1]] for t in todo],
+                              [self.params] * len(todo))
+            for (fold, train, test, data_hash, artifact), model in progress(zip(todo, models), desc="folds", total=len(todo)):
+                row = self._evaluate(fold, model, X, y, race, train, test)
+                self._save(artifact, {"model": model, "features": self.features, "params": self.params, "fold": fold,
+                                      "data_hash": data_hash, "metrics": row})
+                rows.append(row)
+        self.metrics = pd.DataFrame(rows, columns=METRIC_COLUMNS).sort_values("fold").reset_index(drop=True)
+        self.metrics.to_csv(os.path.join(path, "metrics.csv"), index=False)
+        return self.metrics
+
+    def walk_forward_matrix(self, matrix):
+        # walk_forwardのTrainingMatrix版。各プロセスはファイルをメモリマップで開き、学習区間を先頭からのスライスで読む
+        path = os.path.join(self.model_dir, self.versions["matrix"])
+        os.makedirs(path, exist_ok=True)
+        todo, rows = [], []
+        for fold, train, test in matrix.folds(self.freq, self.min_train_months):
+            data_hash = matrix.data_hash(train, self.batch_rows)
+            artifact = os.path.join(path, "fold-%s.pkl" % fold)
+            saved = pd.read_pickle(artifact) if os.path.exists(artifact) else {}
+            if saved.get("data_hash") == data_hash:
+                rows.append(self._evaluate(fold, saved["model"], matrix.X, matrix.y, matrix.race, train, test))
+            else:
+                todo.append((fold, train, test, data_hash, artifact))
+        with ProcessPoolExecutor(max_workers=self.n_jobs) as pool:
+            models = pool.map(Trainer._fit_matrix, [matrix.path] * len(todo), [t[1].stop for t in todo], [self.params] * len(todo),
+                              [self.batch_rows] * len(todo))
+            for (fold, train, test, data_hash, artifact), model in progress(zip(todo, models), desc="folds", total=len(todo)):
+                row = self._evaluate(fold, model, matrix.X, matrix.y, matrix.race, train, test)
+                self._save(artifact, {"model": model, "features": self.features, "params": self.params, "fold": fold,
+                                      "data_hash": data_hash, "metrics": row})
+                rows.append(row)
+        self.metrics = pd.DataFrame(rows, columns=METRIC_COLUMNS).sort_values("fold").reset_index(drop=True)
+        self.metrics.to_csv(os.path.join(path, "metrics.csv"), index=False)
+        return self.metrics
+
+    def fit_matrix(self, matrix):
+        # fitのTrainingMatrix版
+        self.model = Trainer._fit_batches(matrix, len(matrix), dict(self.params, n_jobs=self.n_jobs), self.batch_rows)
+        last = str(matrix.dates[-1].to_period(self.freq))
+        artifact = os.path.join(self.model_dir, self.versions["matrix"], "final-%s.pkl" % last)
+        self._save(artifact, {"model": self.model, "features": self.features, "params": self.params, "fold": last})
+        return artifact
+
+    def fit(self, df):
+        # 全期間で学習した本番用のモデル（ScoringService.from_filesで読む）
+        X = df[self.features].astype(float).fillna(0).values
+        self.model = Trainer._fit(X, df["quinella"].values, dict(self.params, n_jobs=self.n_jobs))
+        last = str(df["date"].max().to_period(self.freq))
+        artifact = os.path.join(self.model_dir, self.version, "final-%s.pkl" % last)
+        self._save(artifact, {"model": self.model, "features": self.features, "params": self.params, "fold": last})
+        return artifact
+
+    def importance(self):
+        fi = self.model.feature_importances_
+        return pd.Series(fi, index=self.features).sort_values(ascending=False)
+
+    @staticmethod
+    def _fit(X, y, params):
+        from sklearn.ensemble import RandomForestClassifier
+        clf = RandomForestClassifier(**dict({"n_jobs": 1}, **params))
+        clf.fit(X, y)
+        return clf
+
+    @staticmethod
+    def _fit_rows(x_path, train, y, params):
+        X = np.load(x_path, mmap_mode="r")
+        return Trainer._fit(X[train], y, params)
+
+    @staticmethod
+    def _fit_matrix(path, stop, params, batch_rows):
+        return Trainer._fit_batches(TrainingMatrix(path).open(), stop, params, batch_rows)
+
+    @staticmethod
+    def _fit_batches(matrix, stop, params, batch_rows):
+        # RandomForestは中でfloat32に直すので、float32のメモリマップはコピーされずにそのまま使われる。
+        # batch_rowsがあれば warm_start で、開催日の塊ごとにその塊の行数に比例した本数の木を足す
+        if batch_rows is None or stop <= batch_rows:
+            return Trainer._fit(matrix.X[:stop], matrix.y[:stop], params)
+        from sklearn.ensemble import RandomForestClassifier
+        clf = RandomForestClassifier(**dict({"n_jobs": 1}, **dict(params, warm_start=True, n_estimators=0)))
+        n_estimators = params.get("n_estimators", 100)
+        for part in matrix.batches(stop, batch_rows):
+            n_trees = int(round(n_estimators * part.stop / stop)) - clf.n_estimators
+            if n_trees > 0:
+                clf.set_params(n_estimators=clf.n_estimators + n_trees)
+                clf.fit(matrix.X[part], matrix.y[part])
+        return clf
+
+    def _evaluate(self, fold, model, X, y, race, train, test):
+        from sklearn.metrics import roc_auc_score
+        prob = model.predict_proba(X[test])[:, 1]
+        auc = roc_auc_score(y[test], prob) if len(np.unique(y[test])) == 2 else np.nan
+        return {"fold": fold, "n_train": len(y[train]), "n_test": len(y[test]), "auc": auc,
+                "race_auc": self.race_auc(race[test], y[test], prob)}
+
+    def race_auc(self, race, y, prob):
+        # レース内のAUC（順位和から計算）を、勝ち負けの両方があるレースで平均する
+        df = pd.DataFrame({"race": race, "y": y, "rank": pd.Series(prob).groupby(race).rank().values})
+        g = df.groupby("race")
+        n_pos = g["y"].sum()
+        n_neg = g["y"].size() - n_pos
+        rank_sum = df.loc[df["y"] == 1].groupby("race")["rank"].sum().reindex(n_pos.index, fill_value=0)
+        auc = (rank_sum - n_pos * (n_pos + 1) / 2) / (n_pos * n_neg)
+        return auc[(n_pos > 0) & (n_neg > 0)].mean()
+
+    def _save(self, path, artifact):
+        # fitだけ回したとき（walk_forwardを先に回していない）も保存先を作る
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(artifact, f)
+        os.replace(path + ".tmp", path)
+
+
+class Predictor:
+    # Peds.pointed（indexがrace_id）をまとめて予測し、レース内の順位・正規化した確率・上位k頭を付ける。
+    # レースごとのループは無く、レースを連続した区間に並べてreduceatで区間ごとに集計する
+    def __init__(self, model, features=FEATURES, batch_size=100000):
+        self.model = model
+        self.features = features
+        self.batch_size = batch_size
+
+    def predict_proba(self, pointed):
+        X = np.ascontiguousarray(pointed[self.features].astype(float).fillna(0).values)
+        prob = np.empty(len(X))
+        for start in range(0, len(X), self.batch_size):
+            prob[start:start + self.batch_size] = self.model.predict_proba(X[start:start + self.batch_size])[:, 1]
+        return prob
+
+    def predict(self, pointed, k=3):
+        prob = self.predict_proba(pointed)
+        race = pd.factorize(pointed.index)[0]
+        # レースごと・確率の高い順（同じ確率なら馬番順）に並べる
+        order = np.lexsort((pointed["馬番"].values, -prob, race))
+        p, r = prob[order], race[order]
+        starts = np.flatnonzero(np.r_[True, r[1:] != r[:-1]])
+        sizes = np.diff(np.r_[starts, len(r)])
+        seg_start = np.repeat(starts, sizes)
+        rank = np.arange(len(r)) - seg_start + 1
+        # 単勝: レース内で和が1になるように割る。連対: Harvilleの式 P(i) = w_i + Σ_{j≠i} w_j * w_i / (1 - w_j)
+        total = np.add.reduceat(p, starts) if len(p) else np.zeros(0)
+        win = np.divide(p, np.repeat(total, sizes), out=np.zeros_like(p), where=np.repeat(total, sizes) > 0)
+        ratio = np.divide(win, 1 - win, out=np.zeros_like(win), where=win < 1)
+        ratio_sum = np.repeat(np.add.reduceat(ratio, starts), sizes) if len(p) else np.zeros(0)
+        quinella = np.minimum(win + win * (ratio_sum - ratio), 1.0)
+
+        out = pointed.copy()
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        out["prob"] = prob
+        out["rank"] = rank[inverse]
+        out["win_prob"] = win[inverse]
+        out["quinella_prob"] = quinella[inverse]
+        out["pick"] = out["rank"] <= k
+        return out
+
+    def top_k(self, pointed, k=3):
+        # 各レースの上位k頭だけを、レース・順位の順で返す
+        out = self.predict(pointed, k)
+        out = out.loc[out["pick"].values]
+        return out.iloc[np.lexsort((out["rank"].values, pd.factorize(out.index)[0]))]
+
+
+class Backtest:
+    # point_allの重み付けと買い方を、Peds.pointedを1回だけ行列にして一度に評価する。
+    # 点数は 成分行列 × 重み行列 の1回の積。それを（重み, レース, 頭）の配列に詰め、レース内の上位は頭の軸のargmaxで取る
+    def __init__(self, pointed, components=POINT_COMPONENTS):
+        # 着順が1頭も無いレース（出馬表）は除く。レース内は馬番順に並べる（同点なら馬番の若い方を上にする）
+        race = pd.factorize(pointed.index)[0]
+        finished = np.bincount(race, weights=pointed["着順"].notna().values) > 0
+        keep = finished[race]
+        order = np.lexsort((pointed["馬番"].values[keep], race[keep]))
+        df = pointed.loc[keep].iloc[order]
+        self.components = list(components)
+        self.X = np.ascontiguousarray(df[self.components].astype(float).fillna(0).values)
+        self.race = pd.factorize(race[keep][order])[0]
+        starts = np.flatnonzero(np.r_[True, self.race[1:] != self.race[:-1]])
+        sizes = np.diff(np.r_[starts, len(self.race)])
+        self.slot = np.arange(len(self.race)) - np.repeat(starts, sizes)
+        self.n_races, self.field = len(starts), int(sizes.max()) if len(sizes) else 0
+        # 1着・2着以内のフラグも（レース, 頭）に詰めておく（空きの頭はFalse）
+        self.win = np.zeros((self.n_races, self.field), dtype=bool)
+        self.placed = np.zeros((self.n_races, self.field), dtype=bool)
+        self.win[self.race, self.slot] = (df["着順"] == 1).values
+        self.placed[self.race, self.slot] = (df["着順"] <= 2).values
+
+    def grid(self, values=(0, 0.5, 1, 2)):
+        # 成分ごとにvaluesのどれかを取る重みの全組み合わせ（全部0の行は除く）
+        weights = np.array(np.meshgrid(*[values] * len(self.components), indexing="ij")).reshape(len(self.components), -1).T
+        return weights[np.abs(weights).sum(axis=1) > 0]
+
+    @profiled()
+    def run(self, weights, k=3, margins=(0.0,), batch_size=256):
+        # weights: 重みの行列（1行が1つの設定）。margins: 1位と2位の点差（重みの絶対値の和で割った値）がこれ以上のレースだけ買う
+        # 的中率は1位が1着、連対率は1位が2着以内、馬連は1位・2位が1・2着、top_kは上位k頭に1着がいる割合
+        weights = np.atleast_2d(np.asarray(weights, dtype=float))
+        rows = []
+        for b in progress(range(0, len(weights), batch_size), desc="backtest"):
+            W = weights[b:b + batch_size]
+            picks, scores = self._top(self.X @ W.T, max(k, 2))
+            races = np.arange(self.n_races)
+            # 頭数がk頭に足りないレースの空き（点数が-inf）は外れ扱い
+            won = [self.win[races, pick] & (score > -np.inf) for pick, score in zip(picks, scores)]
+            placed = [self.placed[races, pick] & (score > -np.inf) for pick, score in zip(picks, scores)]
+            hits = {"hit_rate": won[0], "place_rate": placed[0], "quinella_rate": placed[0] & placed[1],
+                    "top_k_rate": np.any(won[:k], axis=0)}
+            with np.errstate(invalid="ignore", divide="ignore"):
+                margin = (scores[0] - scores[1]) / np.abs(W).sum(axis=1)[:, None]
+            for m in margins:
+                bet = margin >= m
+                n_bet = bet.sum(axis=1)
+                out = pd.DataFrame(W, columns=self.components)
+                out["margin"] = m
+                out["races"] = n_bet
+                out["coverage"] = n_bet / max(self.n_races, 1)
+                for name, hit in hits.items():
+                    out[name] = (hit & bet).sum(axis=1) / np.maximum(n_bet, 1)
+                rows.append(out)
+        return pd.concat(rows, ignore_index=True)
+
+    def _top(self, S, k):
+        # レースごとの1位〜k位の頭（重み×レースの添字）とその点数。argmaxは同点なら前の頭（馬番の若い方）を取る
+        P = np.full((S.shape[1], self.n_races, self.field), -np.inf)
+        P[:, self.race, self.slot] = S.T
+        picks, scores = [], []
+        for _ in range(k):
+            pick = P.argmax(axis=2)
+            score = np.take_along_axis(P, pick[:, :, None], axis=2)[:, :, 0]
+            np.put_along_axis(P, pick[:, :, None], -np.inf, axis=2)
+            picks.append(pick)
+            scores.append(score)
+        return picks, scores
+
+
+# CLIの作業ディレクトリに置くファイル（段 → ファイル名）
+WORK_FILES = {"results": "results.pkl", "hr": "hr.pkl", "peds": "peds.pkl", "merged": "merged.pkl",
+              "merged_df": "merged_df.pkl", "pointed": "pointed.pkl", "state": "state.pkl"}
+
+
+def read_frame(path):
+    # CLIの入力（pickle / csv / json / parquet）
+    ext = os.path.splitext(path)[1].lower()
+    if ext == ".csv":
+        return pd.read_csv(path, dtype={"horse_id": str, "jockey_id": str, "trainer_id": str})
+    if ext == ".json":
+        return pd.read_json(path, dtype={"horse_id": str, "jockey_id": str, "trainer_id": str})
+    if ext == ".parquet":
+        return pd.read_parquet(path)
+    return pd.read_pickle(path)
+
+
+def write_frame(df, path):
+    # 出力先が無ければ標準出力にCSVで出す
+    if path is None:
+        print(df.to_csv())
+    elif path.lower().endswith(".json"):
+        df.reset_index().to_json(path, orient="records", force_ascii=False)
+    elif path.lower().endswith(".csv"):
+        df.to_csv(path)
+    else:
+        df.to_pickle(path)
+
+
+def main(argv=None):
+    # 使い方:
+    #   python ai_sinba_1.py preprocess results.pickle horse_results.pickle --dir work
+    #   python ai_sinba_1.py merge --dir work            （--jobsで開催日ごとに並列）
+    #   python ai_sinba_1.py train --dir work --model-dir models
+    #   python ai_sinba_1.py export --dir work matrix      （学習データをメモリマップに書き出し、train --matrix matrix で使う）
+    #   python ai_sinba_1.py predict models/<version>/final-<月>.pkl --dir work --out picks.csv
+    #   python ai_sinba_1.py score card.csv --dir work [--model ...]
+    import argparse
+    global PROGRESS
+    parser = argparse.ArgumentParser(description="競馬データの前処理・特徴量・学習・予測")
+    parser.add_argument("--dir", default=".", help="作業ディレクトリ（各段の出力を置く）")
+    parser.add_argument("--no-progress", action="store_true", help="進捗バーを出さない")
+    parser.add_argument("--profile", help="各段の時間をChromeのtraceとしてこのファイルに書く")
+    parser.add_argument("--backend", choices=["pandas", "polars"], default="pandas", help="preprocess・mergeの重い段を回す実装")
+    sub = parser.add_subparsers(dest="command", required=True)
+    pre = sub.add_parser("preprocess", help="results・horse_results・血統を前処理する")
+    pre.add_argument("results")
+    pre.add_argument("horse_results")
+    pre.add_argument("--peds", nargs="+", default=PEDS_PATHS, help="血統の生データ（ファイルかディレクトリ）")
+    pre.add_argument("--cache", help="StageCacheのディレクトリ")
+    mer = sub.add_parser("merge", help="過去走の結合と点数付けをし、差分更新用の状態を作る")
+    mer.add_argument("--jobs", type=int, default=1, help="2以上ならParallelPipelineで並列に回す")
+    mer.add_argument("--performance-by", nargs="*", default=[], help="騎手・調教師の成績を分ける列（競馬場 race_typeなど）")
+    sco = sub.add_parser("score", help="出馬表を採点する")
+    sco.add_argument("card", help="出馬表（csv / json / pickle）")
+    sco.add_argument("--model", help="Trainerの保存物。無ければpoint_allまで")
+    sco.add_argument("--out")
+    exp = sub.add_parser("export", help="学習データをfloat32のメモリマップに開催月ごとに書き出す")
+    exp.add_argument("matrix", help="書き出し先のディレクトリ")
+    tra = sub.add_parser("train", help="walk-forwardで評価し、全期間で学習したモデルを保存する")
+    tra.add_argument("--model-dir", default="models")
+    tra.add_argument("--jobs", type=int)
+    tra.add_argument("--matrix", help="exportで書き出したディレクトリ。あればpickleを読まずにここから学習する")
+    tra.add_argument("--batch-rows", type=int, help="--matrixのとき、この行数くらいの塊ごとに木を足して学習する")
+    pred = sub.add_parser("predict", help="pointedの各レースの上位k頭を出す")
+    pred.add_argument("model", help="Trainerの保存物")
+    pred.add_argument("--k", type=int, default=3)
+    pred.add_argument("--out")
+    args = parser.parse_args(argv)
+    PROGRESS = not args.no_progress
+    if args.profile:
+        PROFILER.enable()
+    path = {stage: os.path.join(args.dir, name) for stage, name in WORK_FILES.items()}
+    os.makedirs(args.dir, exist_ok=True)
+    backend = PolarsBackend() if args.backend == "polars" else None
+
+    if args.command == "preprocess":
+        cache = StageCache(args.cache) if args.cache else None
+        r = Results(cache=cache)
+        r.p_p(read_frame(args.results))
+        r.p_p_hr(read_frame(args.horse_results))
+        p = Peds(paths=args.peds, cache=cache, backend=backend)
+        p.p_p()
+        r.results.to_pickle(path["results"])
+        r.hr.to_pickle(path["hr"])
+        p.save_state(path["peds"])
+    elif args.command == "merge":
+        r = Results(performance_by=args.performance_by, backend=backend)
+        r.results, r.hr = pd.read_pickle(path["results"]), pd.read_pickle(path["hr"])
+        p = Peds(backend=backend)
+        p.load_state(path["peds"])
+        if args.jobs > 1:
+            ParallelPipeline(n_jobs=args.jobs).run(r, p)
+        else:
+            r.merge()
+            p.merge(r.merged)
+            p.point()
+        r.build_state()
+        r.merged.to_pickle(path["merged"])
+        p.merged_df.to_pickle(path["merged_df"])
+        p.pointed.to_pickle(path["pointed"])
+        r.save_state(path["state"])
+    elif args.command == "score":
+        service = ScoringService.from_files(path["state"], path["peds"], args.model)
+        write_frame(service.score(read_frame(args.card)), args.out)
+    elif args.command == "export":
+        p = Peds()
+        p.pointed, p.merged_df = pd.read_pickle(path["pointed"]), pd.read_pickle(path["merged_df"])
+        df = Trainer().dataset(p)
+        months = df["date"].dt.to_period("M")
+        matrix = TrainingMatrix(args.matrix).export(part for _, part in df.groupby(months, sort=True))
+        print("exported", len(matrix), "rows to", args.matrix)
+    elif args.command == "train":
+        trainer = Trainer(model_dir=args.model_dir, n_jobs=args.jobs, batch_rows=args.batch_rows)
+        if args.matrix:
+            matrix = TrainingMatrix(args.matrix).open()
+            print(trainer.walk_forward_matrix(matrix))
+            print("saved", trainer.fit_matrix(matrix))
+        else:
+            p = Peds()
+            p.pointed, p.merged_df = pd.read_pickle(path["pointed"]), pd.read_pickle(path["merged_df"])
+            df = trainer.dataset(p)
+            print(trainer.walk_forward(df))
+            print("saved", trainer.fit(df))
+        print(trainer.importance())
+    elif args.command == "predict":
+        with open(args.model, "rb") as f:
+            artifact = pickle.load(f)
+        model, features = (artifact["model"], artifact["features"]) if isinstance(artifact, dict) else (artifact, FEATURES)
+        write_frame(Predictor(model, features).top_k(pd.read_pickle(path["pointed"]), args.k), args.out)
+
+    if args.profile:
+        PROFILER.export_chrome_trace(args.profile)
+        print(PROFILER.summary())
+
+
+if __name__ == "__main__":
+    # スクリプトとして動かしたときも、importしたai_sinba_1のmainを回す（__main__のままだと、保存した状態の
+    # PerformanceIndex・HistoryIndexが__main__のクラスとして記録され、importした側のScoringServiceで読めない）
+    import ai_sinba_1
+    ai_sinba_1.main()
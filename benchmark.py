@@ -0,0 +1,182 @@
+import argparse
+import json
+import tempfile
+import time
+import tracemalloc
+import numpy as np
+import pandas as pd
+import ai_sinba_1 as sinba
+
+
+# ベンチマーク用の合成データ。列名・文字列の形式はnetkeibaから取ったresults / horse_results / peds_rawに合わせる
+KEIBAJO = ["函館", "札幌", "福島", "新潟", "東京", "中山", "中京", "京都", "阪神", "小倉"]
+CHIHOU = ["大井", "川崎", "船橋", "浦和", "名古屋", "園田"]
+DISTANCES = {"芝": [1000, 1200, 1400, 1600, 1800, 2000, 2200, 2400, 2500, 3000, 3600],
+             "ダ": [1000, 1150, 1200, 1300, 1400, 1600, 1700, 1800, 1900, 2100]}
+FIELD_SIZE = (8, 18)          # 頭数
+RUNS_PER_HORSE = 8            # 1頭あたりの平均出走数（馬の数はこれで決める）
+JOCKEYS, TRAINERS = 300, 400  # 騎手・調教師のID数
+TRAIN_FREQ, TRAIN_FOLDS = "Q", 3  # 学習の段は四半期ごとのwalk-forwardの最後の3期だけ評価する（全部の月を回すと大きいサイズで終わらない）
+
+
+def ancestor_names():
+    # 系統・血統ルールに出てくる名前を混ぜて、ルールがちゃんと当たるようにする
+    names = set()
+    for _, patterns in sinba.LINEAGE_RULES:
+        for pattern in ([patterns] if isinstance(patterns, str) else patterns):
+            names |= set(pattern.split("|"))
+    sires = {sire for sire, _, _ in sinba.BLOOD_RULES if sire is not None}
+    names = ["%s %d 鹿毛" % (n, 1980 + i % 30) for i, n in enumerate(sorted(names))]
+    names += ["%s%d 栗毛" % (s, 1995 + i % 20) for i, s in enumerate(sorted(sires))]
+    names += ["ホース%04d %d 黒鹿毛" % (i, 1970 + i % 40) for i in range(2000)]
+    return np.array(names, dtype=object)
+
+
+def make_data(n_rows, seed=0):
+    # n_rows: resultsの行数。horse_resultsは地方・過去分を含むのでそれより多い
+    rng = np.random.RandomState(seed)
+    n_horses = max(50, n_rows // RUNS_PER_HORSE)
+    n_days = max(20, n_rows // 250)
+    horse_ids = np.array(["20%08d" % i for i in range(n_horses)], dtype=object)
+    days = pd.Timestamp("2010-01-03") + pd.to_timedelta(np.arange(n_days) * 7 + rng.randint(0, 2, n_days), unit="D")
+    per_day = int(np.ceil(n_rows * 1.2 / n_days))
+
+    rows = []
+    race_no = 0
+    for d, day in enumerate(days):
+        # 同じ日に同じ馬は1回だけ
+        pool = rng.permutation(n_horses)[:per_day]
+        sizes = rng.randint(FIELD_SIZE[0], FIELD_SIZE[1] + 1, len(pool) // FIELD_SIZE[0] + 1)
+        ends = np.cumsum(sizes)
+        sizes = sizes[ends <= len(pool)]
+        n = sizes.sum()
+        race = np.repeat(np.arange(len(sizes)), sizes)
+        start = np.repeat(np.cumsum(sizes) - sizes, sizes)
+        umaban = np.arange(n) - start + 1
+        venue = rng.randint(0, len(KEIBAJO), len(sizes))[race]
+        jra = rng.rand(len(sizes))[race] > 0.1
+        types = np.where(rng.rand(len(sizes)) < 0.45, "芝", "ダ")
+        distance = np.array([DISTANCES[t][rng.randint(len(DISTANCES[t]))] for t in types])[race]
+        race_type = types[race]
+        finish = np.empty(n, dtype=np.int64)
+        for s, k in zip(np.cumsum(sizes) - sizes, sizes):
+            finish[s:s + k] = rng.permutation(k) + 1
+        rows.append(pd.DataFrame({
+            "horse_id": horse_ids[pool[:n]], "day": d, "race": race_no + race, "頭数": sizes[race], "馬番": umaban,
+            "venue": venue, "jra": jra, "race_type": race_type, "distance": distance, "finish": finish,
+            "人気": rng.randint(1, 19, n).clip(max=sizes[race]), "jockey_id": rng.randint(1, JOCKEYS + 1, n),
+            "trainer_id": rng.randint(1, TRAINERS + 1, n), "weight": rng.randint(400, 560, n), "diff": rng.randint(-12, 13, n),
+            "着差": np.where(finish == 1, 0.0, np.round(rng.exponential(0.8, n), 1)), "上り": np.round(rng.normal(35.5, 1.5, n), 1),
+            "corners": rng.randint(1, 5, n), "sexage": rng.randint(0, 3, n) * 10 + rng.randint(2, 8, n)}))
+        race_no += len(sizes)
+    df = pd.concat(rows, ignore_index=True)
+    n = len(df)
+    date = days[df["day"].values]
+    chaku = df["finish"].astype(str).where(rng.rand(n) > 0.01, "中止")
+    weight = (df["weight"].astype(str) + "(" + df["diff"].map("{:+d}".format) + ")").where(rng.rand(n) > 0.01, "計不")
+    jockey = df["jockey_id"].map("{:05d}".format)
+    trainer = df["trainer_id"].map("{:05d}".format)
+    place = np.array(KEIBAJO, dtype=object)[df["venue"]]
+    kaisai = np.where(df["jra"], pd.Series(rng.randint(1, 6, n)).astype(str) + place + pd.Series(rng.randint(1, 13, n)).astype(str),
+                      np.array(CHIHOU, dtype=object)[df["venue"] % len(CHIHOU)])
+    tsuka = pd.Series(rng.randint(1, 19, n)).astype(str)
+    for k in range(1, 4):
+        tsuka = tsuka.where(df["corners"] <= k, tsuka + "-" + pd.Series(rng.randint(1, 19, n)).astype(str))
+    agari = df["上り"].where(rng.rand(n) > 0.03)
+
+    hr = pd.DataFrame({"horse_id": df["horse_id"], "日付": date.strftime("%Y/%m/%d"), "開催": kaisai, "頭数": df["頭数"],
+                       "馬番": df["馬番"], "人気": df["人気"], "着順": chaku, "jockey_id": jockey,
+                       "距離": df["race_type"] + df["distance"].astype(str), "着差": df["着差"],
+                       "通過": tsuka.where(rng.rand(n) > 0.03), "上り": agari, "馬体重": weight, "_date": date})
+    # netkeibaの馬ページと同じく、馬ごとに新しい順
+    hr = hr.sort_values(["horse_id", "_date"], ascending=[True, False], kind="mergesort").drop(columns="_date").set_index("horse_id")
+
+    # resultsは最初の1割の開催を除いたJRAのレース
+    res = df.loc[df["jra"].values & (df["day"].values >= n_days // 10)]
+    res = res.iloc[:n_rows]
+    sex = np.array(["牡", "牝", "セ"])[res["sexage"] // 10]
+    race_id = (pd.Series(date[res.index].year, index=res.index).astype(str) + res["venue"].map(lambda v: "%02d" % (v + 1))
+               + res["race"].map("{:06d}".format))
+    results = pd.DataFrame({"着順": chaku[res.index], "枠番": (res["馬番"] + 1) // 2, "馬番": res["馬番"], "馬名": "x",
+                            "性齢": sex + (res["sexage"] % 10).astype(str), "斤量": 55.0, "騎手": "x", "タイム": "1:35.0", "着差": "",
+                            "単勝": 3.0, "人気": res["人気"], "馬体重": weight[res.index], "調教師": "x",
+                            "course_len": res["distance"], "race_type": res["race_type"].map({"芝": "芝", "ダ": "ダート"}),
+                            "date": ["%d年%d月%d日" % (d.year, d.month, d.day) for d in date[res.index]],
+                            "horse_id": res["horse_id"], "jockey_id": jockey[res.index], "trainer_id": trainer[res.index],
+                            "競馬場": res["venue"].map(lambda v: "%02d" % (v + 1))})
+    results.index = race_id.values
+
+    # peds_raw: 1頭4行×5列（父系・母父系…の並び）。名前のカーディナリティは実データ程度
+    names = ancestor_names()
+    weights = 1.0 / np.arange(1, len(names) + 1) ** 0.8
+    picks = rng.choice(len(names), size=(n_horses * 4, 5), p=weights / weights.sum())
+    peds = pd.DataFrame(names[picks], index=np.repeat(horse_ids, 4))
+    return results, hr, peds
+
+
+class Benchmark:
+    def __init__(self, memory=True):
+        # memory=Trueなら、時間を測った後にtracemallocを付けてもう1回回し、ピークメモリを測る（tracemallocは遅いので時間とは別に測る）
+        self.memory = memory
+        self.rows = []
+
+    def stage(self, name, n_rows, func, output=None):
+        # output: 結果を属性に入れる段（p_pなど）は、その属性を返す関数
+        t = time.perf_counter()
+        out = func()
+        seconds = time.perf_counter() - t
+        peak = np.nan
+        if self.memory:
+            tracemalloc.start()
+            func()
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+        if output is not None:
+            out = output()
+        out_mb = out.memory_usage(deep=True).sum() / 1024 ** 2 if isinstance(out, pd.DataFrame) else np.nan
+        self.rows.append({"stage": name, "rows": n_rows, "seconds": seconds, "peak_MB": peak / 1024 ** 2, "out_MB": out_mb})
+        print("%-14s %9d rows %9.3f s %9.1f MB peak" % (name, n_rows, seconds, peak / 1024 ** 2))
+        return out
+
+    def run(self, n_rows, seed=0):
+        results, hr, peds = make_data(n_rows, seed)
+        r = sinba.Results()
+        self.stage("Results.p_p", n_rows, lambda: r.p_p(results), lambda: r.results)
+        self.stage("Results.merge", n_rows, lambda: r.merge(hr), lambda: r.merged)
+        p = sinba.Peds()
+        p.peds = peds
+        self.stage("Peds.p_p_1", n_rows, lambda: p.p_p_1(peds[0::4]))
+        self.stage("Peds.p_p", n_rows, p.p_p, lambda: p.df)
+        self.stage("Peds.merge", n_rows, lambda: p.merge(r.merged), lambda: p.merged_df)
+        self.stage("Peds.point", n_rows, p.point, lambda: p.pointed)
+        df = sinba.Trainer().dataset(p)
+        self.stage("walk_forward", n_rows, lambda: self.train(df, "walk_forward"))
+        self.stage("fit", n_rows, lambda: self.train(df, "fit"))
+
+    def train(self, df, step):
+        # 本番と同じTrainerの学習（walk_forward / fit）。保存済みのfoldを使い回さないよう、毎回空のmodel_dirで回す
+        periods = df["date"].dt.to_period(TRAIN_FREQ).nunique()
+        with tempfile.TemporaryDirectory() as model_dir:
+            trainer = sinba.Trainer(model_dir=model_dir, freq=TRAIN_FREQ, min_train_months=max(1, periods - TRAIN_FOLDS))
+            if step == "walk_forward":
+                return trainer.walk_forward(df)
+            trainer.fit(df)
+            return trainer.importance().to_frame("importance")
+
+    def report(self):
+        return pd.DataFrame(self.rows)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="パイプラインの各段の時間とメモリを合成データで測る")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000, 1000000])
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--no-memory", action="store_true", help="ピークメモリを測らない（各段を1回だけ回す）")
+    args = parser.parse_args()
+    bench = Benchmark(memory=not args.no_memory)
+    for n_rows in args.sizes:
+        bench.run(n_rows, args.seed)
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(bench.rows, f, ensure_ascii=False, indent=1)
+    print(bench.report().pivot(index="stage", columns="rows", values="seconds"))
@@ -0,0 +1,15 @@
+import os
+import sys
+import pytest
+
+# リポジトリ直下のai_sinba_1.py・benchmark.pyを読めるようにする
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import benchmark  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def data():
+    # 小さい合成データ（results, horse_results, peds_raw）
+    return benchmark.make_data(3000, seed=0)
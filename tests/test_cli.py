@@ -0,0 +1,30 @@
+import os
+import subprocess
+import sys
+import pandas as pd
+import ai_sinba_1 as sinba
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "ai_sinba_1.py")
+
+
+def test_cli_state_loads_through_import(data, tmp_path):
+    # CLIで書いた状態を、importしたモジュールのScoringServiceで読んで採点できる（__main__のクラスで保存しない）
+    results, hr, peds = data
+    results.to_pickle(tmp_path / "results.pickle")
+    hr.to_pickle(tmp_path / "hr.pickle")
+    peds.to_pickle(tmp_path / "peds_raw.pickle")
+    work = str(tmp_path / "work")
+    for args in (["preprocess", str(tmp_path / "results.pickle"), str(tmp_path / "hr.pickle"), "--peds", str(tmp_path / "peds_raw.pickle")],
+                 ["merge"]):
+        subprocess.run([sys.executable, SCRIPT, "--no-progress", "--dir", work] + args, check=True, cwd=str(tmp_path))
+    state = os.path.join(work, sinba.WORK_FILES["state"])
+    with open(state, "rb") as f:
+        assert b"__main__" not in f.read()
+
+    service = sinba.ScoringService.from_files(state, os.path.join(work, sinba.WORK_FILES["peds"]))
+    card = pd.DataFrame({"race_id": "card", "horse_id": results["horse_id"].iloc[:8].values, "馬番": range(1, 9),
+                         "jockey_id": results["jockey_id"].iloc[:8].values, "trainer_id": results["trainer_id"].iloc[:8].values,
+                         "course": "05芝1600", "date": service.results.state["watermark"] + pd.Timedelta(days=7), "性齢": "牡3"})
+    scored = service.score(card)
+    assert len(scored) == 8
+    assert scored["point_all"].notna().any()
@@ -0,0 +1,24 @@
+import pandas as pd
+import ai_sinba_1 as sinba
+
+
+def test_parallel_matches_serial(data):
+    # 開催日の塊ごとに回しても、直列と同じ結果になる（各プロセスは塊の馬の行だけ読む）
+    results, hr, peds = data
+    out = []
+    for jobs in (1, 2):
+        r = sinba.Results()
+        r.p_p(results)
+        r.p_p_hr(hr)
+        p = sinba.Peds()
+        p.peds = peds
+        p.p_p()
+        if jobs > 1:
+            sinba.ParallelPipeline(n_jobs=jobs, n_shards=3).run(r, p)
+        else:
+            r.merge()
+            p.merge(r.merged)
+            p.point()
+        out.append((r.merged, p.pointed))
+    pd.testing.assert_frame_equal(out[0][1], out[1][1])
+    pd.testing.assert_frame_equal(out[0][0], out[1][0])
@@ -0,0 +1,91 @@
+import pandas as pd
+import pytest
+import ai_sinba_1 as sinba
+
+
+def run_peds(data, features):
+    results, hr, peds = data
+    r = sinba.Results()
+    r.p_p(results)
+    r.merge(hr)
+    p = sinba.Peds(features=features)
+    p.peds = peds
+    p.p_p()
+    p.merge(r.merged)
+    p.point()
+    return p
+
+
+def test_reduced_features_merge_and_point(data):
+    # 血統ルールが使うフラグの一部しか作らなくても、merge・pointが通り、無いフラグのルールは0点になる
+    features = {"父": ["ディープ系", "米国型"], "母父": ["大系統サンデー"]}
+    p = run_peds(data, features)
+    assert "欧州A" not in p.df.columns
+    assert len(p.pointed) == len(p.merged_df)
+    assert p.pointed["bld_point"].notna().any()
+
+
+def test_pedigree_rules_skip_absent_flags():
+    columns = ["父_米国型", "母父_米国型"]
+    rules = list(sinba.pedigree_rules(columns))
+    assert rules
+    for any_flags, all_flags, _, _ in rules:
+        assert set(any_flags + all_flags) <= set(columns)
+
+
+@pytest.fixture(scope="module")
+def merged(data):
+    results, hr, _ = data
+    r = sinba.Results()
+    r.p_p(results)
+    r.merge(hr)
+    return r.merged
+
+
+def pointed_frames(merged, peds, chunk_size=10000):
+    if isinstance(peds, pd.DataFrame):
+        p = sinba.Peds(chunk_size=chunk_size)
+        p.peds = peds
+    else:
+        p = sinba.Peds(paths=peds, chunk_size=chunk_size)
+    p.p_p()
+    p.merge(merged)
+    p.point()
+    return p
+
+
+def flat_peds(raw):
+    # parquet/featherに書く形（列名は文字列、horse_idは列）
+    flat = raw.copy()
+    flat.columns = [str(c) for c in flat.columns]
+    return flat.rename_axis("horse_id").reset_index()
+
+
+def assert_same_peds(actual, expected):
+    pd.testing.assert_frame_equal(actual.df, expected.df)
+    pd.testing.assert_frame_equal(actual.merged_df, expected.merged_df)
+    pd.testing.assert_frame_equal(actual.pointed, expected.pointed)
+
+
+def test_file_loaders_match_frame(data, merged, tmp_path):
+    # feather（小さいレコードバッチ）とparquetのディレクトリ（馬の途中で切れたファイル・小さい行グループ）から読んでも、
+    # Peds.pedsに直接入れたときと同じ結果になる。chunk_sizeも小さくして、馬がバッチ・ファイルをまたぐようにする
+    pytest.importorskip("pyarrow")
+    frame = data[2].iloc[:1202]  # 300頭と半端（最後の馬は2行）
+    expected = pointed_frames(merged, frame)
+    flat = flat_peds(frame)
+    flat.to_feather(tmp_path / "peds.feather", chunksize=10)
+    parquet = tmp_path / "parquet"
+    parquet.mkdir()
+    for i, (start, stop) in enumerate([(0, 450), (450, 1001), (1001, len(flat))]):
+        flat.iloc[start:stop].to_parquet(parquet / ("part%d.parquet" % i), row_group_size=30, index=False)
+    for path in (tmp_path / "peds.feather", parquet):
+        assert_same_peds(pointed_frames(merged, str(path), chunk_size=50), expected)
+
+
+def test_feather_without_horse_id_column(data, merged, tmp_path):
+    # reset_index()しただけ（id列が"index"）のfeatherも読める
+    pytest.importorskip("pyarrow")
+    frame = data[2].iloc[:400]
+    flat_peds(frame).rename(columns={"horse_id": "index"}).to_feather(tmp_path / "peds.feather", chunksize=10)
+    assert_same_peds(pointed_frames(merged, str(tmp_path / "peds.feather"), chunk_size=50), pointed_frames(merged, frame))
@@ -0,0 +1,14 @@
+import pytest
+import ai_sinba_1 as sinba
+
+pytest.importorskip("polars")
+
+
+@pytest.mark.parametrize("performance_by", [(), ("競馬場",)])
+def test_polars_backend_matches_pandas(data, performance_by):
+    # Results（merged）・Peds（peds, merged_df, pointed）の全部の列で、pandasの実装との食い違いが0
+    results, hr, peds = data
+    report = sinba.cross_check(results, hr, peds, performance_by=performance_by)
+    assert set(report["stage"]) == {"merged", "peds", "merged_df", "pointed"}
+    bad = report.loc[report["mismatches"] > 0]
+    assert bad.empty, bad.to_string()
@@ -0,0 +1,33 @@
+import numpy as np
+import pandas as pd
+import ai_sinba_1 as sinba
+
+
+def runs_frame(n, seed):
+    rng = np.random.RandomState(seed)
+    return pd.DataFrame({"horse_id": rng.randint(0, 100, n).astype(str), "jockey_id": rng.randint(0, 10, n).astype(str),
+                         "date": pd.Timestamp("2020-01-05") + pd.to_timedelta(rng.randint(0, 40, n), unit="D"),
+                         "着順": np.where(rng.rand(n) < 0.1, np.nan, rng.randint(1, 10, n))})
+
+
+def test_performance_index_update_matches_rebuild():
+    # 段を足していく差分更新と、全部の出走で作り直した索引は同じ累計を返す
+    runs = runs_frame(2000, 0).sort_values("date", kind="stable")
+    chunks = [runs.iloc[part] for part in np.array_split(np.arange(len(runs)), 6)]
+    index = sinba.PerformanceIndex(chunks[0], "jockey_id")
+    for chunk in chunks[1:]:
+        index.update(chunk)
+    query = runs_frame(300, 1)
+    expected = sinba.PerformanceIndex(runs, "jockey_id").stats(query, "騎手")
+    pd.testing.assert_frame_equal(index.stats(query, "騎手"), expected)
+    assert len(index.parts) < len(chunks)
+
+
+def test_performance_index_uses_corrected_result():
+    # 着順が無いまま取り込んだ出走に、後から着順が来たら後の行で数える（同じ出走は1回だけ）
+    run = pd.DataFrame({"horse_id": ["h1"], "jockey_id": ["j1"], "date": [pd.Timestamp("2020-01-05")], "着順": [np.nan]})
+    index = sinba.PerformanceIndex(run, "jockey_id")
+    index.update(run.assign(着順=1.0))
+    index.update(pd.DataFrame({"horse_id": ["h2"], "jockey_id": ["j2"], "date": [pd.Timestamp("2020-01-12")], "着順": [3.0]}))
+    stats = index.stats(pd.DataFrame({"jockey_id": ["j1"], "date": [pd.Timestamp("2020-02-01")]}), "騎手")
+    assert stats.iloc[0].tolist() == [1, 1, 1]
@@ -0,0 +1,65 @@
+import asyncio
+import json
+import pandas as pd
+import pytest
+import ai_sinba_1 as sinba
+
+
+@pytest.fixture(scope="module")
+def service(data):
+    results, hr, peds = data
+    r = sinba.Results()
+    r.p_p(results)
+    r.p_p_hr(hr)
+    r.build_state()
+    p = sinba.Peds()
+    p.peds = peds
+    p.p_p()
+    return sinba.ScoringService(r, p)
+
+
+def make_card(service, results):
+    # 性齢の無い出馬表。1頭は血統も戦績も無い馬
+    return pd.DataFrame({"race_id": "card", "horse_id": list(results["horse_id"].iloc[:7]) + ["unknown"], "馬番": range(1, 9),
+                         "jockey_id": results["jockey_id"].iloc[:8].values, "trainer_id": results["trainer_id"].iloc[:8].values,
+                         "course": "05芝1600", "date": service.results.state["watermark"] + pd.Timedelta(days=7)})
+
+
+def test_rule_memo_does_not_grow_on_repeated_cards(service, data):
+    # 欠損を含むキーもメモに当たり、同じ出馬表を何度採点してもメモは増えない
+    card = make_card(service, data[0])
+    service.score(card)
+    sizes = {name: len(memo) for name, memo in service.rule_memo.items()}
+    for _ in range(3):
+        service.score(card)
+    assert {name: len(memo) for name, memo in service.rule_memo.items()} == sizes
+
+
+class Writer:
+    def __init__(self):
+        self.data = b""
+
+    def write(self, data):
+        self.data += data
+
+    async def drain(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def test_unexpected_error_returns_500(service, data, monkeypatch):
+    def fail(card):
+        raise RuntimeError("boom")
+
+    monkeypatch.setattr(service, "score", fail)
+    body = make_card(service, data[0]).astype({"date": str}).to_json(orient="records", force_ascii=False).encode("utf-8")
+    reader = asyncio.StreamReader()
+    reader.feed_data(b"POST /score HTTP/1.1\r\nContent-Length: %d\r\n\r\n" % len(body) + body)
+    reader.feed_eof()
+    writer = Writer()
+    asyncio.run(service._handle(reader, writer))
+    head, _, payload = writer.data.partition(b"\r\n\r\n")
+    assert head.startswith(b"HTTP/1.1 500")
+    assert "boom" in json.loads(payload.decode("utf-8"))["error"]
@@ -0,0 +1,43 @@
+import os
+import pandas as pd
+import pytest
+import ai_sinba_1 as sinba
+
+
+@pytest.fixture(scope="module")
+def dataset(data):
+    results, hr, peds = data
+    r = sinba.Results()
+    r.p_p(results)
+    r.merge(hr)
+    p = sinba.Peds()
+    p.peds = peds
+    p.p_p()
+    p.merge(r.merged)
+    p.point()
+    return sinba.Trainer().dataset(p)
+
+
+def test_versions_separate_sources_and_batching():
+    # DataFrameからとTrainingMatrixから、batch_rowsの違いで、保存先のディレクトリが分かれる
+    plain, batched = sinba.Trainer(), sinba.Trainer(batch_rows=1000)
+    assert plain.versions["frame"] != plain.versions["matrix"]
+    assert plain.versions["matrix"] != batched.versions["matrix"]
+    assert plain.versions["frame"] == batched.versions["frame"]
+
+
+def test_walk_forward_and_fit(dataset, tmp_path):
+    # foldごとにメモリマップから学習し、2回目は保存したfoldを使う。fitだけでも保存先を作る
+    trainer = sinba.Trainer(model_dir=str(tmp_path), n_jobs=2, min_train_months=2)
+    metrics = trainer.walk_forward(dataset)
+    assert len(metrics) > 0
+    assert list(metrics.columns) == sinba.METRIC_COLUMNS
+    pd.testing.assert_frame_equal(sinba.Trainer(model_dir=str(tmp_path), n_jobs=2, min_train_months=2).walk_forward(dataset), metrics)
+    artifact = sinba.Trainer(model_dir=str(tmp_path / "fit_only")).fit(dataset)
+    assert os.path.exists(artifact)
+
+
+def test_walk_forward_without_folds(dataset, tmp_path):
+    metrics = sinba.Trainer(model_dir=str(tmp_path), min_train_months=1000).walk_forward(dataset)
+    assert metrics.empty
+    assert list(metrics.columns) == sinba.METRIC_COLUMNS